@@ -0,0 +1,82 @@
+'''
+Recall@k, mAP@k and query speed of model/ann_index.py against the exact blockwise search of model/retrieval.py.
+
+Usage (from the repository root), with embeddings written by evaluate.py --save_embeddings:
+
+python -m benchmarks.ann_benchmark --embeddings_dir embeddings [--k 200]
+
+Without --embeddings_dir, clustered random embeddings of the same size as BasicModel's (1024-d) are used.
+'''
+import argparse
+import time
+
+import numpy as np
+
+from model.ann_index import IVFIndex
+from model.metrics import rank_relevance, average_precision
+from model.retrieval import topk_search
+from utils import load_embeddings
+
+
+def synthetic_embeddings(num_images, num_sketches, num_classes, dim, seed = 0):
+  rng = np.random.RandomState(seed)
+  centers = rng.randn(num_classes, dim).astype(np.float32)
+  image_labels = rng.randint(0, num_classes, num_images); sketch_labels = rng.randint(0, num_classes, num_sketches)
+  image_features = centers[image_labels] + 1.0 * rng.randn(num_images, dim).astype(np.float32)
+  sketch_features = centers[sketch_labels] + 1.0 * rng.randn(num_sketches, dim).astype(np.float32)
+  return image_features, image_labels, sketch_features, sketch_labels
+
+
+def recall_at_k(approximate_indices, exact_indices):
+  '''Fraction of the exact top-k that the approximate search also returns'''
+  hits = [len(np.intersect1d(a, e)) for a, e in zip(approximate_indices, exact_indices)]
+  return np.mean(hits) / exact_indices.shape[1]
+
+
+def relevance_at_k(indices, sketch_labels, image_labels):
+  return rank_relevance(sketch_labels, image_labels, np.maximum(indices, 0)) & (indices >= 0)
+
+
+def map_at_k(indices, sketch_labels, image_labels, num_relevant):
+  '''mAP@k normalised by min(k, relevant photos in the gallery), so both searches share the denominator'''
+  return average_precision(relevance_at_k(indices, sketch_labels, image_labels), num_relevant = num_relevant).mean()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark of the IVF/PQ index against exact search')
+  parser.add_argument('--embeddings_dir', help='Directory written by evaluate.py --save_embeddings')
+  parser.add_argument('--num_images', type=int, help='Synthetic gallery size', default = 50000)
+  parser.add_argument('--num_sketches', type=int, help='Synthetic number of queries', default = 2000)
+  parser.add_argument('--k', type=int, default = 200)
+  parser.add_argument('--metric', choices = ['l2', 'cosine'], default = 'l2')
+  parser.add_argument('--num_lists', type=int, nargs = '+', default = [64, 256])
+  parser.add_argument('--nprobe', type=int, nargs = '+', default = [1, 4, 16])
+  parser.add_argument('--num_subquantizers', type=int, nargs = '+', help='0 stores the full vectors', default = [0, 64])
+  args = parser.parse_args()
+
+  if args.embeddings_dir:
+    image_features, image_labels, sketch_features, sketch_labels = [np.asarray(x) for x in load_embeddings(args.embeddings_dir)]
+  else:
+    image_features, image_labels, sketch_features, sketch_labels = synthetic_embeddings(args.num_images, args.num_sketches, 50, 1024)
+  print('Gallery: %d x %d; queries: %d; k: %d' % (image_features.shape[0], image_features.shape[1], sketch_features.shape[0], args.k))
+
+  start_time = time.time()
+  _, exact_indices = topk_search(sketch_features, image_features, args.k, metric = args.metric)
+  exact_time = time.time() - start_time
+  num_relevant = np.minimum(np.bincount(image_labels)[sketch_labels], args.k)
+  exact_map = map_at_k(exact_indices, sketch_labels, image_labels, num_relevant)
+  print('exact: %.3fs; mAP@%d: %f' % (exact_time, args.k, exact_map))
+
+  print('%9s %6s %6s %9s %9s %9s %10s %9s' % ('num_lists', 'pq', 'nprobe', 'build(s)', 'query(s)', 'speedup', 'recall@k', 'mAP drop'))
+  for num_lists in args.num_lists:
+    for num_subquantizers in args.num_subquantizers:
+      start_time = time.time()
+      index = IVFIndex(num_lists, num_subquantizers = num_subquantizers, metric = args.metric).train(image_features)
+      index.add(image_features)
+      build_time = time.time() - start_time
+      for nprobe in args.nprobe:
+        start_time = time.time()
+        _, indices = index.search(sketch_features, args.k, nprobe = nprobe)
+        query_time = time.time() - start_time
+        print('%9d %6d %6d %9.2f %9.3f %8.1fx %10.4f %9.4f' % (num_lists, num_subquantizers, nprobe, build_time, query_time, exact_time / query_time,
+                                                          recall_at_k(indices, exact_indices), exact_map - map_at_k(indices, sketch_labels, image_labels, num_relevant)))
@@ -0,0 +1,114 @@
+'''
+Two-tower (a DenseNet-121 per domain) against shared-trunk (one backbone, per-domain last dense block) training:
+parameter and optimizer state size, peak memory and step time of the triplet + domain adversarial objective, and
+with --data_dir the test mAP after the same number of training iterations. Each architecture runs in its own process
+so the peak memory of one does not hide the other's.
+
+Usage (from the repository root):
+
+python -m benchmarks.architecture_benchmark [--batch_size 16] [--num_steps 10]
+python -m benchmarks.architecture_benchmark --data_dir DATA_DIR --iterations 500 [--batch_size 16]
+'''
+import argparse
+import multiprocessing
+import time
+
+import torch
+import torch.nn as nn
+
+from model.net import build_models, unique_parameters, DomainAdversarialNet, ARCHITECTURES
+from model.layers import grad_reverse
+from utils import peak_memory_mb
+
+
+def train_step(image_model, sketch_model, domain_net, optimizer, anchors, positives, negatives, accumulation_steps = 1):
+  '''
+  One step of the train.py triplet objective with the gradient reversal layer active. With accumulation_steps > 1 the
+  batch goes through the models in that many micro-batches and their gradients are accumulated, as train.py does over batches.
+  '''
+  criterion = nn.TripletMarginLoss(margin = 1.0, p = 2); domain_criterion = nn.BCELoss()
+  optimizer.zero_grad()
+  for micro_anchors, micro_positives, micro_negatives in zip(*[images.chunk(accumulation_steps) for images in (anchors, positives, negatives)]):
+    pred_sketch_features = sketch_model(micro_anchors)
+    pred_positives_features = image_model(micro_positives); pred_negatives_features = image_model(micro_negatives)
+    image_targets = torch.ones(micro_anchors.shape[0], 1, device = anchors.device); sketch_targets = torch.zeros_like(image_targets)
+    domain_loss = 0.5 * (domain_criterion(domain_net(grad_reverse(pred_positives_features, 1.0)), image_targets)
+                         + domain_criterion(domain_net(grad_reverse(pred_negatives_features, 1.0)), image_targets))
+    domain_loss = domain_loss + 0.5 * domain_criterion(domain_net(grad_reverse(pred_sketch_features, 1.0)), sketch_targets)
+    loss = criterion(pred_sketch_features, pred_positives_features, pred_negatives_features) + domain_loss
+    (loss * micro_anchors.shape[0] / anchors.shape[0]).backward()
+  optimizer.step()
+
+
+def run(setting, args, results):
+  '''setting: dict of architecture, checkpoint_segments and accumulation_steps. Puts (setting, result dict) on 'results' '''
+  torch.manual_seed(0)
+  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+  image_model, sketch_model = build_models(setting['architecture'], checkpoint_segments = setting.get('checkpoint_segments', 0))
+  image_model = image_model.to(device); sketch_model = sketch_model.to(device)
+  domain_net = DomainAdversarialNet().to(device)
+  params = unique_parameters(image_model, sketch_model, domain_net)
+  optimizer = torch.optim.Adam(params, 0.001)
+  image_model.train(); sketch_model.train(); domain_net.train()
+
+  batches = None
+  if args.data_dir:
+    from model.dataloader import Dataloaders
+    dataloaders = Dataloaders(args.data_dir)
+    train_dataloader = dataloaders.get_train_dataloader(batch_size = args.batch_size, shuffle = True)
+    batches = iter(train_dataloader)
+
+  def next_batch():
+    nonlocal batches
+    if batches is None:
+      return [torch.rand(args.batch_size, 3, 224, 224, device = device) for _ in range(3)]
+    try:
+      batch = next(batches)
+    except StopIteration:
+      batches = iter(train_dataloader); batch = next(batches)
+    return [images.to(device) for images in batch[:3]]
+
+  num_steps = args.iterations if args.data_dir else args.num_steps
+  step_times = []
+  for step in range(num_steps):
+    anchors, positives, negatives = next_batch()
+    if device.type == 'cuda': torch.cuda.synchronize()
+    start_time = time.time()
+    train_step(image_model, sketch_model, domain_net, optimizer, anchors, positives, negatives, setting.get('accumulation_steps', 1))
+    if device.type == 'cuda': torch.cuda.synchronize()
+    if step > 0: step_times.append(time.time() - start_time) # the first step allocates the optimizer state
+
+  optimizer_state = sum(value.numel() * value.element_size() for state in optimizer.state.values() for value in state.values() if torch.is_tensor(value))
+  result = {'parameters': sum(param.numel() for param in params), 'optimizer_state_mb': optimizer_state / 2**20,
+            'peak_memory_mb': peak_memory_mb(device), 'step_time': sum(step_times) / max(len(step_times), 1)}
+
+  if args.data_dir:
+    from evaluate import evaluate
+    _, _, result['mAP'] = evaluate(args.batch_size, dataloaders.get_test_dataloader, image_model, sketch_model, dataloaders.test_dict, k = 0, num_display = 0)
+  results.put((setting, result))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Two-tower vs shared-trunk training benchmark')
+  parser.add_argument('--data_dir', help='Train on this dataset and report the test mAP. Random images (no mAP) if omitted')
+  parser.add_argument('--batch_size', type=int, default = 16)
+  parser.add_argument('--num_steps', type=int, help='Timed steps on random images', default = 10)
+  parser.add_argument('--iterations', type=int, help='Training iterations with --data_dir', default = 500)
+  args = parser.parse_args()
+
+  context = multiprocessing.get_context('spawn')
+  results = context.Queue()
+  summary = {}
+  for architecture in ARCHITECTURES:
+    process = context.Process(target = run, args = ({'architecture': architecture}, args, results))
+    process.start()
+    _, result = results.get()
+    process.join()
+    summary[architecture] = result
+    print('%-12s: %9d parameters; optimizer state %7.1f MB; peak memory %8.1f MB; %.3fs per step%s'
+          % (architecture, result['parameters'], result['optimizer_state_mb'], result['peak_memory_mb'], result['step_time'],
+             '; mAP %f' % result['mAP'] if 'mAP' in result else ''))
+
+  two_tower, shared = summary['two_tower'], summary['shared_trunk']
+  print('shared_trunk / two_tower: parameters %.2f; peak memory %.2f; step time %.2f'
+        % (shared['parameters'] / two_tower['parameters'], shared['peak_memory_mb'] / two_tower['peak_memory_mb'], shared['step_time'] / two_tower['step_time']))
@@ -0,0 +1,52 @@
+'''
+Runs model/autotune.py for evaluation (forward passes) and training (train.py triplet steps) of an architecture, then times
+the default setting (--default_batch_size with all threads, as evaluate.py and train.py run without tuning) with the same
+probes, and reports the throughput of both. Tuning results are written to --cache_file (a temporary file by default, so the
+run does not change the cache evaluate.py and train.py read).
+
+Usage (from the repository root):
+
+python -m benchmarks.autotune_benchmark [--architecture two_tower] [--max_batch_size 64] [--memory_limit_mb MB] [--cache_file FILE]
+'''
+import argparse
+import functools
+import os
+import shutil
+import tempfile
+
+import torch
+
+from model.autotune import autotune, default_thread_counts, ProbeRunner
+from model.net import build_models, ARCHITECTURES
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Batch size and thread autotuning benchmark')
+  parser.add_argument('--architecture', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--max_batch_size', type=int, default = 64)
+  parser.add_argument('--default_batch_size', type=int, default = 32)
+  parser.add_argument('--memory_limit_mb', type=float)
+  parser.add_argument('--min_time', type=float, help='Seconds timed per probe', default = 0.5)
+  parser.add_argument('--cache_file')
+  args = parser.parse_args()
+
+  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+  work_dir = tempfile.mkdtemp(prefix = 'autotune_benchmark_')
+  try:
+    cache_file = args.cache_file or os.path.join(work_dir, 'autotune.json')
+    factory = functools.partial(build_models, args.architecture, 0, 0, False)
+    for mode in ['inference', 'train']:
+      setting = autotune(mode, factory, device, name = 'build_models:%s' % args.architecture, memory_limit_mb = args.memory_limit_mb,
+                         max_batch_size = args.max_batch_size, cache_file = cache_file, retune = True, min_time = args.min_time)
+      runner = ProbeRunner(mode, ('factory', factory), device, args.min_time)
+      try:
+        default = runner.probe(args.default_batch_size, default_thread_counts(device)[-1])
+      finally:
+        runner.close()
+      unit = 'triplets/s' if mode == 'train' else 'images/s'
+      print('%-9s: tuned batch size %d, %d threads: %.1f %s, peak %.0f MB; default batch size %d, %d threads: %s; tuning took %.0fs'
+            % (mode, setting['batch_size'], setting['num_threads'], setting['items_per_second'], unit, setting['peak_memory_mb'],
+               default['batch_size'], default['num_threads'], default.get('error') or '%.1f %s, peak %.0f MB' % (default['items_per_second'], unit, default['peak_memory_mb']),
+               setting['tuning_time']))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors = True)
@@ -0,0 +1,115 @@
+'''
+Scaling of distributed training (model/distributed.py) on this host: for every world size, that many local processes
+(gloo backend, an equal share of the cores each) run the train.py triplet step (model.autotune.train_step) through
+DistributedDataParallel on random images, --batch_size triplets per process and step. Reports the samples/sec of all the
+processes together and the scaling efficiency against the smallest world size, and checks that the weights are still the
+same on every rank after training and that DistributedBatchNorm1d (DomainAdversarialNet) matches a BatchNorm1d over the
+batches of all the ranks.
+
+Under torchrun (WORLD_SIZE set, e.g. one process per node) the step is timed once in the given process group instead.
+
+Usage (from the repository root):
+
+python -m benchmarks.distributed_benchmark [--world_sizes 1 2 4] [--batch_size 8] [--steps 10] [--architecture two_tower]
+torchrun --nnodes 2 --nproc_per_node 1 --rdzv_endpoint HOST:PORT -m benchmarks.distributed_benchmark [--batch_size 8]
+'''
+import argparse
+import functools
+import multiprocessing
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+from model.autotune import train_step, IMAGE_SIZE
+from model.distributed import init_distributed, barrier, TrainingModules, data_parallel, launch_local
+from model.layers import DistributedBatchNorm1d
+from model.net import build_models, unique_parameters, DomainAdversarialNet, ARCHITECTURES
+
+
+def max_over_ranks(value):
+  value = torch.tensor([float(value)], dtype = torch.float64)
+  if dist.is_initialized(): dist.all_reduce(value, op = dist.ReduceOp.MAX)
+  return float(value)
+
+
+def rank_difference(tensors):
+  '''Largest difference between these tensors on any rank and on rank 0'''
+  vector = torch.cat([tensor.detach().double().flatten() for tensor in tensors])
+  reference = vector.clone()
+  if dist.is_initialized(): dist.broadcast(reference, 0)
+  return max_over_ranks((vector - reference).abs().max())
+
+
+def batch_norm_parity(rank, world_size, batch_size = 4, num_features = 16):
+  '''Largest error of DistributedBatchNorm1d on this rank's share of a batch against BatchNorm1d on the whole batch'''
+  torch.manual_seed(0) # the same full batch and upstream gradients on every rank
+  x = torch.randn(batch_size * world_size, num_features) * 3 + 1; upstream = torch.randn(batch_size * world_size, num_features)
+  reference, distributed = nn.BatchNorm1d(num_features).double(), DistributedBatchNorm1d(num_features).double()
+  full = x.double().requires_grad_(); expected = reference(full); (expected * upstream.double()).sum().backward()
+
+  share = slice(rank * batch_size, (rank + 1) * batch_size)
+  part = x[share].double().requires_grad_()
+  output = distributed(part); (output * upstream[share].double()).sum().backward()
+  weight_grad = distributed.weight.grad.clone()
+  if dist.is_initialized(): dist.all_reduce(weight_grad) # each rank holds the gradient of its own loss
+  with torch.no_grad():
+    errors = [(output - expected[share]).abs().max(), (part.grad - full.grad[share]).abs().max(), (weight_grad - reference.weight.grad).abs().max(),
+              (distributed.running_var - reference.running_var).abs().max()]
+  return max_over_ranks(max(errors))
+
+
+def worker(architecture, batch_size, steps, warmup, results):
+  '''One process of the run: the timed steps, then the checks. Rank 0 sends its results to 'results' (prints them if None)'''
+  rank, world_size = init_distributed()
+  torch.manual_seed(rank) # different weights before DistributedDataParallel copies rank 0's, and different images
+  image_model, sketch_model = build_models(architecture, pretrained = False)
+  for module in list(image_model.modules()) + list(sketch_model.modules()):
+    if hasattr(module, 'reset_parameters'): module.reset_parameters() # pretrained = False leaves them uninitialised
+  domain_net = DomainAdversarialNet()
+  optimizer = torch.optim.Adam(unique_parameters(image_model, sketch_model, domain_net), 0.001)
+  modules = TrainingModules(image_model, sketch_model, domain_net)
+  if world_size > 1: modules = data_parallel(modules, torch.device('cpu'))
+  modules.train()
+  step = functools.partial(train_step, functools.partial(modules, 'image_model'), functools.partial(modules, 'sketch_model'),
+                           functools.partial(modules, 'domain_net'), optimizer)
+  batch = [torch.rand(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE) for _ in range(3)]
+
+  for _ in range(warmup): step(batch)
+  barrier(); start_time = time.time()
+  for _ in range(steps): step(batch)
+  barrier(); elapsed = max_over_ranks(time.time() - start_time)
+
+  result = {'world_size': world_size, 'num_threads': torch.get_num_threads(), 'samples_per_second': batch_size * world_size * steps / elapsed,
+            'weight_difference': rank_difference(unique_parameters(image_model, sketch_model, domain_net) + list(domain_net.buffers())),
+            'batch_norm_error': batch_norm_parity(rank, world_size)}
+  if rank == 0:
+    if results is None: print(result)
+    else: results.put(result)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Distributed training scaling benchmark')
+  parser.add_argument('--world_sizes', type=int, nargs = '+', help='Numbers of local processes (default: powers of two up to the number of CPUs)')
+  parser.add_argument('--architecture', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--batch_size', type=int, help='Triplets per process and step', default = 8)
+  parser.add_argument('--steps', type=int, default = 10)
+  parser.add_argument('--warmup', type=int, default = 2)
+  args = parser.parse_args()
+
+  if int(os.environ.get('WORLD_SIZE', 1)) > 1: # started by torchrun
+    worker(args.architecture, args.batch_size, args.steps, args.warmup, None)
+  else:
+    num_cpus = os.cpu_count() or 1
+    world_sizes = args.world_sizes or [size for size in [1, 2, 4, 8, 16, 32, 64] if size <= num_cpus]
+    results = multiprocessing.get_context('spawn').Queue()
+    runs = []
+    for world_size in world_sizes:
+      launch_local(worker, world_size, (args.architecture, args.batch_size, args.steps, args.warmup, results))
+      runs.append(results.get())
+      run = runs[-1]
+      print('world size %2d (%2d threads each): %7.2f samples/s, %4.0f%% scaling efficiency; weights differ across ranks by %.1e, batch norm error %.1e'
+            % (world_size, run['num_threads'], run['samples_per_second'], 100 * run['samples_per_second'] / (runs[0]['samples_per_second'] * world_size / world_sizes[0]),
+               run['weight_difference'], run['batch_norm_error']))
@@ -0,0 +1,78 @@
+'''
+End-to-end check of download_data.py against a local mirror (src/mirror_server.py) that drops every connection after
+--drop_every bytes: small synthetic Sketchy.7z / extended_photo.zip archives with the real directory layout are
+downloaded concurrently (resuming after every drop), verified against the mirror's SHA256SUMS, extracted and fixed up.
+Then a corrupted archive must be rejected by its checksum.
+
+Usage (from the repository root):
+
+python -m benchmarks.download_check [--archive_mb 4] [--drop_every 1000000]
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import py7zr
+
+import download_data
+sys.path.insert(0, 'src')
+from mirror_server import start_mirror
+
+
+def make_archives(directory, archive_mb):
+  '''Sketchy.7z and extended_photo.zip with the layout download_data.prepare_dataset expects, padded with random bytes'''
+  rng = np.random.RandomState(0)
+  source = os.path.join(directory, 'source')
+  files = {'256x256/photo/tx_000000000000/hot-air_balloon/a.jpg': None, '256x256/sketch/tx_000000000000/cat/a-1.png': None,
+           '256x256/sketch/tx_000000000010/cat/a-1.png': None, 'README.txt': None}
+  for name in files:
+    os.makedirs(os.path.dirname(os.path.join(source, name)) or source, exist_ok = True)
+    with open(os.path.join(source, name), 'wb') as f:
+      f.write(rng.bytes(archive_mb * 2**20 // len(files)))
+  with py7zr.SevenZipFile(os.path.join(directory, 'Sketchy.7z'), 'w') as archive:
+    for name in files:
+      archive.write(os.path.join(source, name), name)
+  with zipfile.ZipFile(os.path.join(directory, 'extended_photo.zip'), 'w') as archive:
+    archive.writestr('EXTEND_image_sketchy/jack-o-lantern/b.jpg', rng.bytes(archive_mb * 2**20))
+  shutil.rmtree(source)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='download_data.py check against a local mirror')
+  parser.add_argument('--archive_mb', type=int, default = 4)
+  parser.add_argument('--drop_every', type=int, help='Bytes per response before the mirror closes the connection', default = 1000000)
+  args = parser.parse_args()
+
+  work_dir = tempfile.mkdtemp(prefix = 'download_check_')
+  try:
+    mirror_dir = os.path.join(work_dir, 'mirror'); os.makedirs(mirror_dir)
+    make_archives(mirror_dir, args.archive_mb)
+    server, base_url = start_mirror(mirror_dir, drop_every = args.drop_every)
+
+    dataset_dir = os.path.join(work_dir, 'Dataset'); os.makedirs(dataset_dir)
+    start_time = time.time()
+    download_data.download_archives(dataset_dir, base_url, max_retries = 3)
+    download_time = time.time() - start_time
+    download_data.prepare_dataset(dataset_dir)
+    for path in ['Sketchy/photo/tx_000000000000/hot_air_balloon/a.jpg', 'Sketchy/sketch/tx_000000000000/cat/a-1.png',
+                 'Sketchy/extended_photo/jack_o_lantern/b.jpg']:
+      assert os.path.exists(os.path.join(dataset_dir, path)), 'missing %s' % path
+    assert not os.path.exists(os.path.join(dataset_dir, 'Sketchy/sketch/tx_000000000010')), 'unwanted directory kept'
+    print('downloaded and prepared %d MB in %.1fs through connections dropped every %d bytes' % (2 * args.archive_mb, download_time, args.drop_every))
+
+    with open(os.path.join(mirror_dir, 'extended_photo.zip'), 'r+b') as f:
+      f.write(b'corrupted') # SHA256SUMS still has the original hash
+    os.makedirs(os.path.join(work_dir, 'Corrupted'))
+    try:
+      download_data.download_archives(os.path.join(work_dir, 'Corrupted'), base_url, max_retries = 3)
+      raise AssertionError('the corrupted archive was accepted')
+    except ValueError as e:
+      print('corrupted archive rejected: %s' % e)
+    server.shutdown()
+  finally:
+    shutil.rmtree(work_dir, ignore_errors = True)
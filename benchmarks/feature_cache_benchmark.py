@@ -0,0 +1,67 @@
+'''
+Training epoch time with the first K DenseNet blocks frozen and their outputs cached (model.feature_cache), for each K:
+time to build the cache, its size on disk, and the time of --num_batches training batches (data loading included)
+against the fully trainable model (K = 0).
+
+Usage (from the repository root):
+
+python -m benchmarks.feature_cache_benchmark --data_dir DATA_DIR [--frozen_blocks 0 1 2 3] [--num_batches 50] [--batch_size 16]
+'''
+import argparse
+import itertools
+import shutil
+import time
+
+import torch
+
+from benchmarks.architecture_benchmark import train_step
+from model.dataloader import Dataloaders
+from model.feature_cache import FeatureCache
+from model.net import build_models, unique_parameters, DomainAdversarialNet, FROZEN_BLOCKS
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Frozen-prefix feature cache benchmark')
+  parser.add_argument('--data_dir', required = True)
+  parser.add_argument('--frozen_blocks', type=int, nargs = '+', choices = FROZEN_BLOCKS, default = list(FROZEN_BLOCKS))
+  parser.add_argument('--num_batches', type=int, help='Timed training batches per setting', default = 50)
+  parser.add_argument('--batch_size', type=int, default = 16)
+  parser.add_argument('--num_workers', type=int, default = 0)
+  parser.add_argument('--cache_dir', default = '/tmp/feature_cache_benchmark')
+  args = parser.parse_args()
+
+  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+  baseline = None
+  for frozen_blocks in args.frozen_blocks:
+    torch.manual_seed(0)
+    image_model, sketch_model = build_models(frozen_blocks = frozen_blocks)
+    image_model = image_model.to(device).train(); sketch_model = sketch_model.to(device).train()
+    domain_net = DomainAdversarialNet().to(device).train()
+    optimizer = torch.optim.Adam(unique_parameters(image_model, sketch_model, domain_net), 0.001)
+    dataloaders = Dataloaders(args.data_dir, num_workers = args.num_workers)
+
+    build_time, cache_mb, encode_sketches, encode_photos = 0.0, 0.0, sketch_model, image_model
+    if frozen_blocks:
+      shutil.rmtree(args.cache_dir, ignore_errors = True)
+      cache = FeatureCache(args.cache_dir, image_model, sketch_model, frozen_blocks)
+      start_time = time.time()
+      cache.build_dataset(dataloaders.train_dataset, batch_size = args.batch_size, num_workers = args.num_workers, device = device)
+      build_time, cache_mb = time.time() - start_time, cache.size_bytes() / 2**20
+      cache.attach(dataloaders.train_dataset)
+      encode_sketches, encode_photos = sketch_model.forward_suffix, image_model.forward_suffix
+
+    train_dataloader = dataloaders.get_train_dataloader(batch_size = args.batch_size, shuffle = True)
+    num_batches = min(args.num_batches, len(train_dataloader))
+    start_time = time.time()
+    for batch in itertools.islice(train_dataloader, num_batches):
+      anchors, positives, negatives = [images.to(device) for images in batch[:3]]
+      train_step(encode_photos, encode_sketches, domain_net, optimizer, anchors, positives, negatives)
+    if device.type == 'cuda': torch.cuda.synchronize()
+    batch_time = (time.time() - start_time) / num_batches
+    if baseline is None and frozen_blocks == 0: baseline = batch_time
+
+    epoch_time = batch_time * len(train_dataloader)
+    print('K = %d: cache %.1f MB (%.2f KB per image), built in %.1fs; %.3fs per batch, epoch %.0fs%s'
+          % (frozen_blocks, cache_mb, 1024 * cache_mb / max(len(dataloaders.train_dataset.image_filenames) + len(dataloaders.train_dataset), 1),
+             build_time, batch_time, epoch_time, '; speedup %.2f' % (baseline / batch_time) if baseline else ''))
+  shutil.rmtree(args.cache_dir, ignore_errors = True)
@@ -0,0 +1,57 @@
+'''
+Cost of updating a gallery of random embeddings: rewriting the whole matrix (as the embedding store does) against a
+GalleryIndex append / remove of --num_changed photos, for each gallery size; then the query time with the tombstones
+and after compact(), and the time of compact() itself.
+
+Usage (from the repository root):
+
+python -m benchmarks.gallery_index_benchmark [--sizes 10000 100000] [--num_changed 100] [--dim 1024] [--index_dir /tmp/gallery_index_benchmark]
+'''
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+import torch
+
+from model.gallery_index import GalleryIndex
+
+
+def timed(fn):
+  start_time = time.time()
+  result = fn()
+  return time.time() - start_time, result
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Gallery index update benchmark')
+  parser.add_argument('--sizes', type=int, nargs = '+', default = [10000, 100000])
+  parser.add_argument('--num_changed', type=int, help='Photos added and removed per update', default = 100)
+  parser.add_argument('--dim', type=int, default = 1024)
+  parser.add_argument('--num_queries', type=int, default = 64)
+  parser.add_argument('--index_dir', default = '/tmp/gallery_index_benchmark')
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  queries = torch.from_numpy(rng.randn(args.num_queries, args.dim).astype(np.float32))
+  for size in args.sizes:
+    shutil.rmtree(args.index_dir, ignore_errors = True)
+    embeddings = rng.randn(size, args.dim).astype(np.float32)
+    paths = ['photo_%d' % i for i in range(size)]
+    index = GalleryIndex(args.index_dir)
+    index.add(paths, embeddings, [0] * size)
+
+    rewrite_time, _ = timed(lambda: np.save(os.path.join(args.index_dir, 'rewrite.npy'), np.concatenate([embeddings, embeddings[:args.num_changed]])))
+    os.remove(os.path.join(args.index_dir, 'rewrite.npy'))
+    new_paths = ['new_photo_%d' % i for i in range(args.num_changed)]
+    add_time, _ = timed(lambda: index.add(new_paths, embeddings[:args.num_changed], [0] * args.num_changed))
+    remove_time, _ = timed(lambda: index.remove(paths[:args.num_changed]))
+    search_time, (distances, _) = timed(lambda: index.snapshot().search(queries, 10))
+    compact_time, _ = timed(index.compact)
+    compacted_search_time, (compacted_distances, _) = timed(lambda: index.snapshot().search(queries, 10))
+    assert np.allclose(distances, compacted_distances), 'compaction changed the search results'
+
+    print('%7d photos: full rewrite %.3fs; add %d %.3fs; remove %d %.3fs; search %.3fs (%.3fs compacted); compact %.3fs'
+          % (size, rewrite_time, args.num_changed, add_time, args.num_changed, remove_time, search_time, compacted_search_time, compact_time))
+  shutil.rmtree(args.index_dir, ignore_errors = True)
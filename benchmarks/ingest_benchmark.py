@@ -0,0 +1,131 @@
+'''
+Wall time and disk footprint of turning the downloaded archives into training data:
+extract-then-load (download_data.prepare_dataset, then one pass decoding every file, as the dataloaders do each epoch),
+extract-then-shard (prepare_dataset, then build_shards over the extracted tree) and streaming ingestion
+(model.ingest.ingest_archives, no extracted tree). Uses synthetic archives with the Sketchy layout unless --archives is given.
+
+Usage (from the repository root):
+
+python -m benchmarks.ingest_benchmark [--num_classes 10] [--images_per_class 100] [--num_workers 4]
+python -m benchmarks.ingest_benchmark --archives Sketchy.7z extended_photo.zip [--num_workers 4]
+'''
+import argparse
+import glob
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from multiprocessing import Pool
+
+import numpy as np
+import py7zr
+from PIL import Image
+
+from download_data import prepare_dataset
+from model.ingest import ingest_archives
+from model.shards import build_shards, decode_image
+
+
+def encoded_image(rng, extension):
+  image = Image.fromarray(rng.randint(0, 256, size = (256, 256, 3), dtype = np.uint8))
+  buffer = io.BytesIO()
+  image.save(buffer, format = 'JPEG' if extension == '.jpg' else 'PNG')
+  return buffer.getvalue()
+
+
+def make_archives(directory, num_classes, images_per_class):
+  '''Sketchy.7z (photos, sketches and one augmented sketch variant to be skipped) and extended_photo.zip'''
+  rng = np.random.RandomState(0)
+  labels = ['class_%d' % i for i in range(num_classes - 1)] + ['hot-air_balloon']
+  with py7zr.SevenZipFile(os.path.join(directory, 'Sketchy.7z'), 'w') as archive:
+    archive.writestr(b'readme', 'README.txt')
+    for label in labels:
+      for i in range(images_per_class):
+        archive.writestr(encoded_image(rng, '.jpg'), '256x256/photo/tx_000000000000/%s/%d.jpg' % (label, i))
+        for variant in ['tx_000000000000', 'tx_000000000010']:
+          archive.writestr(encoded_image(rng, '.png'), '256x256/sketch/%s/%s/%d-1.png' % (variant, label, i))
+  with zipfile.ZipFile(os.path.join(directory, 'extended_photo.zip'), 'w') as archive:
+    for label in labels:
+      for i in range(images_per_class):
+        archive.writestr('EXTEND_image_sketchy/%s/e%d.jpg' % (label, i), encoded_image(rng, '.jpg'))
+
+
+def disk_usage(path):
+  return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def extracted_files(dataset_dir):
+  '''{(section, label): [files]} of the extracted tree, as the dataloaders would see it after the usual reorganisation'''
+  files = {}
+  for section, pattern in [('photos', 'Sketchy/photo/tx_000000000000/*/*.jpg'), ('photos', 'Sketchy/extended_photo/*/*.jpg'),
+                           ('sketches', 'Sketchy/sketch/tx_000000000000/*/*.png')]:
+    for path in glob.glob(os.path.join(dataset_dir, pattern)):
+      files.setdefault((section, os.path.basename(os.path.dirname(path))), []).append(path)
+  return files
+
+
+def extract(archives, work_dir):
+  dataset_dir = os.path.join(work_dir, 'Dataset'); os.makedirs(dataset_dir)
+  for path in archives: shutil.copy(path, dataset_dir) # prepare_dataset deletes the archives
+  peak_disk = disk_usage(dataset_dir)
+  prepare_dataset(dataset_dir)
+  return dataset_dir, peak_disk + disk_usage(dataset_dir)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Archive ingestion benchmark')
+  parser.add_argument('--archives', nargs = '+', help='Sketchy.7z and extended_photo.zip (synthetic archives if omitted)')
+  parser.add_argument('--num_classes', type=int, default = 10)
+  parser.add_argument('--images_per_class', type=int, default = 100)
+  parser.add_argument('--num_workers', type=int, default = 0)
+  args = parser.parse_args()
+
+  work_dir = tempfile.mkdtemp(prefix = 'ingest_benchmark_')
+  try:
+    archives = args.archives
+    if not archives:
+      archive_dir = os.path.join(work_dir, 'archives'); os.makedirs(archive_dir)
+      make_archives(archive_dir, args.num_classes, args.images_per_class)
+      archives = [os.path.join(archive_dir, 'Sketchy.7z'), os.path.join(archive_dir, 'extended_photo.zip')]
+    archives_size = sum(os.path.getsize(path) for path in archives)
+    print('archives: %.1f MB' % (archives_size / 2**20))
+
+    pool = Pool(args.num_workers) if args.num_workers > 0 else None
+    run = pool.map if pool else lambda fn, items: list(map(fn, items))
+    results = []
+
+    '''EXTRACT, THEN DECODE EVERY FILE'''
+    start_time = time.time()
+    dataset_dir, peak_disk = extract(archives, os.path.join(work_dir, 'load'))
+    extract_time = time.time() - start_time
+    files = extracted_files(dataset_dir)
+    num_images = sum(len(paths) for paths in files.values())
+    run(decode_image, [path for paths in files.values() for path in paths])
+    results.append(('extract then load', time.time() - start_time, disk_usage(dataset_dir), peak_disk))
+    shutil.rmtree(os.path.join(work_dir, 'load'))
+
+    '''EXTRACT, THEN BUILD THE SHARDS'''
+    start_time = time.time()
+    dataset_dir, peak_disk = extract(archives, os.path.join(work_dir, 'shard'))
+    shard_dir = os.path.join(work_dir, 'shard', 'shards')
+    files = extracted_files(dataset_dir)
+    for section in ['photos', 'sketches']:
+      build_shards(os.path.join(shard_dir, section), {label: paths for (paths_section, label), paths in files.items() if paths_section == section}, args.num_workers)
+    results.append(('extract then shard', time.time() - start_time, disk_usage(shard_dir), peak_disk + disk_usage(shard_dir)))
+    shutil.rmtree(os.path.join(work_dir, 'shard'))
+    if pool: pool.close(); pool.join()
+
+    '''STREAM INTO SHARDS'''
+    start_time = time.time()
+    shard_dir = os.path.join(work_dir, 'stream')
+    counts = ingest_archives(archives, shard_dir, args.num_workers)
+    assert sum(counts.values()) == num_images, 'streaming ingested %d images, the extracted tree has %d' % (sum(counts.values()), num_images)
+    results.append(('stream into shards', time.time() - start_time, disk_usage(shard_dir), archives_size + disk_usage(shard_dir)))
+
+    print('%d images (extract then load: extraction %.1fs)' % (num_images, extract_time))
+    for name, elapsed, footprint, peak in results:
+      print('%-19s: %7.1fs; result on disk %8.1f MB; peak disk %8.1f MB (archives included)' % (name, elapsed, footprint / 2**20, peak / 2**20))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors = True)
@@ -0,0 +1,100 @@
+'''
+Load generator for serve.py: 'concurrency' clients send sketch queries back to back for 'duration' seconds,
+then the client-side latency percentiles and throughput are printed along with the server's /stats.
+
+Usage (from the repository root, with serve.py running):
+
+python -m benchmarks.load_generator --sketch_dir Dataset/sketches/teapot [--concurrency 16] [--duration 30] [--port 8000]
+python -m benchmarks.load_generator --sketch_dir ... --unix_socket /tmp/sbir.sock
+'''
+import argparse
+import glob
+import http.client
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+  def __init__(self, path, timeout = 60):
+    super(UnixHTTPConnection, self).__init__('localhost', timeout = timeout)
+    self.path = path
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.path)
+
+
+def connect(args):
+  if args.unix_socket:
+    return UnixHTTPConnection(args.unix_socket)
+  return http.client.HTTPConnection(args.host, args.port, timeout = 60)
+
+
+def load_sketches(sketch_dir, max_sketches = 64):
+  if sketch_dir:
+    filenames = sorted(glob.glob(os.path.join(sketch_dir, '*.png')) + glob.glob(os.path.join(sketch_dir, '*.jpg')))[:max_sketches]
+    return [open(filename, 'rb').read() for filename in filenames]
+  # random strokes-like noise, enough to exercise the service
+  rng = np.random.RandomState(0)
+  sketches = []
+  for _ in range(8):
+    buffer = io.BytesIO()
+    Image.fromarray(np.uint8(255 * (rng.rand(256, 256, 3) > 0.05))).save(buffer, format = 'PNG')
+    sketches.append(buffer.getvalue())
+  return sketches
+
+
+def client(args, sketches, deadline, latencies, errors, lock):
+  connection = connect(args)
+  i = 0
+  while time.time() < deadline:
+    start_time = time.time()
+    try:
+      connection.request('POST', '/query?k=%d' % args.k, body = sketches[i % len(sketches)], headers = {'Content-Type': 'application/octet-stream'})
+      response = connection.getresponse(); response.read()
+      ok = response.status == 200
+    except (http.client.HTTPException, OSError):
+      ok = False
+      connection.close(); connection = connect(args)
+    with lock:
+      (latencies if ok else errors).append(time.time() - start_time)
+    i += 1
+  connection.close()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Load generator for the local retrieval service')
+  parser.add_argument('--sketch_dir', help='Directory of sketch images to send. Random images if omitted')
+  parser.add_argument('--host', default = '127.0.0.1')
+  parser.add_argument('--port', type=int, default = 8000)
+  parser.add_argument('--unix_socket')
+  parser.add_argument('--concurrency', type=int, nargs = '+', default = [1, 4, 16])
+  parser.add_argument('--duration', type=float, help='Seconds per concurrency level', default = 20)
+  parser.add_argument('--k', type=int, default = 10)
+  args = parser.parse_args()
+
+  sketches = load_sketches(args.sketch_dir)
+  for concurrency in args.concurrency:
+    latencies = []; errors = []; lock = threading.Lock()
+    deadline = time.time() + args.duration
+    threads = [threading.Thread(target = client, args = (args, sketches, deadline, latencies, errors, lock)) for _ in range(concurrency)]
+    start_time = time.time()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.time() - start_time
+
+    latencies_ms = 1000.0 * np.array(latencies) if latencies else np.zeros(1)
+    print('concurrency %3d: %7.1f queries/s; p50: %7.1f ms; p99: %7.1f ms; errors: %d'
+          % (concurrency, len(latencies) / elapsed, np.percentile(latencies_ms, 50), np.percentile(latencies_ms, 99), len(errors)))
+
+  connection = connect(args)
+  connection.request('GET', '/stats'); stats = json.loads(connection.getresponse().read())
+  print('server stats: %s' % json.dumps(stats, indent = 2))
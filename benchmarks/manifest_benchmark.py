@@ -0,0 +1,55 @@
+'''
+Time to list the dataset: the glob of every class directory (dataloader.get_data_list) against the cached manifest
+(model/manifest.py) when it is built, when it is loaded unchanged, and after one class directory changed.
+
+Usage (from the repository root):
+
+python -m benchmarks.manifest_benchmark --data_dir DATA_DIR [--manifest_path /tmp/manifest.npz] [--num_workers 8]
+'''
+import argparse
+import os
+import time
+
+from model.dataloader import get_data_list, label2index
+from model.manifest import DatasetManifest
+
+
+def timed(fn):
+  start_time = time.time()
+  result = fn()
+  return time.time() - start_time, result
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Dataset listing benchmark')
+  parser.add_argument('--data_dir', required = True)
+  parser.add_argument('--manifest_path', help='Where to write the manifest (default <data_dir>/manifest.npz is left untouched)', default = '/tmp/manifest_benchmark.npz')
+  parser.add_argument('--num_workers', type=int, default = 8)
+  args = parser.parse_args()
+
+  labels = open(os.path.join(args.data_dir, 'train_labels.txt')).read().splitlines()
+  labels += open(os.path.join(args.data_dir, 'test_labels.txt')).read().splitlines()
+  label_to_index = label2index(labels)
+  sections = ['photos', 'sketches']
+
+  glob_time, glob_lists = timed(lambda: [get_data_list(args.data_dir, labels, label_to_index, section) for section in sections])
+  print('glob: %.3fs for %d files' % (glob_time, sum(len(filenames) for filenames, _ in glob_lists)))
+
+  if os.path.exists(args.manifest_path): os.remove(args.manifest_path)
+  def listing():
+    manifest = DatasetManifest(args.data_dir, manifest_path = args.manifest_path, num_workers = args.num_workers)
+    return manifest.update(sections, labels), [manifest.get_data_list(labels, label_to_index, section) for section in sections]
+
+  for name in ['manifest build', 'manifest load']:
+    elapsed, (num_scanned, lists) = timed(listing)
+    print('%s: %.3fs (%d directories listed)' % (name, elapsed, num_scanned))
+  assert all(sorted(zip(*a)) == sorted(zip(*b)) for a, b in zip(lists, glob_lists)), 'the manifest lists different files than glob'
+
+  directory = os.path.join(args.data_dir, sections[0], labels[0])
+  times = os.stat(directory)
+  os.utime(directory, ns = (times.st_atime_ns, times.st_mtime_ns + 10**9)) # as if a file was added
+  try:
+    elapsed, (num_scanned, _) = timed(listing)
+  finally:
+    os.utime(directory, ns = (times.st_atime_ns, times.st_mtime_ns)) # the dataset's own manifest still matches the directory
+  print('manifest after one directory changed: %.3fs (%d directories listed)' % (elapsed, num_scanned))
@@ -0,0 +1,40 @@
+'''
+Peak memory (RSS on CPU, allocated memory on GPU) and time per effective batch of the triplet + domain adversarial step
+with activation checkpointing and gradient accumulation. Every setting trains on the same effective batch size in its
+own process.
+
+Usage (from the repository root):
+
+python -m benchmarks.memory_benchmark [--batch_size 32] [--checkpoint_segments 0 4] [--accumulation_steps 1 4] [--num_steps 4]
+'''
+import argparse
+import multiprocessing
+
+from model.net import ARCHITECTURES
+from benchmarks.architecture_benchmark import run
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Activation checkpointing / gradient accumulation memory benchmark')
+  parser.add_argument('--architecture', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--batch_size', type=int, help='Effective batch size (triplets per optimizer step)', default = 32)
+  parser.add_argument('--checkpoint_segments', type=int, nargs = '+', default = [0, 4])
+  parser.add_argument('--accumulation_steps', type=int, nargs = '+', default = [1, 4])
+  parser.add_argument('--num_steps', type=int, help='Optimizer steps per setting (the first one is not timed)', default = 4)
+  args = parser.parse_args()
+  args.data_dir = None
+
+  context = multiprocessing.get_context('spawn')
+  results = context.Queue()
+  baseline = None
+  for checkpoint_segments in args.checkpoint_segments:
+    for accumulation_steps in args.accumulation_steps:
+      setting = {'architecture': args.architecture, 'checkpoint_segments': checkpoint_segments, 'accumulation_steps': accumulation_steps}
+      process = context.Process(target = run, args = (setting, args, results))
+      process.start()
+      _, result = results.get()
+      process.join()
+      baseline = baseline or result
+      print('checkpoint segments %2d; accumulation steps %2d (micro-batch %3d): peak memory %8.1f MB (%.2fx); %.3fs per step (%.2fx)'
+            % (checkpoint_segments, accumulation_steps, args.batch_size // accumulation_steps, result['peak_memory_mb'],
+               result['peak_memory_mb'] / baseline['peak_memory_mb'], result['step_time'], result['step_time'] / baseline['step_time']))
@@ -0,0 +1,63 @@
+'''
+Checks that model/metrics.py reproduces the per-sketch sklearn average_precision_score loop evaluate.py used before,
+and times both.
+
+Usage (from the repository root):
+
+python -m benchmarks.metrics_parity [--num_sketches 2000] [--num_images 5000]
+'''
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial.distance import cdist
+from sklearn.metrics import average_precision_score
+
+from model.metrics import retrieval_metrics, per_class_mean
+
+
+def sklearn_average_precisions(sketch_features, image_features, sketch_labels, image_labels):
+  '''The previous evaluate.py implementation'''
+  distance = cdist(sketch_features, image_features, 'minkowski')
+  similarity = 1.0/distance
+  is_correct_label_index = 1 * (np.expand_dims(sketch_labels, axis = 1) == np.expand_dims(image_labels, axis = 0))
+  return np.array([average_precision_score(is_correct_label_index[i], similarity[i]) for i in range(sketch_labels.shape[0])])
+
+
+def make_features(num_items, num_classes, dim, rng, quantize = False):
+  labels = rng.randint(0, num_classes, num_items)
+  centers = rng.randn(num_classes, dim)
+  features = (centers[labels] + 2.0 * rng.randn(num_items, dim)).astype(np.float32)
+  if quantize:
+    # coarse features produce many tied distances, which exercises the tie handling
+    features = np.round(features)
+  return features, labels
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Parity and speed of the vectorized mAP against sklearn')
+  parser.add_argument('--num_sketches', type=int, default = 2000)
+  parser.add_argument('--num_images', type=int, default = 5000)
+  parser.add_argument('--num_classes', type=int, default = 10)
+  parser.add_argument('--dim', type=int, default = 64)
+  parser.add_argument('--block_size', type=int, default = 256)
+  args = parser.parse_args()
+
+  rng = np.random.RandomState(0)
+  for quantize in [False, True]:
+    sketch_features, sketch_labels = make_features(args.num_sketches, args.num_classes, args.dim, rng, quantize)
+    image_features, image_labels = make_features(args.num_images, args.num_classes, args.dim, rng, quantize)
+
+    start_time = time.time()
+    expected = sklearn_average_precisions(sketch_features, image_features, sketch_labels, image_labels)
+    sklearn_time = time.time() - start_time
+
+    start_time = time.time()
+    scores = retrieval_metrics(sketch_features, image_features, sketch_labels, image_labels, ks = (200,), block_size = args.block_size)
+    vectorized_time = time.time() - start_time
+
+    max_error = np.abs(scores['ap'] - expected).max()
+    class_error = np.nanmax(np.abs(per_class_mean(scores['ap'], sketch_labels, args.num_classes) - per_class_mean(expected, sketch_labels, args.num_classes)))
+    print('ties: %s; mAP sklearn: %f; mAP vectorized: %f; max AP error: %g; max per-class error: %g' % (quantize, expected.mean(), scores['ap'].mean(), max_error, class_error))
+    print('sklearn loop: %.3fs; vectorized: %.3fs; speedup: %.1fx' % (sklearn_time, vectorized_time, sklearn_time / vectorized_time))
+    assert max_error < 1e-4, 'vectorized AP differs from sklearn'
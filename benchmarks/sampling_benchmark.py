@@ -0,0 +1,77 @@
+'''
+Triplet sampling rate (positive image + negative class + negative image, without reading the images) of the
+per-class index and alias tables in model/samplers.py against the previous per-item list scans.
+
+Usage (from the repository root):
+
+python -m benchmarks.sampling_benchmark [--num_classes 100] [--images_per_class 700] [--num_samples 20000]
+'''
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from model.samplers import TripletSampler
+
+
+def get_random_image(image_label_indices, image_filenames, label_idx):
+  '''The positive/negative image draw of model/dataloader.py before the precomputed tables: a scan of every label'''
+  indices = [i for i,label in enumerate(image_label_indices) if label == label_idx]
+  return image_filenames[np.random.choice(indices, 1)[0]]
+
+
+def previous_triplet(label_idx, image_label_idxs, image_filenames, word_vectors_similarity, label_to_index):
+  '''The sampling SketchyTrainDataset.__getitem__ did before the precomputed tables'''
+  positive = get_random_image(image_label_idxs, image_filenames, label_idx)
+  current_label_similarities = word_vectors_similarity[label_idx]
+  negative_labels = [x for x in label_to_index.values() if x != label_idx]
+  negative_labels_similarities = [current_label_similarities[x] for x in negative_labels]
+  negative_labels_similarities /= np.linalg.norm(negative_labels_similarities, ord = 1)
+  negative_label = np.random.choice(negative_labels, 1, p = negative_labels_similarities)[0]
+  negative = get_random_image(image_label_idxs, image_filenames, negative_label)
+  return positive, negative_label, negative
+
+
+def current_triplet(label_idx, sampler, image_filenames):
+  positive = image_filenames[sampler.random_image(label_idx)]
+  negative_label = sampler.negative_label(label_idx)
+  negative = image_filenames[sampler.random_image(negative_label)]
+  return positive, negative_label, negative
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Triplet sampling micro-benchmark')
+  parser.add_argument('--num_classes', type=int, default = 100)
+  parser.add_argument('--images_per_class', type=int, default = 700)
+  parser.add_argument('--num_samples', type=int, default = 20000)
+  args = parser.parse_args()
+
+  np.random.seed(0)
+  embedding = np.random.rand(args.num_classes, 300)
+  wv_distance = cdist(embedding, embedding, 'minkowski')
+  word_vectors_similarity = np.where(wv_distance == 0, 1.0, 1.0 / np.maximum(wv_distance, 1e-12))
+  image_label_idxs = list(np.repeat(np.arange(args.num_classes), args.images_per_class))
+  image_filenames = ['image_%d.jpg' % i for i in range(len(image_label_idxs))]
+  label_to_index = {'class_%d' % i: i for i in range(args.num_classes)}
+  anchor_labels = np.random.randint(args.num_classes, size = args.num_samples)
+
+  start_time = time.time()
+  sampler = TripletSampler(image_label_idxs, word_vectors_similarity)
+  print('Table construction: %.3fs' % (time.time() - start_time))
+
+  num_previous = max(args.num_samples // 20, 1) # the previous sampler is too slow for the full count
+  start_time = time.time()
+  previous_negatives = [previous_triplet(l, image_label_idxs, image_filenames, word_vectors_similarity, label_to_index)[1] for l in anchor_labels[:num_previous]]
+  previous_rate = num_previous / (time.time() - start_time)
+
+  start_time = time.time()
+  current_negatives = [current_triplet(l, sampler, image_filenames)[1] for l in anchor_labels]
+  current_rate = args.num_samples / (time.time() - start_time)
+
+  print('previous: %.0f triplets/s; current: %.0f triplets/s; speedup: %.1fx' % (previous_rate, current_rate, current_rate / previous_rate))
+
+  '''SANITY CHECK OF THE NEGATIVE CLASS DISTRIBUTION FOR ONE ANCHOR CLASS'''
+  expected = word_vectors_similarity[0].copy(); expected[0] = 0; expected /= expected.sum()
+  observed = np.bincount([sampler.negative_label(0) for _ in range(100000)], minlength = args.num_classes) / 100000.0
+  print('max |observed - expected| negative class probability: %.4f' % np.abs(observed - expected).max())
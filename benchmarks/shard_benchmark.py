@@ -0,0 +1,46 @@
+'''
+Epoch time of the datasets reading from the pre-decoded shards (build_shards.py) against decoding every file with PIL.
+
+Usage (from the repository root):
+
+python -m benchmarks.shard_benchmark --data_dir Dataset --shard_dir shards [--epochs 2] [--max_batches 100]
+
+The first epoch of each mode is reported as cold and the following ones as warm. For a truly cold first epoch,
+drop the page cache before running (sync; echo 3 > /proc/sys/vm/drop_caches).
+'''
+import argparse
+import time
+
+import torch
+
+from model.dataloader import Dataloaders
+
+
+def time_epochs(dataloader, epochs, max_batches):
+  epoch_times = []
+  for epoch in range(epochs):
+    start_time = time.time()
+    for iteration, batch in enumerate(dataloader):
+      if iteration + 1 >= max_batches:
+        break
+    epoch_times.append(time.time() - start_time)
+  return epoch_times
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Shard vs PIL data loading benchmark')
+  parser.add_argument('--data_dir', required = True)
+  parser.add_argument('--shard_dir', required = True)
+  parser.add_argument('--batch_size', type=int, default = 32)
+  parser.add_argument('--epochs', type=int, default = 2)
+  parser.add_argument('--max_batches', type=int, help='Batches per epoch', default = 100)
+  args = parser.parse_args()
+
+  for mode, shard_dir in [('pil', None), ('shards', args.shard_dir)]:
+    dataloaders = Dataloaders(args.data_dir, shard_dir = shard_dir)
+    torch.manual_seed(0)
+    for name, dataloader in [('train triplets', dataloaders.get_train_dataloader(args.batch_size, shuffle = True)),
+                             ('test photos', dataloaders.get_test_dataloader(args.batch_size, 'photos')),
+                             ('test sketches', dataloaders.get_test_dataloader(args.batch_size, 'sketches'))]:
+      epoch_times = time_epochs(dataloader, args.epochs, args.max_batches)
+      print('%-7s %-14s cold: %.2fs; warm: %s' % (mode, name, epoch_times[0], ', '.join('%.2fs' % t for t in epoch_times[1:])))
@@ -0,0 +1,42 @@
+'''
+Test-set evaluation time (encoding the photos and sketches, then ranking) in this process against evaluate(num_shards = N)
+for N = 1 .. --max_shards CPU worker processes, and the check that every setting reports the same mAP.
+
+Usage (from the repository root):
+
+python -m benchmarks.sharded_eval_benchmark --data_dir DATA_DIR [--max_shards 4] [--batch_size 32] [--architecture two_tower]
+'''
+import argparse
+import time
+
+import torch
+
+from evaluate import evaluate
+from model.dataloader import Dataloaders
+from model.net import build_models, ARCHITECTURES
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Sharded evaluation benchmark')
+  parser.add_argument('--data_dir', required = True)
+  parser.add_argument('--max_shards', type=int, default = 4)
+  parser.add_argument('--batch_size', type=int, default = 32)
+  parser.add_argument('--architecture', choices = ARCHITECTURES, default = 'two_tower')
+  args = parser.parse_args()
+
+  torch.manual_seed(0)
+  image_model, sketch_model = build_models(args.architecture)
+  dataloaders = Dataloaders(args.data_dir)
+  num_items = sum(len(dataloaders.get_test_dataloader(batch_size = 1, section = section).dataset) for section in ['photos', 'sketches'])
+  device = torch.device('cpu')
+
+  baseline = None
+  for num_shards in range(args.max_shards + 1):
+    start_time = time.time()
+    _, _, mean_average_precision = evaluate(args.batch_size, dataloaders.get_test_dataloader, image_model, sketch_model, dataloaders.test_dict,
+                                            k = 0, num_display = 0, device = device, num_shards = num_shards)
+    elapsed = time.time() - start_time
+    if baseline is None: baseline = (elapsed, mean_average_precision)
+    print('%-12s: %.2fs; %.1f images/s; speedup %.2f; mAP %f'
+          % ('in process' if num_shards == 0 else '%d shards' % num_shards, elapsed, num_items / elapsed, baseline[0] / elapsed, mean_average_precision))
+    assert abs(mean_average_precision - baseline[1]) < 1e-6, 'sharded evaluation changed the mAP'
@@ -0,0 +1,122 @@
+'''
+Cold-start time of evaluate.py-style model loading: a fresh interpreter imports evaluate.py, builds the models, loads a
+checkpoint and answers a first query (one sketch embedded and ranked against a random gallery). Two modes:
+  baseline: the previous start-up, emulated: scipy/pytz imported eagerly, ImageNet weights read for both models and then
+            overwritten, the whole checkpoint read with torch.load
+  fast:     build_models(pretrained = False) and load_checkpoint (memory-mapped where torch supports it)
+The ImageNet weights are read from the torch hub cache; if they are not there, a stand-in file of the same size is written
+to a temporary TORCH_HOME (so the baseline does not depend on the network, which it otherwise needs).
+Without --model, a random checkpoint with the domain model and Adam state (like train.py's last.pth.tar) is used.
+
+Usage (from the repository root):
+
+python -m benchmarks.startup_benchmark [--model CHECKPOINT] [--architecture two_tower] [--repeats 3] [--drop_caches]
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ['imports', 'construct', 'load', 'first query']
+DENSENET_WEIGHTS = 'densenet121-a639ec97.pth' # torchvision's file name of the ImageNet weights
+
+
+def child(mode, model, architecture):
+  '''One cold start, in this (fresh) process. Prints the time of every phase as json'''
+  times = {}; start_time = time.time()
+  if mode == 'baseline':
+    import pytz, scipy.spatial.distance # imported by evaluate.py / model.dataloader before
+  import torch
+  from evaluate import build_models, load_checkpoint
+  from model.retrieval import topk_search
+  times['imports'] = time.time() - start_time; start_time = time.time()
+
+  image_model, sketch_model = build_models(architecture, pretrained = mode == 'baseline')
+  times['construct'] = time.time() - start_time; start_time = time.time()
+
+  if mode == 'baseline':
+    checkpoint = torch.load(model, map_location = 'cpu')
+    image_model.load_state_dict(checkpoint['image_model']); sketch_model.load_state_dict(checkpoint['sketch_model'])
+  else:
+    load_checkpoint(model, image_model, sketch_model)
+  times['load'] = time.time() - start_time; start_time = time.time()
+
+  sketch_model.eval()
+  with torch.no_grad():
+    features = sketch_model(torch.rand(1, 3, 224, 224))
+  topk_search(features, torch.rand(1000, features.shape[1]), 10)
+  times['first query'] = time.time() - start_time
+  print(json.dumps(times))
+
+
+def make_checkpoint(path, architecture):
+  import torch
+  from model.net import build_models, unique_parameters, DomainAdversarialNet
+  image_model, sketch_model = build_models(architecture, pretrained = False)
+  for module in list(image_model.modules()) + list(sketch_model.modules()):
+    if hasattr(module, 'reset_parameters'): module.reset_parameters() # random weights (pretrained = False leaves them uninitialised)
+  domain_net = DomainAdversarialNet()
+  params = unique_parameters(image_model, sketch_model, domain_net)
+  optimizer = torch.optim.Adam(params, 0.001)
+  for param in params: param.grad = torch.zeros_like(param)
+  optimizer.step() # creates the Adam state
+  torch.save({'iteration': 0, 'image_model': image_model.state_dict(), 'sketch_model': sketch_model.state_dict(),
+              'domain_model': domain_net.state_dict(), 'optim_dict': optimizer.state_dict()}, path)
+
+
+def drop_caches():
+  '''Empties the page cache (Linux, as root), so the files are read from the disk again'''
+  subprocess.run(['sync'])
+  with open('/proc/sys/vm/drop_caches', 'w') as f:
+    f.write('3\n')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Model construction and checkpoint loading start-up benchmark')
+  parser.add_argument('--model', help='Checkpoint to load (a random one if omitted)')
+  parser.add_argument('--architecture', choices = ['two_tower', 'shared_trunk'], default = 'two_tower')
+  parser.add_argument('--repeats', type=int, default = 3)
+  parser.add_argument('--drop_caches', action = 'store_true', help='Drop the page cache before every start (needs root)')
+  parser.add_argument('--child', choices = ['baseline', 'fast'], help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    child(args.child, args.model, args.architecture)
+    sys.exit(0)
+
+  import torch
+  work_dir = tempfile.mkdtemp(prefix = 'startup_benchmark_')
+  try:
+    env = dict(os.environ)
+    if not os.path.exists(os.path.join(torch.hub.get_dir(), 'checkpoints', DENSENET_WEIGHTS)):
+      import torchvision
+      env['TORCH_HOME'] = os.path.join(work_dir, 'torch_home'); os.makedirs(os.path.join(env['TORCH_HOME'], 'hub', 'checkpoints'))
+      torch.save(torchvision.models.densenet121().state_dict(), os.path.join(env['TORCH_HOME'], 'hub', 'checkpoints', DENSENET_WEIGHTS))
+      print('ImageNet weights not cached: the baseline reads a stand-in file of the same size')
+    model = args.model
+    if not model:
+      model = os.path.join(work_dir, 'last.pth.tar')
+      make_checkpoint(model, args.architecture)
+    print('checkpoint: %.1f MB' % (os.path.getsize(model) / 2**20))
+
+    results = {'baseline': [], 'fast': []}
+    for _ in range(args.repeats):
+      for mode in results:
+        if args.drop_caches: drop_caches()
+        start_time = time.time()
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.startup_benchmark', '--child', mode, '--model', model, '--architecture', args.architecture],
+                                env = env, stdout = subprocess.PIPE, check = True, universal_newlines = True).stdout
+        times = json.loads(output.strip().splitlines()[-1])
+        times['total'] = time.time() - start_time # interpreter start-up included
+        results[mode].append(times)
+
+    print('median of %d starts%s' % (args.repeats, ', page cache dropped before each' if args.drop_caches else ''))
+    for mode, runs in results.items():
+      median = {phase: sorted(run[phase] for run in runs)[len(runs) // 2] for phase in PHASES + ['total']}
+      print('%-8s: %s' % (mode, '; '.join('%s %.2fs' % (phase, median[phase]) for phase in PHASES + ['total'])))
+  finally:
+    shutil.rmtree(work_dir, ignore_errors = True)
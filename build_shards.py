@@ -0,0 +1,36 @@
+import argparse
+import os
+import time
+import datetime
+
+from model.manifest import DatasetManifest
+from model.shards import build_shards
+from model.ingest import ingest_archives
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Decodes and resizes every photo/sketch once into per-class shards that the datasets can memory-map')
+  parser.add_argument('--data_dir', help='Data directory path. Directory should contain two folders - sketches and photos, along with 2 .txt files for the labels')
+  parser.add_argument('--archives', nargs = '+', help='Sketchy.7z and extended_photo.zip: stream the shards straight from the downloaded archives (every class) instead of --data_dir')
+  parser.add_argument('--output_dir', help='Directory to write the shards to', required = True)
+  parser.add_argument('--num_workers', type=int, help='Number of decoding processes', default = 0)
+
+  args = parser.parse_args()
+  if not (args.data_dir or args.archives):
+    parser.error('--data_dir or --archives is required')
+
+  start_time = time.time()
+  if args.archives:
+    # no extracted tree: entries are renamed, filtered and decoded as they are read from the archives
+    counts = ingest_archives(args.archives, args.output_dir, args.num_workers)
+    print('Streamed %s' % ', '.join('%d %s' % (count, section) for section, count in counts.items()))
+  else:
+    labels = open(os.path.join(args.data_dir, 'train_labels.txt')).read().splitlines()
+    labels += open(os.path.join(args.data_dir, 'test_labels.txt')).read().splitlines()
+
+    manifest = DatasetManifest(args.data_dir)
+    manifest.update(['photos', 'sketches'], labels)
+    for section in ['photos', 'sketches']:
+      files_by_label = {label: manifest.get_data_list([label], {label: 0}, section)[0] for label in labels}
+      build_shards(os.path.join(args.output_dir, section), files_by_label, args.num_workers)
+  print('Shards written to %s. Time taken: %s' % (args.output_dir, str(datetime.timedelta(seconds = int(time.time() - start_time)))))
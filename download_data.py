@@ -1,24 +1,50 @@
-
+import argparse
 import os
-import subprocess
+import shutil
 import sys
 import py7zr
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from download_gdrive import download_url, download_file_from_google_drive
+from model.ingest import ingest_archives
 
 # Set the path to your dataset directory
 path_dataset = "C:/Users/rub/Desktop/Stanford/CS230/Project/Zero-Shot-Sketch-Based-Image-Retrieval-master/Zero-Shot-Sketch-Based-Image-Retrieval-master/Dataset"
-python_exec = "C:/Users/rub/AppData/Local/miniconda3/envs/cs230-env/python.exe"
 
+# name, Google Drive id, expected SHA-256 (None: not checked, unless the mirror publishes a SHA256SUMS)
+ARCHIVES = [
+    ("Sketchy.7z", "0B7ISyeE8QtDdTjE1MG9Gcy1kSkE", None),
+    ("extended_photo.zip", "0B2U-hnwRkpRrdGZKTzkwbkEwVkk", None),
+]
+
+
+# Checksums published next to the archives by a mirror
+def fetch_checksums(base_url):
+    response = requests.get(base_url.rstrip('/') + '/SHA256SUMS', timeout = 60)
+    if response.status_code == 404:
+        return {}
+    response.raise_for_status()
+    return {name.strip(): digest for digest, name in (line.split(None, 1) for line in response.text.splitlines() if line.strip())}
 
-# Ensure the directory exists
-if not os.path.exists(path_dataset):
-    os.makedirs(path_dataset)
+# Downloads the archives concurrently (resumable, see src/download_gdrive.py), from Google Drive or from base_url/<name>
+def download_archives(path_dataset, base_url = None, max_retries = 5):
+    checksums = fetch_checksums(base_url) if base_url else {}
 
-# Function to download a file from Google Drive
-def download_file(file_id, destination):
-    python_exec = sys.executable  # Use the current Python interpreter
-    command = f"{python_exec} src/download_gdrive.py {file_id} {destination}"
-    subprocess.run(command, shell=True, check=True)
+    def download(position, archive):
+        name, file_id, sha256 = archive
+        destination = os.path.join(path_dataset, name)
+        session = requests.Session()  # one per thread
+        sha256 = sha256 or checksums.get(name)
+        if base_url:
+            return download_url(base_url.rstrip('/') + '/' + name, destination, session = session, sha256 = sha256, max_retries = max_retries, position = position)
+        return download_file_from_google_drive(file_id, destination, session = session, sha256 = sha256, max_retries = max_retries, position = position)
+
+    with ThreadPoolExecutor(len(ARCHIVES)) as executor:
+        return list(executor.map(download, range(len(ARCHIVES)), ARCHIVES))
 
 # Function to extract a .7z file using py7zr
 def extract_7z(file_path, destination):
@@ -30,55 +56,74 @@ def unzip_file(file_path, destination):
     with zipfile.ZipFile(file_path, 'r') as z:
         z.extractall(path=destination)
 
-# Download the Sketchy dataset
-print("Downloading the Sketchy dataset (it will take some time)")
-download_file("0B7ISyeE8QtDdTjE1MG9Gcy1kSkE", f"{path_dataset}/Sketchy.7z")
-
-# Extract the Sketchy dataset
-print("Unzipping it...")
-extract_7z(f"{path_dataset}/Sketchy.7z", path_dataset)
-
-# Clean up
-os.remove(f"{path_dataset}/Sketchy.7z")
-os.remove(f"{path_dataset}/README.txt")
-os.rename(f"{path_dataset}/256x256", f"{path_dataset}/Sketchy")
-
-# Download the extended photos of the Sketchy dataset
-print("Downloading the extended photos of Sketchy dataset (it will take some time)")
-download_file("0B2U-hnwRkpRrdGZKTzkwbkEwVkk", f"{path_dataset}/Sketchy/extended_photo.zip")
-
-# Extract the extended photos
-print("Unzipping it...")
-unzip_file(f"{path_dataset}/Sketchy/extended_photo.zip", f"{path_dataset}/Sketchy")
-
-# Clean up
-os.remove(f"{path_dataset}/Sketchy/extended_photo.zip")
-os.rename(f"{path_dataset}/Sketchy/EXTEND_image_sketchy", f"{path_dataset}/Sketchy/extended_photo")
-
-# Remove unwanted directories
-unwanted_dirs = [
-    "sketch/tx_000000000010", "sketch/tx_000000000110", "sketch/tx_000000001010",
-    "sketch/tx_000000001110", "sketch/tx_000100000000", "photo/tx_000100000000"
-]
-for dir in unwanted_dirs:
-    path = f"{path_dataset}/Sketchy/{dir}"
-    if os.path.exists(path):
-        os.removedirs(path)
-
-# Rename directories to fix inconsistent naming
-renames = [
-    ("sketch/tx_000000000000/hot-air_balloon", "sketch/tx_000000000000/hot_air_balloon"),
-    ("sketch/tx_000000000000/jack-o-lantern", "sketch/tx_000000000000/jack_o_lantern"),
-    ("photo/tx_000000000000/hot-air_balloon", "photo/tx_000000000000/hot_air_balloon"),
-    ("photo/tx_000000000000/jack-o-lantern", "photo/tx_000000000000/jack_o_lantern"),
-    ("extended_photo/hot-air_balloon", "extended_photo/hot_air_balloon"),
-    ("extended_photo/jack-o-lantern", "extended_photo/jack_o_lantern")
-]
-for old_name, new_name in renames:
-    old_path = f"{path_dataset}/Sketchy/{old_name}"
-    new_path = f"{path_dataset}/Sketchy/{new_name}"
-    if os.path.exists(old_path):
-        os.rename(old_path, new_path)
-
-print("Done")
-print("Sketchy dataset is now ready to be used")
\ No newline at end of file
+# Extracts the downloaded archives into path_dataset/Sketchy and fixes the directory layout
+def prepare_dataset(path_dataset):
+    # Extract the Sketchy dataset
+    print("Unzipping it...")
+    extract_7z(f"{path_dataset}/Sketchy.7z", path_dataset)
+
+    # Clean up
+    os.remove(f"{path_dataset}/Sketchy.7z")
+    os.remove(f"{path_dataset}/README.txt")
+    os.rename(f"{path_dataset}/256x256", f"{path_dataset}/Sketchy")
+
+    # Extract the extended photos
+    print("Unzipping it...")
+    unzip_file(f"{path_dataset}/extended_photo.zip", f"{path_dataset}/Sketchy")
+
+    # Clean up
+    os.remove(f"{path_dataset}/extended_photo.zip")
+    os.rename(f"{path_dataset}/Sketchy/EXTEND_image_sketchy", f"{path_dataset}/Sketchy/extended_photo")
+
+    # Remove unwanted directories
+    unwanted_dirs = [
+        "sketch/tx_000000000010", "sketch/tx_000000000110", "sketch/tx_000000001010",
+        "sketch/tx_000000001110", "sketch/tx_000100000000", "photo/tx_000100000000"
+    ]
+    for dir in unwanted_dirs:
+        path = f"{path_dataset}/Sketchy/{dir}"
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    # Rename directories to fix inconsistent naming
+    renames = [
+        ("sketch/tx_000000000000/hot-air_balloon", "sketch/tx_000000000000/hot_air_balloon"),
+        ("sketch/tx_000000000000/jack-o-lantern", "sketch/tx_000000000000/jack_o_lantern"),
+        ("photo/tx_000000000000/hot-air_balloon", "photo/tx_000000000000/hot_air_balloon"),
+        ("photo/tx_000000000000/jack-o-lantern", "photo/tx_000000000000/jack_o_lantern"),
+        ("extended_photo/hot-air_balloon", "extended_photo/hot_air_balloon"),
+        ("extended_photo/jack-o-lantern", "extended_photo/jack_o_lantern")
+    ]
+    for old_name, new_name in renames:
+        old_path = f"{path_dataset}/Sketchy/{old_name}"
+        new_path = f"{path_dataset}/Sketchy/{new_name}"
+        if os.path.exists(old_path):
+            os.rename(old_path, new_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Downloads and extracts the Sketchy dataset')
+    parser.add_argument('--path_dataset', help = 'Dataset directory', default = path_dataset)
+    parser.add_argument('--base_url', help = 'Download <base_url>/Sketchy.7z and <base_url>/extended_photo.zip (e.g. a mirror, or src/mirror_server.py) instead of Google Drive')
+    parser.add_argument('--shard_dir', help = 'Stream the archives straight into per-class shards in this directory (see build_shards.py) instead of extracting them')
+    parser.add_argument('--num_workers', type = int, help = 'Number of decoding processes with --shard_dir', default = 0)
+    parser.add_argument('--max_retries', type = int, help = 'Consecutive failed attempts before a download is abandoned', default = 5)
+    args = parser.parse_args()
+
+    # Ensure the directory exists
+    if not os.path.exists(args.path_dataset):
+        os.makedirs(args.path_dataset)
+
+    # Download the Sketchy dataset and its extended photos
+    print("Downloading the Sketchy dataset and the extended photos (it will take some time, an interrupted download resumes when run again)")
+    download_archives(args.path_dataset, args.base_url, args.max_retries)
+
+    if args.shard_dir:
+        print("Streaming the archives into shards...")
+        counts = ingest_archives([os.path.join(args.path_dataset, name) for name, _, _ in ARCHIVES], args.shard_dir, args.num_workers)
+        print("%d photos and %d sketches written to %s" % (counts.get('photos', 0), counts.get('sketches', 0), args.shard_dir))
+    else:
+        prepare_dataset(args.path_dataset)
+
+    print("Done")
+    print("Sketchy dataset is now ready to be used")
@@ -1,46 +1,84 @@
 import argparse
+import functools
 
 import time
 import datetime
-import pytz 
 import os
 from PIL import Image
 
 import numpy as np
-from scipy.spatial.distance import cdist
-from sklearn.metrics import average_precision_score
 import torch 
 import torch.nn as nn
 
-from model.net import BasicModel 
+from model.net import build_models, ARCHITECTURES
 from model.dataloader import Dataloaders
+from model.retrieval import METRICS, DTYPES
+from model.metrics import retrieval_metrics, per_class_mean
+from model.embedding_store import EmbeddingStore, file_hash
+from model.export import load_exported_model
+from model.sharded_eval import ShardedEvaluator
+from model.autotune import autotune
 from utils import *
 
 
 
-def evaluate(batch_size, dataloader_fn, images_model, sketches_model, label2index, k = 5, num_display = 2):
-  device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+def evaluate(batch_size, dataloader_fn, images_model, sketches_model, label2index, k = 5, num_display = 2, metric = 'l2', dtype = torch.float32, block_size = 256, map_k = 200, embedding_store = None, save_embeddings_dir = None, device = None, num_shards = 0, threads_per_worker = None):
+  '''
+  batch_size: 'auto' uses the throughput-optimal batch size and number of threads of this host and model (model/autotune.py,
+  probed once then read from its cache)
+  num_shards > 0: CPU evaluation in that many worker processes (model/sharded_eval.py), each encoding a shard of the
+  photos and sketches and scoring a shard of the sketches with threads_per_worker threads
+  '''
+  device = device or (torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'))
+  if num_shards > 0: device = torch.device('cpu')
+  if batch_size == 'auto':
+    setting = autotune('inference', (images_model,), device)
+    batch_size = setting['batch_size']; torch.set_num_threads(setting['num_threads'])
   images_model = images_model.to(device); sketches_model = sketches_model.to(device)
   images_model.eval(); sketches_model.eval()
 
   images_dataloader = dataloader_fn(batch_size = batch_size, section = 'photos', shuffle = False)
   sketches_dataloader = dataloader_fn(batch_size = batch_size, section = 'sketches', shuffle = False)
 
+  sharded = None
+  if num_shards > 0:
+    sharded = ShardedEvaluator(images_model, sketches_model, {'photos': images_dataloader.dataset, 'sketches': sketches_dataloader.dataset}, num_shards, threads_per_worker)
+  try:
+    return evaluate_features(batch_size, images_dataloader, sketches_dataloader, images_model, sketches_model, label2index, k, num_display, metric, dtype, block_size, map_k, embedding_store, save_embeddings_dir, device, sharded)
+  finally:
+    if sharded: sharded.close()
+
+
+def evaluate_features(batch_size, images_dataloader, sketches_dataloader, images_model, sketches_model, label2index, k, num_display, metric, dtype, block_size, map_k, embedding_store, save_embeddings_dir, device, sharded):
+
   '''IMAGES'''
   print('Processing the images. Batch size: %d; Number of batches: %d' % (batch_size, len(images_dataloader)))
 
   start_time = time.time()
 
-  image_feature_predictions = []; image_label_indices = []; test_images = []
-  with torch.no_grad():
-    for iteration, batch in enumerate(images_dataloader):
-      images, label_indices = batch 
-      images = torch.autograd.Variable(images.to(device))
-      pred_features = images_model(images)
-      test_images.append(images); image_feature_predictions.append(pred_features); image_label_indices.append(label_indices)  
-  image_feature_predictions = torch.cat(image_feature_predictions,dim=0)
-  image_label_indices = torch.cat(image_label_indices,dim=0)
-  test_images = torch.cat(test_images, dim = 0)
+  if sharded and embedding_store is None:
+    image_feature_predictions = sharded.encode('photos', range(len(images_dataloader.dataset)), batch_size)
+    image_label_indices = torch.LongTensor(images_dataloader.dataset.label_idxs)
+  elif embedding_store is None:
+    image_feature_predictions = []; image_label_indices = []
+    with torch.no_grad():
+      for iteration, batch in enumerate(images_dataloader):
+        images, label_indices = batch 
+        images = torch.autograd.Variable(images.to(device))
+        pred_features = images_model(images)
+        image_feature_predictions.append(pred_features.cpu()); image_label_indices.append(label_indices)  
+    image_feature_predictions = torch.cat(image_feature_predictions,dim=0).numpy()
+    image_label_indices = torch.cat(image_label_indices,dim=0)
+  else:
+    # only photos that are new or changed since the store was written go through the model
+    images_dataset = images_dataloader.dataset
+    def encode_images(indices):
+      if sharded: return sharded.encode('photos', indices, batch_size)
+      subset_dataloader = torch.utils.data.DataLoader(torch.utils.data.Subset(images_dataset, indices), batch_size = batch_size, shuffle = False)
+      with torch.no_grad():
+        return torch.cat([images_model(images.to(device)).cpu() for images, _ in subset_dataloader], dim = 0).numpy()
+    image_feature_predictions = embedding_store.get_embeddings(images_dataset.filenames, images_dataset.label_idxs, encode_images, images_dataset.stamp)
+    image_label_indices = torch.LongTensor(images_dataset.label_idxs)
 
   end_time = time.time()
 
@@ -52,66 +90,97 @@ def evaluate(batch_size, dataloader_fn, images_model, sketches_model, label2inde
 
   start_time = time.time()
 
-  sketch_feature_predictions = []; sketch_label_indices = []; test_sketches = []
-  with torch.no_grad():
-    for iteration, batch in enumerate(sketches_dataloader):
-      sketches, label_indices = batch 
-      sketches = torch.autograd.Variable(sketches.to(device))
-      pred_features = sketches_model(sketches)
-      test_sketches.append(sketches); sketch_feature_predictions.append(pred_features); sketch_label_indices.append(label_indices)
-
-  sketch_feature_predictions = torch.cat(sketch_feature_predictions,dim=0)
-  sketch_label_indices = torch.cat(sketch_label_indices,dim=0)
-  test_sketches = torch.cat(test_sketches, dim = 0)
+  if sharded:
+    sketch_feature_predictions = torch.from_numpy(sharded.encode('sketches', range(len(sketches_dataloader.dataset)), batch_size))
+    sketch_label_indices = torch.LongTensor(sketches_dataloader.dataset.label_idxs)
+  else:
+    sketch_feature_predictions = []; sketch_label_indices = []
+    with torch.no_grad():
+      for iteration, batch in enumerate(sketches_dataloader):
+        sketches, label_indices = batch 
+        sketches = torch.autograd.Variable(sketches.to(device))
+        pred_features = sketches_model(sketches)
+        sketch_feature_predictions.append(pred_features.cpu()); sketch_label_indices.append(label_indices)
+
+    sketch_feature_predictions = torch.cat(sketch_feature_predictions,dim=0)
+    sketch_label_indices = torch.cat(sketch_label_indices,dim=0)
 
   end_time = time.time()
 
   print('Processed the sketches. Time taken: %s' % (str(datetime.timedelta(seconds = int(end_time - start_time)))))
 
   '''mAP calculation'''
-  image_feature_predictions = image_feature_predictions.cpu().numpy() 
   sketch_feature_predictions = sketch_feature_predictions.cpu().numpy() 
   image_label_indices = image_label_indices.cpu().numpy() 
   sketch_label_indices = sketch_label_indices.cpu().numpy() 
 
-  distance = cdist(sketch_feature_predictions, image_feature_predictions, 'minkowski')
-  similarity = 1.0/distance 
-
-  is_correct_label_index = 1 * (np.expand_dims(sketch_label_indices, axis = 1) == np.expand_dims(image_label_indices, axis = 0))
+  if save_embeddings_dir:
+    save_embeddings(save_embeddings_dir, image_feature_predictions, image_label_indices, sketch_feature_predictions, sketch_label_indices)
 
-  average_precision_scores = []
-  for i in range(sketch_label_indices.shape[0]):
-    average_precision_scores.append(average_precision_score(is_correct_label_index[i], similarity[i])) 
-  average_precision_scores = np.array(average_precision_scores)
+  # distances are computed for 'block_size' sketches at a time, the sketches x images matrix is never materialised; each block
+  # is still ranked against the whole gallery (block_size x images distances, argsort and relevance), so memory grows with the gallery
+  score_fn = sharded.retrieval_metrics if sharded else functools.partial(retrieval_metrics, device = device)
+  scores = score_fn(sketch_feature_predictions, image_feature_predictions, sketch_label_indices, image_label_indices, ks = (map_k,), metric = metric, dtype = dtype, block_size = block_size)
+  average_precision_scores = scores['ap']
 
   index2label = {v: k for k, v in label2index.items()}
-  for cls in set(sketch_label_indices):
-    print('Class: %s, mAP: %f' % (index2label[cls], average_precision_scores[sketch_label_indices == cls].mean()))
+  class_average_precisions = per_class_mean(average_precision_scores, sketch_label_indices, len(index2label))
+  for cls in np.unique(sketch_label_indices):
+    print('Class: %s, mAP: %f' % (index2label[cls], class_average_precisions[cls]))
 
   mean_average_precision = average_precision_scores.mean()
+  print('mAP@%d: %f; Precision@%d: %f' % (map_k, scores['ap@%d' % map_k].mean(), map_k, scores['precision@%d' % map_k].mean()))
 
-  sketches, image_grids = get_sketch_images_grids(test_sketches, test_images, similarity, k, num_display)
+  # only embeddings are kept in memory (in dataset order), the few displayed sketches and photos are read again from disk
+  sketches, image_grids = get_sketch_images_grids(sketches_dataloader.dataset, images_dataloader.dataset, sketch_feature_predictions, image_feature_predictions, k, num_display, metric = metric)
 
   return sketches, image_grids, mean_average_precision
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Evaluation of SBIR')
   parser.add_argument('--model', help='Model checkpoint path')
+  parser.add_argument('--architecture', help='Architecture of the checkpoint (train.py architecture)', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--exported_dir', help='Directory of TorchScript models written by export.py, used instead of --model (on the CPU)')
   parser.add_argument('--data', help='Data directory path. Directory should contain two folders - sketches and photos, along with 2 .txt files for the labels', required = True)
   parser.add_argument('--num_images', type=int, help='Number of random images to output for every sketch', default = 0)
   parser.add_argument('--num_sketches', type=int, help='Number of random sketches to output', default = 0)
-  parser.add_argument('--batch_size', type=int, help='Batch size to process the test sketches/photos', default = 1)
+  parser.add_argument('--batch_size', type=lambda value: value if value == 'auto' else int(value), help='Batch size to process the test sketches/photos, or auto: tuned for this host and model (model/autotune.py, cached)', default = 32)
   parser.add_argument('--output_dir', help='Directory to save output sketch and images', default = 'outputs')
+  parser.add_argument('--num_workers', type=int, help='Number of data loading processes', default = 0)
+  parser.add_argument('--num_shards', type=int, help='Encode and score on the CPU in this many worker processes, each with its own model copy (0: in this process)', default = 0)
+  parser.add_argument('--threads_per_worker', type=int, help='Intra-op threads of each --num_shards worker (default: the available threads divided among the workers)')
+  parser.add_argument('--shard_dir', help='Directory of pre-decoded image shards written by build_shards.py. Images are decoded from --data if omitted')
+  parser.add_argument('--metric', help='Distance used for retrieval', choices = METRICS, default = 'l2')
+  parser.add_argument('--precision', help='Precision of the embeddings during retrieval', choices = list(DTYPES), default = 'float32')
+  parser.add_argument('--block_size', type=int, help='Number of sketches scored against the gallery at a time', default = 256)
+  parser.add_argument('--embedding_store', help='Directory of the on-disk photo embedding store. Not used if omitted')
+  parser.add_argument('--store_action', help='reuse: encode only new/changed photos; build: re-encode every photo; invalidate: delete the store of every checkpoint, then build', choices = ['reuse', 'build', 'invalidate'], default = 'reuse')
+  parser.add_argument('--save_embeddings', help='Directory to save the photo/sketch embeddings and labels as .npy files (e.g. for benchmarks/ann_benchmark.py)')
 
   args = parser.parse_args()
 
   device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-  dataloaders = Dataloaders(args.data)
-  image_model = BasicModel().to(device)
-  sketch_model = BasicModel().to(device) 
-  if args.model: load_checkpoint(args.model, image_model, sketch_model)  
-  sketches, image_grids, test_mAP = evaluate(args.batch_size, dataloaders.get_test_dataloader, image_model, sketch_model, dataloaders.test_dict, k = args.num_images, num_display = args.num_sketches)
+  dataloaders = Dataloaders(args.data, shard_dir = args.shard_dir, num_workers = args.num_workers, pin_memory = torch.cuda.is_available())
+  if args.exported_dir:
+    device = torch.device('cpu')
+    image_model = load_exported_model(os.path.join(args.exported_dir, 'image_model.pt'))
+    sketch_model = load_exported_model(os.path.join(args.exported_dir, 'sketch_model.pt'))
+    store_key = file_hash(os.path.join(args.exported_dir, 'image_model.pt'))
+  else:
+    # the ImageNet weights are only needed when no checkpoint overwrites them
+    image_model, sketch_model = build_models(args.architecture, pretrained = not args.model)
+    image_model = image_model.to(device)
+    sketch_model = sketch_model.to(device) 
+    if args.model: load_checkpoint(args.model, image_model, sketch_model, map_location = device)  
+    store_key = None
+
+  embedding_store = None
+  if args.embedding_store:
+    embedding_store = EmbeddingStore(args.embedding_store, image_model, rebuild = args.store_action != 'reuse', key = store_key)
+    if args.store_action == 'invalidate': embedding_store.invalidate()
+
+  sketches, image_grids, test_mAP = evaluate(args.batch_size, dataloaders.get_test_dataloader, image_model, sketch_model, dataloaders.test_dict, k = args.num_images, num_display = args.num_sketches, metric = args.metric, dtype = DTYPES[args.precision], block_size = args.block_size, embedding_store = embedding_store, save_embeddings_dir = args.save_embeddings, device = device, num_shards = args.num_shards, threads_per_worker = args.threads_per_worker)
   print('Average test mAP: ', test_mAP)
 
   if not os.path.isdir(args.output_dir):
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+
+import torch
+
+from model.net import build_models, ARCHITECTURES
+from model.dataloader import Dataloaders
+from model.export import trace_model, quantize_static, export_onnx, load_exported_model, measure_latency, IMAGE_SIZE
+from evaluate import evaluate
+from utils import load_checkpoint
+
+
+def calibration_batches(dataloaders, section, batch_size, num_batches):
+  '''A random sample of training-class images, so the test classes are never seen during calibration'''
+  dataloader = dataloaders.get_full_train_dataloader(batch_size = batch_size, section = section, shuffle = True)
+  for iteration, (images, _) in enumerate(dataloader):
+    if iteration >= num_batches:
+      break
+    yield images
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Exports the sketch/image models to standalone TorchScript (optionally int8) artifacts for CPU inference')
+  parser.add_argument('--model', help='Model checkpoint path', required = True)
+  parser.add_argument('--architecture', help='Architecture of the checkpoint (train.py architecture)', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--data', help='Data directory path, used for calibration and for the mAP comparison', required = True)
+  parser.add_argument('--output_dir', help='Directory to write the artifacts and report.json', default = 'exported')
+  parser.add_argument('--quantization', help='static: int8 post-training quantization calibrated on training images', choices = ['none', 'static'], default = 'static')
+  parser.add_argument('--calibration_batches', type=int, help='Number of batches used to calibrate the activation ranges', default = 10)
+  parser.add_argument('--batch_size', type=int, help='Batch size for calibration and evaluation', default = 16)
+  parser.add_argument('--batch_sizes', type=int, nargs = '+', help='Batch sizes of the throughput measurement', default = [1, 8, 32])
+  parser.add_argument('--onnx', action = 'store_true', help='Also write fp32 ONNX graphs')
+  parser.add_argument('--skip_evaluation', action = 'store_true', help='Do not compute the mAP of the fp32 and exported models')
+
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.output_dir): os.makedirs(args.output_dir)
+  dataloaders = Dataloaders(args.data)
+  image_model, sketch_model = build_models(args.architecture, pretrained = False)
+  load_checkpoint(args.model, image_model, sketch_model)
+  image_model.eval(); sketch_model.eval()
+  example_input = torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE)
+
+  report = {'quantization': args.quantization, 'latency': {}}
+  exported = {}
+  for name, model, section in [('image_model', image_model, 'photos'), ('sketch_model', sketch_model, 'sketches')]:
+    if args.onnx:
+      export_onnx(model, os.path.join(args.output_dir, name + '.onnx'), example_input)
+
+    export_input = model
+    if args.quantization == 'static':
+      print('Calibrating %s on %d batches of training %s' % (name, args.calibration_batches, section))
+      export_input = quantize_static(model, calibration_batches(dataloaders, section, args.batch_size, args.calibration_batches))
+    path = os.path.join(args.output_dir, name + '.pt')
+    torch.jit.save(trace_model(export_input, example_input), path)
+    exported[name] = load_exported_model(path)
+    print('Saved %s' % path)
+
+    '''LATENCY AND THROUGHPUT'''
+    report['latency'][name] = {}
+    for variant, variant_model in [('fp32', model), ('exported', exported[name])]:
+      for batch_size, (latency, throughput) in measure_latency(variant_model, args.batch_sizes).items():
+        report['latency'][name]['%s_batch_%d' % (variant, batch_size)] = {'ms_per_image': latency, 'images_per_second': throughput}
+        print('%s %-8s batch %3d: %7.2f ms/image; %7.1f images/s' % (name, variant, batch_size, latency, throughput))
+
+  '''mAP DIFFERENCE'''
+  if not args.skip_evaluation:
+    cpu = torch.device('cpu')
+    _, _, fp32_mAP = evaluate(args.batch_size, dataloaders.get_test_dataloader, image_model, sketch_model, dataloaders.test_dict, k = 0, num_display = 0, device = cpu)
+    _, _, exported_mAP = evaluate(args.batch_size, dataloaders.get_test_dataloader, exported['image_model'], exported['sketch_model'], dataloaders.test_dict, k = 0, num_display = 0, device = cpu)
+    report.update({'fp32_mAP': fp32_mAP, 'exported_mAP': exported_mAP, 'mAP_difference': exported_mAP - fp32_mAP})
+    print('mAP fp32: %f; exported: %f; difference: %f' % (fp32_mAP, exported_mAP, exported_mAP - fp32_mAP))
+
+  with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+    json.dump(report, f, indent = 2)
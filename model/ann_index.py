@@ -0,0 +1,181 @@
+import numpy as np
+import torch
+
+from model.retrieval import METRICS, get_block
+
+
+def squared_distances(x, y):
+  '''Squared euclidean distances between the rows of two float32 tensors'''
+  return (x.pow(2).sum(dim = 1, keepdim = True) - 2.0 * torch.mm(x, y.t()) + y.pow(2).sum(dim = 1).unsqueeze(0)).clamp_(min = 0.0)
+
+
+def assign(features, centroids, block_size = 8192):
+  '''Index of the nearest centroid of every row of 'features' (float32 tensor)'''
+  assignments = torch.empty(features.shape[0], dtype = torch.long, device = features.device)
+  for start in range(0, features.shape[0], block_size):
+    assignments[start:start + block_size] = squared_distances(features[start:start + block_size], centroids).argmin(dim = 1)
+  return assignments
+
+
+def kmeans(features, num_clusters, num_iterations = 20, seed = 0):
+  '''Lloyd's k-means on a float32 tensor. Empty clusters are re-seeded with random points. Returns the centroids'''
+  generator = torch.Generator().manual_seed(seed)
+  num_points = features.shape[0]
+  if num_points < num_clusters:
+    raise ValueError('k-means needs at least %d points, got %d' % (num_clusters, num_points))
+
+  centroids = features[torch.randperm(num_points, generator = generator)[:num_clusters].to(features.device)].clone()
+  for _ in range(num_iterations):
+    assignments = assign(features, centroids)
+    counts = torch.bincount(assignments, minlength = num_clusters).to(features.dtype)
+    sums = torch.zeros_like(centroids).index_add_(0, assignments, features)
+    empty = counts == 0
+    centroids = sums / counts.clamp(min = 1).unsqueeze(1)
+    if empty.any():
+      centroids[empty] = features[torch.randint(num_points, (int(empty.sum()),), generator = generator).to(features.device)]
+  return centroids
+
+
+class IVFIndex():
+  '''
+  Inverted-file approximate nearest-neighbour index over photo embeddings.
+  The gallery is partitioned with k-means into 'num_lists' lists; a query only scans the 'nprobe' lists with the closest centroids.
+  With num_subquantizers > 0 the residuals to the list centroid are stored as product-quantized uint8 codes
+  (num_subquantizers sub-vectors with 256 centroids each) and scanned with per-query lookup tables.
+  Distances follow model/retrieval.py: euclidean for 'l2', 1 - cosine similarity for 'cosine'.
+  '''
+  def __init__(self, num_lists = 256, nprobe = 8, num_subquantizers = 0, metric = 'l2', device = None):
+    if metric not in METRICS:
+      raise ValueError('Unknown metric %s, expected one of %s' % (metric, str(METRICS)))
+    self.num_lists = num_lists
+    self.nprobe = nprobe
+    self.num_subquantizers = num_subquantizers
+    self.metric = metric
+    self.device = device or torch.device('cpu')
+
+    self.centroids = None; self.codebooks = None
+    self.list_offsets = None; self.ids = None; self.vectors = None; self.codes = None
+
+  def _prepare(self, features):
+    return get_block(features, 0, len(features), self.metric, torch.float32, self.device)
+
+  def train(self, features, num_iterations = 20, max_training_points = 100000, seed = 0):
+    '''Learns the coarse centroids and, with product quantization, the sub-quantizer codebooks'''
+    features = self._prepare(features)
+    generator = torch.Generator().manual_seed(seed)
+    if features.shape[0] > max_training_points:
+      features = features[torch.randperm(features.shape[0], generator = generator)[:max_training_points].to(self.device)]
+
+    self.centroids = kmeans(features, self.num_lists, num_iterations, seed)
+    if self.num_subquantizers:
+      dim = features.shape[1]
+      if dim % self.num_subquantizers != 0:
+        raise ValueError('Embedding size %d is not divisible by %d sub-quantizers' % (dim, self.num_subquantizers))
+      residuals = features - self.centroids[assign(features, self.centroids)]
+      sub_dim = dim // self.num_subquantizers
+      self.codebooks = torch.stack([kmeans(residuals[:, m * sub_dim:(m + 1) * sub_dim].contiguous(), 256, num_iterations, seed + m)
+                                    for m in range(self.num_subquantizers)])
+    return self
+
+  def _encode(self, residuals):
+    sub_dim = residuals.shape[1] // self.num_subquantizers
+    codes = [assign(residuals[:, m * sub_dim:(m + 1) * sub_dim].contiguous(), self.codebooks[m]) for m in range(self.num_subquantizers)]
+    return torch.stack(codes, dim = 1).to(torch.uint8)
+
+  def add(self, features):
+    '''Indexes 'features' (replacing anything added before); row i gets id i'''
+    if self.centroids is None:
+      raise RuntimeError('The index has to be trained before adding embeddings')
+    features = self._prepare(features)
+    assignments = assign(features, self.centroids)
+
+    '''SORT BY LIST SO EVERY LIST IS A CONTIGUOUS SLICE'''
+    order = torch.from_numpy(np.argsort(assignments.cpu().numpy(), kind = 'stable')).to(self.device)
+    counts = torch.bincount(assignments, minlength = self.num_lists)
+    self.list_offsets = torch.cat([torch.zeros(1, dtype = torch.long, device = self.device), torch.cumsum(counts, dim = 0)]).cpu()
+    self.ids = order
+    if self.num_subquantizers:
+      self.codes = self._encode(features[order] - self.centroids[assignments[order]])
+      self.vectors = None
+    else:
+      self.vectors = features[order]
+    return self
+
+  def __len__(self):
+    return 0 if self.ids is None else self.ids.shape[0]
+
+  def _list_distances(self, queries, list_idx):
+    '''Squared distances (len(queries) x list size) between the queries and the members of one list'''
+    start, end = int(self.list_offsets[list_idx]), int(self.list_offsets[list_idx + 1])
+    if not self.num_subquantizers:
+      return squared_distances(queries, self.vectors[start:end])
+
+    '''ASYMMETRIC DISTANCES THROUGH PER-QUERY LOOKUP TABLES'''
+    residuals = queries - self.centroids[list_idx].unsqueeze(0)
+    sub_dim = residuals.shape[1] // self.num_subquantizers
+    residuals = residuals.view(residuals.shape[0], self.num_subquantizers, sub_dim)
+    tables = (residuals.pow(2).sum(dim = 2, keepdim = True) - 2.0 * torch.einsum('qmd,mjd->qmj', residuals, self.codebooks)
+              + self.codebooks.pow(2).sum(dim = 2).unsqueeze(0)) # queries x sub-quantizers x 256
+    codes = self.codes[start:end].long()
+    distances = torch.zeros((queries.shape[0], end - start), device = self.device)
+    for m in range(self.num_subquantizers):
+      distances += tables[:, m, :].index_select(1, codes[:, m])
+    return distances
+
+  def search(self, queries, k, nprobe = None, query_block_size = 1024):
+    '''Returns (distances, indices) numpy arrays of shape (len(queries), k), nearest first; missing neighbours have index -1'''
+    nprobe = min(nprobe or self.nprobe, self.num_lists)
+    num_queries = len(queries)
+    all_distances = np.full((num_queries, k), np.inf, dtype = np.float32)
+    all_indices = np.full((num_queries, k), -1, dtype = np.int64)
+
+    for q_start in range(0, num_queries, query_block_size):
+      q_end = min(q_start + query_block_size, num_queries)
+      query_block = get_block(queries, q_start, q_end, self.metric, torch.float32, self.device)
+      probes = torch.topk(squared_distances(query_block, self.centroids), nprobe, dim = 1, largest = False).indices
+
+      best_distances = torch.full((q_end - q_start, k), float('inf'), device = self.device)
+      best_indices = torch.full((q_end - q_start, k), -1, dtype = torch.long, device = self.device)
+      # every list is scanned once, for all the queries of the block that probe it
+      for list_idx in torch.unique(probes).tolist():
+        start, end = int(self.list_offsets[list_idx]), int(self.list_offsets[list_idx + 1])
+        if start == end:
+          continue
+        query_idxs = (probes == list_idx).any(dim = 1).nonzero().squeeze(1)
+        distances = torch.cat([best_distances[query_idxs], self._list_distances(query_block[query_idxs], list_idx)], dim = 1)
+        candidates = torch.cat([best_indices[query_idxs], self.ids[start:end].unsqueeze(0).expand(query_idxs.shape[0], -1)], dim = 1)
+        distances, order = torch.topk(distances, k, dim = 1, largest = False)
+        best_distances[query_idxs] = distances
+        best_indices[query_idxs] = torch.gather(candidates, 1, order)
+
+      all_distances[q_start:q_end] = self._to_metric(best_distances).cpu().numpy()
+      all_indices[q_start:q_end] = best_indices.cpu().numpy()
+    return all_distances, all_indices
+
+  def _to_metric(self, squared):
+    if self.metric == 'cosine':
+      return squared / 2.0 # unit vectors: ||a - b||^2 = 2 - 2 cos
+    return squared.sqrt()
+
+  def save(self, path):
+    arrays = {'config': np.array([self.num_lists, self.nprobe, self.num_subquantizers]), 'metric': np.array(self.metric),
+              'centroids': self.centroids.cpu().numpy(), 'list_offsets': self.list_offsets.numpy(), 'ids': self.ids.cpu().numpy()}
+    if self.num_subquantizers:
+      arrays.update({'codebooks': self.codebooks.cpu().numpy(), 'codes': self.codes.cpu().numpy()})
+    else:
+      arrays['vectors'] = self.vectors.cpu().numpy()
+    np.savez(path, **arrays)
+
+  @classmethod
+  def load(cls, path, device = None):
+    arrays = np.load(path)
+    num_lists, nprobe, num_subquantizers = [int(x) for x in arrays['config']]
+    index = cls(num_lists, nprobe, num_subquantizers, str(arrays['metric']), device)
+    to_tensor = lambda name: torch.from_numpy(arrays[name]).to(index.device)
+    index.centroids, index.ids = to_tensor('centroids'), to_tensor('ids')
+    index.list_offsets = torch.from_numpy(arrays['list_offsets'])
+    if num_subquantizers:
+      index.codebooks, index.codes = to_tensor('codebooks'), to_tensor('codes')
+    else:
+      index.vectors = to_tensor('vectors')
+    return index
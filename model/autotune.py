@@ -0,0 +1,262 @@
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import socket
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from model.layers import grad_reverse
+from model.net import DomainAdversarialNet, unique_parameters
+from model.sharded_eval import serialize_model, deserialize_model
+from utils import peak_memory_mb
+
+AUTOTUNE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'sketch_to_image', 'autotune.json')
+MODES = ('inference', 'train', 'train_suffix')
+IMAGE_SIZE = 224
+
+
+def total_memory_mb(device):
+  if device.type == 'cuda':
+    return torch.cuda.get_device_properties(device).total_memory / 2**20
+  if hasattr(os, 'sysconf'):
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**20
+  if sys.platform == 'win32':
+    return windows_memory_status().ullTotalPhys / 2**20
+  raise RuntimeError('autotune: the RAM of this host is unknown, pass memory_limit_mb')
+
+
+def windows_memory_status():
+  '''GlobalMemoryStatusEx (Windows has no os.sysconf)'''
+  import ctypes
+  class MEMORYSTATUSEX(ctypes.Structure):
+    _fields_ = [('dwLength', ctypes.c_ulong), ('dwMemoryLoad', ctypes.c_ulong)] + [(name, ctypes.c_ulonglong) for name in
+                ['ullTotalPhys', 'ullAvailPhys', 'ullTotalPageFile', 'ullAvailPageFile', 'ullTotalVirtual', 'ullAvailVirtual', 'ullAvailExtendedVirtual']]
+  status = MEMORYSTATUSEX(); status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+  if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+    raise ctypes.WinError()
+  return status
+
+
+def model_signature(model):
+  '''Name of a model for the cache: class, number of weights and the options that change its cost'''
+  if isinstance(model, torch.jit.ScriptModule):
+    return 'script:%s:%d' % (model.original_name, sum(value.numel() for value in model.state_dict().values() if torch.is_tensor(value)))
+  return '%s:%d:segments%d:frozen%d' % (type(model).__name__, sum(param.numel() for param in model.parameters()),
+                                        getattr(model, 'checkpoint_segments', 0), getattr(model, 'num_frozen', 0))
+
+
+def host_signature(device):
+  '''The probes are only valid on the same host, device and torch version'''
+  name = torch.cuda.get_device_name(device) if device.type == 'cuda' else platform.processor() or platform.machine()
+  return '%s:%s:%s:%dcpus:torch%s' % (socket.gethostname(), device.type, name, os.cpu_count() or 1, torch.__version__)
+
+
+'''PROBE WORKER'''
+
+def probe_worker(mode, models_spec, device, requests, results):
+  '''
+  Runs in its own process: builds the models once, then times (batch_size, num_threads) requests until it gets None.
+  Batch sizes come in increasing order, so on the CPU the peak RSS after a probe is that probe's peak.
+  '''
+  device = torch.device(device)
+  if models_spec[0] == 'factory':
+    models = models_spec[1]()
+    for model in models:
+      for module in model.modules():
+        if hasattr(module, 'reset_parameters'): module.reset_parameters() # the factory may leave them uninitialised
+  else:
+    models = [deserialize_model(spec) for spec in models_spec[1]]
+  models = [model.to(device) for model in models]
+
+  input_shape = (3, IMAGE_SIZE, IMAGE_SIZE)
+  if mode in ('train', 'train_suffix'):
+    image_model, sketch_model = models
+    domain_net = DomainAdversarialNet().to(device)
+    optimizer = torch.optim.Adam(unique_parameters(image_model, sketch_model, domain_net), 0.001)
+    for model in (image_model, sketch_model, domain_net): model.train()
+    encode_photos, encode_sketches = image_model, sketch_model
+    if mode == 'train_suffix':
+      # the inputs are the outputs of the frozen layers, as read from the feature cache
+      with torch.no_grad():
+        input_shape = tuple(image_model.frozen_prefix()(torch.rand(1, 3, IMAGE_SIZE, IMAGE_SIZE, device = device)).shape[1:])
+      encode_photos, encode_sketches = image_model.forward_suffix, sketch_model.forward_suffix
+    step = lambda batch: train_step(encode_photos, encode_sketches, domain_net, optimizer, batch)
+  else:
+    model = models[0].eval()
+    def step(batch):
+      with torch.no_grad():
+        model(batch[0])
+
+  while True:
+    request = requests.get()
+    if request is None:
+      return
+    batch_size, num_threads, min_time = request
+    torch.set_num_threads(num_threads)
+    batch = None
+    try:
+      if device.type == 'cuda': torch.cuda.reset_peak_memory_stats(device)
+      batch = [torch.rand((batch_size,) + input_shape, device = device) for _ in range(1 if mode == 'inference' else 3)]
+      step(batch) # warm-up (allocator, cudnn algorithms, optimizer state)
+      if device.type == 'cuda': torch.cuda.synchronize(device)
+      num_steps = 0; start_time = time.time()
+      while num_steps < 2 or time.time() - start_time < min_time:
+        step(batch); num_steps += 1
+        if device.type == 'cuda': torch.cuda.synchronize(device)
+      results.put({'batch_size': batch_size, 'num_threads': num_threads, 'items_per_second': batch_size * num_steps / (time.time() - start_time),
+                   'peak_memory_mb': peak_memory_mb(device)})
+    except Exception as e: # typically CUDA out of memory; the search stops at the first failed batch size
+      del batch
+      if device.type == 'cuda': torch.cuda.empty_cache()
+      results.put({'batch_size': batch_size, 'num_threads': num_threads, 'error': '%s: %s' % (type(e).__name__, str(e).split('\n')[0])})
+
+
+def train_step(image_model, sketch_model, domain_net, optimizer, batch):
+  '''One train.py step with triplet sampling: 3 forward passes, triplet and domain losses, backward, Adam step'''
+  anchors, positives, negatives = batch
+  criterion = nn.TripletMarginLoss(margin = 1.0, p = 2); domain_criterion = nn.BCELoss()
+  optimizer.zero_grad()
+  sketch_features, positive_features, negative_features = sketch_model(anchors), image_model(positives), image_model(negatives)
+  image_targets = torch.ones(anchors.shape[0], 1, device = anchors.device)
+  domain_loss = 0.5 * (domain_criterion(domain_net(grad_reverse(positive_features, 1.0)), image_targets)
+                       + domain_criterion(domain_net(grad_reverse(negative_features, 1.0)), image_targets))
+  domain_loss = domain_loss + 0.5 * domain_criterion(domain_net(grad_reverse(sketch_features, 1.0)), torch.zeros_like(image_targets))
+  (criterion(sketch_features, positive_features, negative_features) + domain_loss).backward()
+  optimizer.step()
+
+
+class ProbeRunner():
+  '''Sends probes to a probe_worker process, and starts a new one when a probe kills it (e.g. the kernel's OOM killer)'''
+  def __init__(self, mode, models_spec, device, min_time):
+    self.args = (mode, models_spec, str(device))
+    self.min_time = min_time
+    self.context = multiprocessing.get_context('spawn')
+    self.process = None
+
+  def probe(self, batch_size, num_threads):
+    if self.process is None:
+      self.requests, self.results = self.context.Queue(), self.context.Queue()
+      self.process = self.context.Process(target = probe_worker, args = self.args + (self.requests, self.results), daemon = True)
+      self.process.start()
+    self.requests.put((batch_size, num_threads, self.min_time))
+    while True:
+      try:
+        return self.results.get(timeout = 1)
+      except queue.Empty:
+        if not self.process.is_alive():
+          self.process = None
+          return {'batch_size': batch_size, 'num_threads': num_threads, 'error': 'worker died'}
+
+  def close(self):
+    if self.process is not None:
+      self.requests.put(None); self.process.join()
+      self.process = None
+
+
+'''SEARCH'''
+
+def search(runner, device, memory_limit_mb, min_batch_size, max_batch_size, thread_counts, tolerance):
+  '''
+  Doubles the batch size from min_batch_size (with the most threads) while the throughput improves by more than 'tolerance' and the peak memory,
+  extrapolated linearly from the last two probes, stays under the limit. Then tries the thread counts at the best batch size.
+  Returns the probes and the chosen one: the smallest batch size, then the fewest threads, within 'tolerance' of the best throughput.
+  '''
+  probes = []
+  def feasible(probe):
+    return 'error' not in probe and probe['peak_memory_mb'] <= memory_limit_mb
+
+  batch_size = min_batch_size; best = None; previous = None
+  while batch_size <= max_batch_size:
+    probe = runner.probe(batch_size, thread_counts[-1]); probes.append(probe)
+    print('autotune: batch size %4d, %2d threads: %s' % (batch_size, thread_counts[-1], probe.get('error') or
+          '%.1f items/s, peak memory %.0f MB' % (probe['items_per_second'], probe['peak_memory_mb'])))
+    if not feasible(probe):
+      break
+    if best is not None and probe['items_per_second'] < best['items_per_second'] * (1 + tolerance):
+      break
+    if best is None or probe['items_per_second'] > best['items_per_second']: best = probe
+    if previous is not None and probe['peak_memory_mb'] + 2 * (probe['peak_memory_mb'] - previous['peak_memory_mb']) > memory_limit_mb:
+      break # the next doubling would not fit: memory is about linear in the batch size, m(2b) ~ m(b) + 2 (m(b) - m(b/2))
+    previous = probe; batch_size *= 2
+  if best is None:
+    raise RuntimeError('autotune: a batch of %d failed: %s' % (min_batch_size, probes[0].get('error') or 'peak memory %.0f MB over the %.0f MB limit' % (probes[0]['peak_memory_mb'], memory_limit_mb)))
+
+  for num_threads in thread_counts[:-1]:
+    probe = runner.probe(best['batch_size'], num_threads); probes.append(probe)
+    # the CPU peak RSS only grows, it may come from a larger batch probed before; the thread count does not change the memory
+    if device.type == 'cpu' and 'error' not in probe: probe['peak_memory_mb'] = best['peak_memory_mb']
+    print('autotune: batch size %4d, %2d threads: %s' % (best['batch_size'], num_threads, probe.get('error') or '%.1f items/s' % probe['items_per_second']))
+
+  candidates = [probe for probe in probes if feasible(probe)]
+  fastest = max(probe['items_per_second'] for probe in candidates)
+  chosen = min([probe for probe in candidates if probe['items_per_second'] >= (1 - tolerance) * fastest], key = lambda probe: (probe['batch_size'], probe['num_threads']))
+  return chosen, probes
+
+
+def default_thread_counts(device):
+  '''Powers of two up to the number of CPUs (and that number); threads hardly matter when a GPU does the work'''
+  num_cpus = os.cpu_count() or 1
+  if device.type == 'cuda':
+    return [torch.get_num_threads()]
+  counts = [count for count in [1, 2, 4, 8, 16, 32, 64, 128] if count < num_cpus]
+  return counts + [num_cpus]
+
+
+def autotune(mode, models, device = None, name = None, memory_limit_mb = None, max_batch_size = None, thread_counts = None,
+             cache_file = AUTOTUNE_CACHE, retune = False, min_time = 0.5, tolerance = 0.05):
+  '''
+  Throughput-optimal batch size and number of intra-op threads for this host and model, from short timed probes that stay under
+  'memory_limit_mb' (default: 80% of the RAM, or 90% of the GPU's memory). Returns a dict with 'batch_size', 'num_threads',
+  'items_per_second' (images, or triplets in training), 'peak_memory_mb' and all the probes; the caller applies the threads.
+  mode: 'inference' (forward pass under no_grad), 'train' (a train.py triplet step: 3 forward passes, backward, Adam step) or
+  'train_suffix' (the same step through forward_suffix on features of the frozen layers, as train.py with a feature cache).
+  models: (model,) for inference, (image_model, sketch_model) for training, or a picklable function returning them; they are
+  copied to a separate process, which is where the probes run (the caller's models and memory are untouched).
+  name: cache key of the model (default: model_signature of the first model). The result is stored in 'cache_file' under the
+  host, model, mode and memory limit, and reused unless 'retune'.
+  '''
+  if mode not in MODES:
+    raise ValueError('mode must be one of %s' % str(MODES))
+  device = device or (torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'))
+  memory_limit_mb = memory_limit_mb or total_memory_mb(device) * (0.9 if device.type == 'cuda' else 0.8)
+  max_batch_size = max_batch_size or (256 if mode == 'inference' else 64)
+  thread_counts = sorted(thread_counts or default_thread_counts(device))
+  if name is None:
+    if callable(models): raise ValueError('name is required when models is a function')
+    name = model_signature(models[0])
+  key = '|'.join([host_signature(device), mode, name, '%dMB' % memory_limit_mb, 'max%d' % max_batch_size, 'threads%s' % ','.join(map(str, thread_counts))])
+
+  cache = {}
+  if os.path.exists(cache_file):
+    with open(cache_file) as f:
+      cache = json.load(f)
+  if key in cache and not retune:
+    return cache[key]
+
+  models_spec = ('factory', models) if callable(models) else ('modules', [serialize_model(model) for model in models])
+  runner = ProbeRunner(mode, models_spec, device, min_time)
+  start_time = time.time()
+  try:
+    # training needs 2 samples per batch (batch norm of the domain network)
+    chosen, probes = search(runner, device, memory_limit_mb, 1 if mode == 'inference' else 2, max_batch_size, thread_counts, tolerance)
+  finally:
+    runner.close()
+  setting = dict(chosen, memory_limit_mb = memory_limit_mb, probes = probes, tuning_time = time.time() - start_time)
+  print('autotune: batch size %d with %d threads, %.1f items/s (%d probes in %.0fs)'
+        % (setting['batch_size'], setting['num_threads'], setting['items_per_second'], len(probes), setting['tuning_time']))
+
+  # re-read and write atomically: other processes may have tuned other models meanwhile
+  if os.path.exists(cache_file):
+    with open(cache_file) as f:
+      cache = json.load(f)
+  cache[key] = setting
+  if not os.path.isdir(os.path.dirname(cache_file)): os.makedirs(os.path.dirname(cache_file))
+  with open(cache_file + '.tmp', 'w') as f:
+    json.dump(cache, f, indent = 1)
+  os.replace(cache_file + '.tmp', cache_file)
+  return setting
@@ -0,0 +1,170 @@
+import inspect
+import json
+import os
+import queue
+import random
+import shutil
+import threading
+import zipfile
+
+import numpy as np
+import torch
+
+
+def tensor_storage(tensor):
+  return tensor.untyped_storage() if hasattr(tensor, 'untyped_storage') else tensor.storage() # untyped_storage since torch 2.0
+
+
+def snapshot(state, copies = None):
+  '''
+  Copy of a (nested) checkpoint dict with every tensor copied to the CPU, so training can go on while it is written.
+  Tensors that share a storage (the trunk of shared_trunk in both encoders) stay views of one copied storage, which
+  torch.save writes once. 'copies' maps the storages already copied (device, data_ptr) to their copy
+  '''
+  copies = {} if copies is None else copies
+  if torch.is_tensor(state):
+    state = state.detach()
+    if state.layout != torch.strided or state.is_quantized or state.numel() == 0:
+      return state.to('cpu', copy = True)
+    storage = tensor_storage(state)
+    key = (str(state.device), storage.data_ptr())
+    if key not in copies:
+      copies[key] = storage.cpu() if storage.is_cuda else storage.clone()
+    return torch.empty(0, dtype = state.dtype).set_(copies[key], state.storage_offset(), state.size(), state.stride())
+  if isinstance(state, dict):
+    return type(state)((key, snapshot(value, copies)) for key, value in state.items())
+  if isinstance(state, (list, tuple)):
+    return type(state)(snapshot(value, copies) for value in state)
+  return state
+
+
+def get_rng_state():
+  '''python, numpy and torch (CPU and CUDA) generator states, as tensors and python values only'''
+  numpy_state = np.random.get_state()
+  state = {'python': random.getstate(),
+           'numpy': (numpy_state[0], torch.from_numpy(numpy_state[1].astype(np.int64)), numpy_state[2], numpy_state[3], numpy_state[4]),
+           'torch': torch.get_rng_state()}
+  if torch.cuda.is_available(): state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+
+def set_rng_state(state):
+  random.setstate(state['python'])
+  name, keys, position, has_gauss, cached_gaussian = state['numpy']
+  np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+  torch.set_rng_state(state['torch'])
+  if 'cuda' in state and torch.cuda.is_available(): torch.cuda.set_rng_state_all(state['cuda'])
+
+
+# torch >= 2.1 can memory-map checkpoints saved in the zip format (the default since torch 1.6)
+MMAP_LOAD = 'mmap' in inspect.signature(torch.load).parameters
+
+def lazy_load(path, map_location = 'cpu'):
+  '''
+  torch.load of a checkpoint, memory-mapped where torch supports it: tensors are read from the file when they are first
+  used, so the parts a caller ignores (optimizer state, domain model...) are never read. map_location as in torch.load.
+  '''
+  if MMAP_LOAD and zipfile.is_zipfile(path):
+    return torch.load(path, map_location = map_location, mmap = True)
+  return torch.load(path, map_location = map_location)
+
+
+def atomic_save(state, path):
+  '''torch.save to a temporary file in the same directory, then rename over 'path': a crash never leaves a partial file'''
+  temporary_path = path + '.tmp'
+  with open(temporary_path, 'wb') as f:
+    torch.save(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(temporary_path, path)
+
+
+def atomic_link(source, path):
+  '''Makes 'path' the same file as 'source' (hard link, or a copy where links are not supported), atomically'''
+  temporary_path = path + '.tmp'
+  if os.path.exists(temporary_path): os.remove(temporary_path)
+  try:
+    os.link(source, temporary_path)
+  except OSError:
+    shutil.copyfile(source, temporary_path)
+  os.replace(temporary_path, path)
+
+
+class CheckpointManager():
+  '''
+  Writes checkpoint_<iteration>.pth.tar files in a background thread from a CPU snapshot of the state, keeps the
+  last 'keep_last' of them, and points last.pth.tar (most recent) and best.pth.tar (highest score) at them.
+  checkpoints.json lists the kept files with their scores. Errors of the writer are raised by the next save/wait.
+  '''
+  def __init__(self, checkpoint_dir, keep_last = 3, background = True):
+    self.checkpoint_dir = checkpoint_dir
+    self.keep_last = keep_last
+    if not os.path.isdir(checkpoint_dir): os.makedirs(checkpoint_dir)
+    self.index_path = os.path.join(checkpoint_dir, 'checkpoints.json')
+    self.index = {'checkpoints': [], 'best': None}
+    if os.path.exists(self.index_path):
+      with open(self.index_path) as f:
+        self.index = json.load(f)
+    self.error = None
+    self.queue = None
+    if background:
+      self.queue = queue.Queue(maxsize = 1) # at most one snapshot waits, a slow disk throttles training instead of memory
+      self.thread = threading.Thread(target = self.run, daemon = True)
+      self.thread.start()
+
+  def save(self, state, iteration, score = None):
+    '''Snapshot now, write later. score: validation metric (higher is better) for best.pth.tar'''
+    self.raise_error()
+    job = (snapshot(state), iteration, score)
+    if self.queue is None:
+      self.write(*job)
+    else:
+      self.queue.put(job)
+
+  def run(self):
+    while True:
+      job = self.queue.get()
+      try:
+        if job is not None and self.error is None: self.write(*job)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+      if job is None:
+        break
+
+  def write(self, state, iteration, score):
+    file_name = 'checkpoint_%d.pth.tar' % iteration
+    path = os.path.join(self.checkpoint_dir, file_name)
+    atomic_save(state, path)
+    atomic_link(path, os.path.join(self.checkpoint_dir, 'last.pth.tar'))
+
+    checkpoints = [entry for entry in self.index['checkpoints'] if entry['file'] != file_name]
+    checkpoints.append({'file': file_name, 'iteration': iteration, 'score': score})
+    best = self.index['best']
+    if score is not None and (best is None or score > best['score']):
+      atomic_link(path, os.path.join(self.checkpoint_dir, 'best.pth.tar'))
+      best = {'file': file_name, 'iteration': iteration, 'score': score}
+    for entry in checkpoints[:-self.keep_last] if self.keep_last > 0 else []:
+      os.remove(os.path.join(self.checkpoint_dir, entry['file'])) # best.pth.tar is a separate link and stays
+    self.index = {'checkpoints': checkpoints[-self.keep_last:] if self.keep_last > 0 else checkpoints, 'best': best}
+    with open(self.index_path + '.tmp', 'w') as f:
+      json.dump(self.index, f, indent = 2)
+    os.replace(self.index_path + '.tmp', self.index_path)
+
+  def wait(self):
+    '''Blocks until every queued checkpoint is on disk'''
+    if self.queue is not None: self.queue.join()
+    self.raise_error()
+
+  def close(self):
+    if self.queue is not None:
+      self.queue.put(None)
+      self.thread.join()
+      self.queue = None
+    self.raise_error()
+
+  def raise_error(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise RuntimeError('Writing a checkpoint failed: %s' % error)
@@ -1,16 +1,25 @@
 import torch
 from smart_open import open
+import inspect
 import os
+import random
 import numpy as np
-from scipy.spatial.distance import cdist
 from PIL import Image
 from io import BytesIO
 import glob
 import torchvision
 import torchvision.transforms as T
 
+from model.embedding_store import file_mtime
+from model.shards import ShardReader
+from model.manifest import DatasetManifest
+from model.samplers import TripletSampler, PKBatchSampler, ResumableBatchSampler
+
 np.seterr(divide='ignore', invalid='ignore')
 
+# prefetch_factor and persistent_workers are DataLoader arguments since torch 1.7, older versions get the default behaviour
+WORKER_OPTIONS = [name for name in ('prefetch_factor', 'persistent_workers') if name in inspect.signature(torch.utils.data.DataLoader).parameters]
+
 def get_data_list(data_dir, labels, label_to_index, section):
   ext = '*.jpg' if section == 'photos' else '*.png'
 
@@ -23,9 +32,23 @@ def get_data_list(data_dir, labels, label_to_index, section):
 
   return filenames, classes    
 
-def get_random_image(image_label_indices, image_filenames, label_idx):
-  indices = [i for i,label in enumerate(image_label_indices) if label == label_idx]
-  return image_filenames[np.random.choice(indices, 1)[0]]
+def get_file_list(data_dir, labels, label_to_index, section, manifest = None):
+  '''get_data_list, or the cached listing of a DatasetManifest'''
+  if manifest is not None:
+    return manifest.get_data_list(labels, label_to_index, section)
+  return get_data_list(data_dir, labels, label_to_index, section)
+
+def open_image(filename):
+  return Image.open(filename).convert('RGB').resize((224,224))
+
+def seed_worker(worker_id):
+  '''
+  DataLoader workers are forked with the same np.random/random state, which would make every worker draw the same triplets.
+  Reseed them from torch's per-worker seed (different for every worker and every epoch's iterator).
+  '''
+  worker_seed = torch.initial_seed() % 2**32
+  np.random.seed(worker_seed)
+  random.seed(worker_seed)
 
 def label2index(labels):
   '''For saving data when storing the labels'''
@@ -33,13 +56,20 @@ def label2index(labels):
   return d
 
 class SketchyTestDataset(torch.utils.data.Dataset):
-  def __init__(self, data_dir, labels, label_to_index, embedding, section, transforms = None):
+  def __init__(self, data_dir, labels, label_to_index, embedding, section, transforms = None, shard_dir = None, manifest = None):
     self.labels = labels
     self.label_to_index = label_to_index
     self.embedding = embedding # not used
     self.transforms = transforms
-        
-    self.filenames, self.label_idxs = get_data_list(data_dir, self.labels, self.label_to_index, section) 
+
+    if shard_dir:
+      # pre-decoded 224x224 pixels written by build_shards.py
+      self.reader = ShardReader(shard_dir, section)
+      self.read_image, self.stamp = self.reader.read, self.reader.stamp
+      self.filenames, self.label_idxs = self.reader.get_data_list(self.labels, self.label_to_index)
+    else:
+      self.read_image, self.stamp = open_image, file_mtime
+      self.filenames, self.label_idxs = get_file_list(data_dir, self.labels, self.label_to_index, section, manifest) 
 
   def __getitem__(self, idx):
     '''
@@ -50,7 +80,7 @@ class SketchyTestDataset(torch.utils.data.Dataset):
     filename = self.filenames[idx]
     label_idx = self.label_idxs[idx]
 
-    image = Image.open(filename).convert('RGB').resize((224,224))
+    image = self.read_image(filename)
 
     '''TRANSFORMS'''
     if self.transforms:
@@ -64,62 +94,93 @@ class SketchyTestDataset(torch.utils.data.Dataset):
 
 
 class SketchyTrainDataset(torch.utils.data.Dataset):
-  def __init__(self, data_dir, labels, label_to_index, embedding, transforms = None):
+  def __init__(self, data_dir, labels, label_to_index, embedding, transforms = None, shard_dir = None, manifest = None):
     self.labels = labels
     self.label_to_index = label_to_index
     self.embedding = embedding
     self.transforms = transforms
 
-    self.image_filenames, self.image_label_idxs = get_data_list(data_dir, self.labels, self.label_to_index, 'photos') 
-    self.sketch_filenames, self.sketch_label_idxs = get_data_list(data_dir, self.labels, self.label_to_index, 'sketches') 
+    if shard_dir:
+      # pre-decoded 224x224 pixels written by build_shards.py
+      image_reader, sketch_reader = ShardReader(shard_dir, 'photos'), ShardReader(shard_dir, 'sketches')
+      self.read_photo, self.read_sketch = image_reader.read, sketch_reader.read
+      self.image_filenames, self.image_label_idxs = image_reader.get_data_list(self.labels, self.label_to_index)
+      self.sketch_filenames, self.sketch_label_idxs = sketch_reader.get_data_list(self.labels, self.label_to_index)
+    else:
+      self.read_photo, self.read_sketch = open_image, open_image
+      self.image_filenames, self.image_label_idxs = get_file_list(data_dir, self.labels, self.label_to_index, 'photos', manifest) 
+      self.sketch_filenames, self.sketch_label_idxs = get_file_list(data_dir, self.labels, self.label_to_index, 'sketches', manifest) 
 
+    from scipy.spatial.distance import cdist # deferred: scipy.spatial is slow to import and only training needs it
     wv_distance = cdist(embedding, embedding, 'minkowski')
     numerator = np.ones_like(wv_distance); numerator[wv_distance == 0] = 0.0
     self.word_vectors_similarity = numerator/(wv_distance); self.word_vectors_similarity[wv_distance == 0] = 1.0
+    self.triplet_sampler = TripletSampler(self.image_label_idxs, self.word_vectors_similarity)
 
   def __getitem__(self, idx):
     '''
     Reads sketch at 'idx' and returns a corresponding random image with the same label, and a hard negative image as triplet
     '''
-    '''SKETCH IMAGE'''
-    sketch_filename, label_idx = self.sketch_filenames[idx], self.sketch_label_idxs[idx]
-    sketch_image = Image.open(sketch_filename).convert('RGB').resize((224,224))
-
-    '''POSITIVE IMAGE'''
-    positive_image = Image.open(get_random_image(self.image_label_idxs, self.image_filenames, label_idx)).convert('RGB').resize((224,224))  
+    '''SKETCH AND POSITIVE IMAGE'''
+    sketch_image, positive_image, cur_label_embedding, label_idx = self.get_pair(idx)
 
     '''NEGATIVE IMAGE'''
     # hard negative mining - closer classes(more similarity value) have a higher probability of selection
-    current_label_similarities = self.word_vectors_similarity[label_idx]
-    negative_labels = [x for x in self.label_to_index.values() if x != label_idx]
-    negative_labels_similarities = [current_label_similarities[x] for x in negative_labels]
-    negative_labels_similarities_norms = np.linalg.norm(negative_labels_similarities, ord = 1) 
-    negative_labels_similarities /= negative_labels_similarities_norms # prob
-    chosen_negative_label_idx = np.random.choice(negative_labels, 1, p = negative_labels_similarities)[0]
-    negative_image = Image.open(get_random_image(self.image_label_idxs, self.image_filenames, chosen_negative_label_idx)).convert('RGB').resize((224,224)) 
+    chosen_negative_label_idx = self.triplet_sampler.negative_label(label_idx)
+    negative_image = self.read_photo(self.image_filenames[self.triplet_sampler.random_image(chosen_negative_label_idx)])
+
+    '''TRANSFORMS'''
+    if self.transforms:
+      negative_image = self.transforms(negative_image)
+
+
+    '''RETURN'''
+
+    return sketch_image, positive_image, negative_image, cur_label_embedding, label_idx, chosen_negative_label_idx
 
+  def get_pair(self, idx):
+    '''
+    Reads sketch at 'idx' and a random image with the same label, without a negative (negatives are mined within the batch)
+    '''
+    '''SKETCH IMAGE'''
+    sketch_filename, label_idx = self.sketch_filenames[idx], self.sketch_label_idxs[idx]
+    sketch_image = self.read_sketch(sketch_filename)
+
+    '''POSITIVE IMAGE'''
+    positive_image = self.read_photo(self.image_filenames[self.triplet_sampler.random_image(label_idx)])
 
     '''EMBEDDING'''
     cur_label_embedding = self.embedding[label_idx]
 
     '''TRANSFORMS'''
     if self.transforms:
-      sketch_image, positive_image, negative_image = self.transforms(sketch_image), self.transforms(positive_image), self.transforms(negative_image)
+      sketch_image, positive_image = self.transforms(sketch_image), self.transforms(positive_image)
       cur_label_embedding = torch.FloatTensor(cur_label_embedding)
 
+    return sketch_image, positive_image, cur_label_embedding, label_idx
 
-    '''RETURN'''
 
-    return sketch_image, positive_image, negative_image, cur_label_embedding, label_idx, chosen_negative_label_idx
+  def __len__(self):
+    return len(self.sketch_filenames)
+
 
 
+class SketchyPairDataset(torch.utils.data.Dataset):
+  '''(sketch, positive image, label embedding, label index) pairs of a SketchyTrainDataset, used with PKBatchSampler'''
+  def __init__(self, triplet_dataset):
+    self.triplet_dataset = triplet_dataset
+
+  def __getitem__(self, idx):
+    return self.triplet_dataset.get_pair(idx)
+
   def __len__(self):
-    return len(self.sketch_filenames)
+    return len(self.triplet_dataset)
 
 
 
 class Dataloaders:
-  def __init__(self, data_dir):
+  def __init__(self, data_dir, shard_dir = None, num_workers = 0, pin_memory = False, prefetch_factor = 2, persistent_workers = False, use_manifest = True):
+    '''use_manifest: list the image directories through the cached <data_dir>/manifest.npz (model/manifest.py) instead of globbing them'''
     self.train_labels = open(os.path.join(data_dir, 'train_labels.txt')).read().splitlines() 
     self.train_dict = label2index(self.train_labels)
     self.train_label_embeddings = np.load(os.path.join(data_dir,'train_embeddings.npy'))
@@ -131,19 +192,56 @@ class Dataloaders:
     print('Training on: ', self.train_labels)
     print('Testing on: ', self.test_labels)
 
-    self.train_dataset = SketchyTrainDataset(data_dir, self.train_labels, self.train_dict, self.train_label_embeddings, transforms = get_train_transforms())
-    self.test_dataset_images = SketchyTestDataset(data_dir, self.test_labels, self.test_dict, self.test_label_embeddings, section='photos', transforms = get_test_transforms())
-    self.test_dataset_sketches = SketchyTestDataset(data_dir, self.test_labels, self.test_dict, self.test_label_embeddings, section='sketches', transforms = get_test_transforms())
+    self.manifest = None
+    if use_manifest and not shard_dir:
+      self.manifest = DatasetManifest(data_dir)
+      self.manifest.update(['photos', 'sketches'], self.train_labels + self.test_labels)
+
+    self.train_dataset = SketchyTrainDataset(data_dir, self.train_labels, self.train_dict, self.train_label_embeddings, transforms = get_train_transforms(), shard_dir = shard_dir, manifest = self.manifest)
+    self.test_dataset_images = SketchyTestDataset(data_dir, self.test_labels, self.test_dict, self.test_label_embeddings, section='photos', transforms = get_test_transforms(), shard_dir = shard_dir, manifest = self.manifest)
+    self.test_dataset_sketches = SketchyTestDataset(data_dir, self.test_labels, self.test_dict, self.test_label_embeddings, section='sketches', transforms = get_test_transforms(), shard_dir = shard_dir, manifest = self.manifest)
 
     self.data_dir = data_dir
+    self.shard_dir = shard_dir
+    self.num_workers = num_workers
+    self.pin_memory = pin_memory
+    self.prefetch_factor = prefetch_factor
+    self.persistent_workers = persistent_workers
+
+  def get_loader_options(self):
+    '''Worker pool settings shared by all the dataloaders'''
+    options = {'num_workers': self.num_workers, 'pin_memory': self.pin_memory, 'worker_init_fn': seed_worker}
+    if self.num_workers > 0: # only valid with worker processes
+      options.update({name: getattr(self, name) for name in WORKER_OPTIONS})
+    return options
+
+  def get_train_dataloader(self, batch_size, shuffle = True, num_replicas = 1, rank = 0, seed = 0):
+    '''
+    The batch sampler is a ResumableBatchSampler, so a checkpoint can continue an epoch where it stopped.
+    num_replicas > 1: this process ('rank') only gets its share of the sketches, from a DistributedSampler shuffled with
+    'seed' and the epoch (ResumableBatchSampler.set_epoch)
+    '''
+    if num_replicas > 1:
+      sampler = torch.utils.data.distributed.DistributedSampler(self.train_dataset, num_replicas = num_replicas, rank = rank, shuffle = shuffle, seed = seed)
+    else:
+      sampler = torch.utils.data.RandomSampler(self.train_dataset) if shuffle else torch.utils.data.SequentialSampler(self.train_dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size = batch_size,
+                                                  drop_last = True) # since we use batch normalization, and the last batch's size could be 1
+    train_dataloader = torch.utils.data.DataLoader(self.train_dataset, 
+                                                  batch_sampler = ResumableBatchSampler(batch_sampler),
+                                                  **self.get_loader_options())
+    return train_dataloader
 
-  def get_train_dataloader(self, batch_size, shuffle = True):
 
-    train_dataloader = torch.utils.data.DataLoader(self.train_dataset, 
-                                                  batch_size = batch_size,
-                                                  shuffle = shuffle,
-                                                  num_workers = 0,
-                                                  drop_last = True) # since we use batch normalization, and the last batch's size could be 1
+  def get_pk_train_dataloader(self, classes_per_batch, samples_per_class, num_replicas = 1):
+    '''
+    Batches of 'classes_per_batch' classes x 'samples_per_class' sketch/photo pairs, negatives are mined within the batch.
+    num_replicas > 1: the epoch's batches are divided among that many processes
+    '''
+    batch_sampler = ResumableBatchSampler(PKBatchSampler(self.train_dataset.sketch_label_idxs, classes_per_batch, samples_per_class, num_replicas))
+    train_dataloader = torch.utils.data.DataLoader(SketchyPairDataset(self.train_dataset),
+                                                  batch_sampler = batch_sampler,
+                                                  **self.get_loader_options())
     return train_dataloader
 
 
@@ -156,16 +254,16 @@ class Dataloaders:
     test_dataloader = torch.utils.data.DataLoader(dataset, 
                                                   batch_size = batch_size,
                                                   shuffle = shuffle,
-                                                  num_workers = 0)
+                                                  **self.get_loader_options())
     return test_dataloader                                              
 
   def get_full_train_dataloader(self, batch_size, section, shuffle = False):
-    dataset = SketchyTestDataset(self.data_dir, self.train_labels, self.train_dict, self.train_label_embeddings, section, transforms = get_test_transforms())
+    dataset = SketchyTestDataset(self.data_dir, self.train_labels, self.train_dict, self.train_label_embeddings, section, transforms = get_test_transforms(), shard_dir = self.shard_dir, manifest = self.manifest)
 
     dataloader = torch.utils.data.DataLoader(dataset, 
                                             batch_size = batch_size,
                                             shuffle = shuffle,
-                                            num_workers = 0)
+                                            **self.get_loader_options())
     return dataloader   
 
 
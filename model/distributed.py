@@ -0,0 +1,131 @@
+import datetime
+import multiprocessing
+import os
+import random
+import socket
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from model.layers import is_distributed
+
+
+def get_rank():
+  return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+  return dist.get_world_size() if is_distributed() else 1
+
+
+def init_distributed(backend = 'gloo', timeout_minutes = 30):
+  '''
+  Joins the process group described by the environment of torchrun (or launch_local): RANK, WORLD_SIZE, MASTER_ADDR,
+  MASTER_PORT and LOCAL_WORLD_SIZE. Returns (rank, world_size), (0, 1) when WORLD_SIZE is not above 1.
+  Unless OMP_NUM_THREADS is set, every process gets an equal share of the host's cores for its intra-op threads.
+  '''
+  world_size = int(os.environ.get('WORLD_SIZE', 1))
+  if world_size <= 1:
+    return 0, 1
+  if not dist.is_initialized():
+    dist.init_process_group(backend, init_method = 'env://', timeout = datetime.timedelta(minutes = timeout_minutes))
+  if 'OMP_NUM_THREADS' not in os.environ:
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+  return dist.get_rank(), world_size
+
+
+def barrier():
+  if is_distributed(): dist.barrier()
+
+
+'''RANDOM NUMBER STREAMS'''
+
+def shared_seed():
+  '''A random seed drawn by rank 0 and sent to every process (the seed of the epoch shuffles, the same on all ranks)'''
+  seed = torch.randint(2**31 - 1, (1,), dtype = torch.int64)
+  if is_distributed(): dist.broadcast(seed, 0)
+  return int(seed)
+
+
+def seed_rank(seed, rank, step = 0):
+  '''
+  Independent python, numpy and torch streams per rank (triplet and PK sampling, dataloader worker seeds), derived from
+  the shared seed, the rank and the iteration training starts at, so a resumed run does not replay the first draws
+  '''
+  rng = np.random.RandomState([seed, rank, step])
+  random.seed(int(rng.randint(2**31))); np.random.seed(int(rng.randint(2**31))); torch.manual_seed(int(rng.randint(2**31)))
+
+
+'''MODEL'''
+
+class TrainingModules(nn.Module):
+  '''
+  The image, sketch and domain models of train.py as one module whose forward runs one of them, by name ('forward_suffix'
+  of the encoders when 'suffix_only', with a feature cache). DistributedDataParallel wraps it once, so every call goes
+  through the wrapper and the parameters the encoders share (shared_trunk) are reduced once.
+  '''
+  def __init__(self, image_model, sketch_model, domain_net, suffix_only = False):
+    super(TrainingModules, self).__init__()
+    self.image_model = image_model
+    self.sketch_model = sketch_model
+    self.domain_net = domain_net
+    self.suffix_only = suffix_only
+
+  def forward(self, name, x):
+    model = getattr(self, name)
+    if self.suffix_only and name != 'domain_net':
+      return model.forward_suffix(x)
+    return model(x)
+
+
+def data_parallel(modules, device):
+  '''
+  DistributedDataParallel over 'modules' (rank 0's weights are copied to every process). Gradients are averaged over the
+  processes during backward; the batch norm buffers of the encoders are rank 0's, sent before every call.
+  '''
+  return DistributedDataParallel(modules, device_ids = [device.index] if device.type == 'cuda' else None)
+
+
+'''LOCAL LAUNCHER'''
+
+def free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def run_process(rank, world_size, port, fn, args):
+  os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size), 'LOCAL_WORLD_SIZE': str(world_size),
+                     'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+  try:
+    fn(*args)
+  finally:
+    if dist.is_initialized(): dist.destroy_process_group()
+
+
+def launch_local(fn, world_size, args = ()):
+  '''
+  Runs fn(*args) in 'world_size' new processes of this host with the environment torchrun would give them (fn calls
+  init_distributed, directly or through Trainer.train_and_evaluate). fn must be picklable, e.g. a module-level function.
+  Raises RuntimeError if a process fails; the others are then stopped.
+  '''
+  context = multiprocessing.get_context('spawn')
+  port = free_port()
+  processes = [context.Process(target = run_process, args = (rank, world_size, port, fn, args)) for rank in range(world_size)]
+  for process in processes: process.start()
+  try:
+    remaining = list(processes)
+    while remaining:
+      for process in list(remaining):
+        process.join(timeout = 0.5)
+        if process.exitcode is None: continue
+        remaining.remove(process)
+        if process.exitcode != 0:
+          raise RuntimeError('rank %d of %d exited with code %d' % (processes.index(process), world_size, process.exitcode))
+  finally:
+    for process in processes:
+      if process.is_alive(): process.terminate()
+    for process in processes: process.join()
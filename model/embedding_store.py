@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+
+def state_dict_hash(model):
+  '''Short sha1 of the names and values of a model's state_dict, used as the key of the stored embeddings'''
+  digest = hashlib.sha1()
+  for name, tensor in model.state_dict().items():
+    digest.update(name.encode('utf-8'))
+    if tensor.is_quantized: tensor = tensor.int_repr()
+    digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+  return digest.hexdigest()[:16]
+
+
+def file_mtime(filename):
+  '''Change stamp of a photo read from its own file (the datasets read from shards use ShardReader.stamp)'''
+  return os.stat(filename).st_mtime_ns
+
+
+def file_hash(path, chunk_size = 1 << 20):
+  '''Short sha1 of a file, the key of the stored embeddings for exported (frozen TorchScript) models without a state_dict'''
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()[:16]
+
+
+class EmbeddingStore():
+  '''
+  Photo embeddings of one image model kept on disk as <store_dir>/<model hash>/embeddings.npy (memory-mapped)
+  and manifest.json (path, change stamp and label of every row). Only new or modified photos are encoded again.
+  '''
+  EMBEDDINGS_FILE = 'embeddings.npy'
+  MANIFEST_FILE = 'manifest.json'
+
+  def __init__(self, store_dir, image_model, rebuild = False, key = None):
+    self.store_dir = store_dir
+    self.key = key or state_dict_hash(image_model)
+    self.directory = os.path.join(store_dir, self.key)
+    self.rebuild = rebuild
+
+  def invalidate(self):
+    '''Removes the stored embeddings of every model'''
+    if os.path.isdir(self.store_dir):
+      shutil.rmtree(self.store_dir)
+
+  def load(self):
+    '''Returns (manifest, memory-mapped embeddings), or ([], None) if nothing is stored for this model'''
+    embeddings_path = os.path.join(self.directory, self.EMBEDDINGS_FILE)
+    manifest_path = os.path.join(self.directory, self.MANIFEST_FILE)
+    if not (os.path.exists(embeddings_path) and os.path.exists(manifest_path)):
+      return [], None
+    with open(manifest_path) as f:
+      manifest = json.load(f)
+    return manifest, np.load(embeddings_path, mmap_mode = 'r')
+
+  def get_embeddings(self, filenames, label_idxs, encode_fn, stamp_fn = file_mtime):
+    '''
+    Embeddings of 'filenames', in order, as a read-only memmap.
+    encode_fn(indices) must return the embeddings of filenames[indices] as a (len(indices), dim) float array.
+    stamp_fn(filename) returns a value that changes when the photo does (the dataset's 'stamp', e.g. the file's mtime).
+    '''
+    manifest, stored_embeddings = ([], None) if self.rebuild else self.load()
+    stored_rows = {entry['path']: (row, entry) for row, entry in enumerate(manifest)}
+
+    entries = [{'path': filename, 'mtime': stamp_fn(filename), 'label': int(label_idx)} for filename, label_idx in zip(filenames, label_idxs)]
+    source_rows = []; stale_indices = []
+    for i, entry in enumerate(entries):
+      row, stored_entry = stored_rows.get(entry['path'], (None, None))
+      if stored_entry is not None and stored_entry['mtime'] == entry['mtime'] and stored_entry['label'] == entry['label']:
+        source_rows.append(row)
+      else:
+        source_rows.append(None); stale_indices.append(i)
+
+    print('Embedding store %s: reusing %d embeddings, encoding %d' % (self.key, len(entries) - len(stale_indices), len(stale_indices)))
+    if not stale_indices and source_rows == list(range(len(manifest))):
+      return stored_embeddings
+
+    '''ENCODE THE NEW/MODIFIED FILES AND WRITE THE MERGED MATRIX'''
+    new_embeddings = np.asarray(encode_fn(stale_indices), dtype = np.float32) if stale_indices else None
+    dim = new_embeddings.shape[1] if new_embeddings is not None else stored_embeddings.shape[1]
+
+    if not os.path.isdir(self.directory): os.makedirs(self.directory)
+    embeddings_path = os.path.join(self.directory, self.EMBEDDINGS_FILE)
+    temp_path = embeddings_path + '.tmp.npy'
+    embeddings = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.float32, shape = (len(entries), dim))
+    reused = [i for i, row in enumerate(source_rows) if row is not None]
+    if reused:
+      embeddings[reused] = stored_embeddings[[source_rows[i] for i in reused]]
+    if stale_indices:
+      embeddings[stale_indices] = new_embeddings
+    embeddings.flush(); del embeddings, stored_embeddings
+
+    # the old manifest is dropped before its rows are replaced, so a crash in between forces a full re-encode instead of a mismatch
+    manifest_path = os.path.join(self.directory, self.MANIFEST_FILE)
+    if os.path.exists(manifest_path): os.remove(manifest_path)
+    os.replace(temp_path, embeddings_path)
+    with open(manifest_path + '.tmp', 'w') as f:
+      json.dump(entries, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return np.load(embeddings_path, mmap_mode = 'r')
@@ -0,0 +1,68 @@
+import copy
+import time
+
+import torch
+
+IMAGE_SIZE = 224
+# torch.jit.freeze since torch 1.8; older versions keep the traced model as it is (it still loads without the model code)
+JIT_FREEZE = hasattr(torch.jit, 'freeze')
+
+
+def trace_model(model, example_input, freeze = True):
+  '''TorchScript version of an eval-mode model, independent of the python model code'''
+  model = model.eval()
+  with torch.no_grad():
+    traced = torch.jit.trace(model, example_input)
+  return torch.jit.freeze(traced) if freeze and JIT_FREEZE else traced
+
+
+def quantize_static(model, calibration_batches, backend = 'fbgemm'):
+  '''
+  Post-training static int8 quantization (FX graph mode) of a CPU model. The activation ranges are calibrated on
+  'calibration_batches' (iterable of input tensors). BasicModel is convolutions only, which dynamic quantization
+  (Linear/LSTM weights) does not cover, so static quantization is the int8 path that applies to it.
+  '''
+  try:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+  except ImportError:
+    raise RuntimeError('Static quantization needs torch >= 1.13 (QConfigMapping and prepare_fx with example inputs), this is torch %s: '
+                       'install the torch of environment.yml, or export with --quantization none' % torch.__version__)
+
+  torch.backends.quantized.engine = backend
+  model = copy.deepcopy(model).cpu().eval()
+  calibration_batches = iter(calibration_batches)
+  first_batch = next(calibration_batches)
+  prepared = prepare_fx(model, get_default_qconfig_mapping(backend), (first_batch,))
+  with torch.no_grad():
+    prepared(first_batch)
+    for batch in calibration_batches:
+      prepared(batch)
+  return convert_fx(prepared)
+
+
+def export_onnx(model, path, example_input):
+  '''fp32 ONNX graph with a dynamic batch dimension'''
+  torch.onnx.export(model.cpu().eval(), example_input, path, input_names = ['images'], output_names = ['embeddings'],
+                    dynamic_axes = {'images': {0: 'batch'}, 'embeddings': {0: 'batch'}}, opset_version = 13)
+
+
+def load_exported_model(path):
+  '''TorchScript model written by export.py (always loaded on the CPU, int8 models only run there)'''
+  return torch.jit.load(path, map_location = 'cpu')
+
+
+def measure_latency(model, batch_sizes, num_iterations = 10, num_warmup = 2):
+  '''{batch_size: (latency per image in ms, images per second)} of a CPU model on random inputs'''
+  results = {}
+  with torch.no_grad():
+    for batch_size in batch_sizes:
+      images = torch.rand(batch_size, 3, IMAGE_SIZE, IMAGE_SIZE)
+      for _ in range(num_warmup):
+        model(images)
+      start_time = time.time()
+      for _ in range(num_iterations):
+        model(images)
+      elapsed = time.time() - start_time
+      results[batch_size] = (1000.0 * elapsed / (num_iterations * batch_size), num_iterations * batch_size / elapsed)
+  return results
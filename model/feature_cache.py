@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from model.dataloader import get_train_transforms
+from model.embedding_store import state_dict_hash
+
+SECTIONS = ('photos', 'sketches')
+
+
+class FileDataset(torch.utils.data.Dataset):
+  '''Images of 'filenames' read with 'read_fn' (open_image or a ShardReader), in order'''
+  def __init__(self, filenames, read_fn, transforms):
+    self.filenames = filenames
+    self.read_fn = read_fn
+    self.transforms = transforms
+
+  def __getitem__(self, idx):
+    return self.transforms(self.read_fn(self.filenames[idx]))
+
+  def __len__(self):
+    return len(self.filenames)
+
+
+class CachedFeatureReader():
+  '''Reads the cached prefix output of a file (an fp16 row of the memory-mapped cache), in place of the image'''
+  def __init__(self, path, filenames):
+    self.path = path
+    self.rows = {filename: row for row, filename in enumerate(filenames)}
+    self.features = None
+
+  def __getstate__(self):
+    # dataloader workers open their own memory map
+    state = dict(self.__dict__); state['features'] = None
+    return state
+
+  def __call__(self, filename):
+    if self.features is None: self.features = np.load(self.path, mmap_mode = 'r')
+    return self.features[self.rows[filename]]
+
+
+def features_to_tensor(features):
+  '''The transform of cached features: fp16 row -> float32 tensor'''
+  return torch.from_numpy(np.asarray(features, dtype = np.float32))
+
+
+class FeatureCache():
+  '''
+  Outputs of the frozen DenseNet prefix of the image model (for the training photos) and of the sketch model (for the
+  training sketches), stored as float16 .npy files under <cache_dir>/<key> and read through memory maps.
+  The key hashes the frozen block count and the prefix weights, so a cache is only reused for the same frozen layers.
+  Valid because the training transforms are deterministic (no random augmentation).
+  '''
+  def __init__(self, cache_dir, image_model, sketch_model, frozen_blocks):
+    self.models = {'photos': image_model, 'sketches': sketch_model}
+    key = '%s_%s' % (state_dict_hash(image_model.frozen_prefix()), state_dict_hash(sketch_model.frozen_prefix()))
+    self.directory = os.path.join(cache_dir, 'blocks%d_%s' % (frozen_blocks, key))
+
+  def paths(self, section):
+    return os.path.join(self.directory, section + '.npy'), os.path.join(self.directory, section + '.json')
+
+  def build(self, section, filenames, read_fn, batch_size = 32, num_workers = 0, device = None):
+    '''Runs the prefix over 'filenames' unless the cache already holds exactly them. Returns the number of files encoded'''
+    features_path, filenames_path = self.paths(section)
+    if os.path.exists(features_path) and os.path.exists(filenames_path):
+      with open(filenames_path) as f:
+        if json.load(f) == list(filenames): return 0
+
+    device = device or torch.device('cpu')
+    prefix = self.models[section].frozen_prefix().to(device).eval()
+    dataloader = torch.utils.data.DataLoader(FileDataset(filenames, read_fn, get_train_transforms()), batch_size = batch_size, shuffle = False, num_workers = num_workers)
+    if not os.path.isdir(self.directory): os.makedirs(self.directory)
+    if os.path.exists(filenames_path): os.remove(filenames_path) # the file list is written last and marks a complete cache
+
+    temp_path = features_path + '.tmp.npy'
+    features = None; start = 0
+    with torch.no_grad(), torch.random.fork_rng(devices = []): # the loader's seed draw must not shift the training RNG
+      for images in dataloader:
+        outputs = prefix(images.to(device)).cpu().numpy().astype(np.float16)
+        if features is None:
+          features = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.float16, shape = (len(filenames),) + outputs.shape[1:])
+        features[start:start + len(outputs)] = outputs
+        start += len(outputs)
+    if features is None:
+      raise ValueError('No %s to cache' % section)
+    features.flush(); del features
+    os.replace(temp_path, features_path)
+    with open(filenames_path, 'w') as f:
+      json.dump(list(filenames), f)
+    return len(filenames)
+
+  def build_dataset(self, dataset, batch_size = 32, num_workers = 0, device = None):
+    '''Caches the photos and sketches of a SketchyTrainDataset. Returns the number of files encoded'''
+    return (self.build('photos', dataset.image_filenames, dataset.read_photo, batch_size, num_workers, device)
+            + self.build('sketches', dataset.sketch_filenames, dataset.read_sketch, batch_size, num_workers, device))
+
+  def attach(self, dataset):
+    '''Makes a SketchyTrainDataset return the cached prefix outputs instead of the images'''
+    dataset.read_photo, dataset.read_sketch = self.reader('photos'), self.reader('sketches')
+    dataset.transforms = features_to_tensor
+
+  def reader(self, section):
+    features_path, filenames_path = self.paths(section)
+    with open(filenames_path) as f:
+      return CachedFeatureReader(features_path, json.load(f))
+
+  def size_bytes(self):
+    return sum(os.path.getsize(self.paths(section)[0]) for section in SECTIONS if os.path.exists(self.paths(section)[0]))
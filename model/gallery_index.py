@@ -0,0 +1,274 @@
+import collections
+import json
+import os
+import threading
+
+import numpy as np
+
+from model.embedding_store import file_mtime
+from model.retrieval import topk_search
+
+LOG_FILE = 'log.jsonl'
+
+# an immutable embedding file with the path, label and change stamp (mtime) of its rows; 'deleted' is replaced (never modified) on removal
+Segment = collections.namedtuple('Segment', ['name', 'embeddings', 'paths', 'labels', 'mtimes', 'deleted'])
+
+
+class GallerySnapshot():
+  '''
+  Read-only view of a GalleryIndex at one point of its log. Updates of the index build a new snapshot and never modify
+  this one, so a query sees the same gallery from start to end. Rows are numbered across segments, tombstones included.
+  '''
+  def __init__(self, segments, generation, log_offset):
+    self.segments = tuple(segments)
+    self.generation = generation
+    self.log_offset = log_offset
+    self.offsets = np.cumsum([0] + [len(segment.paths) for segment in self.segments])
+    self.num_live = int(sum(len(segment.paths) - segment.deleted.sum() for segment in self.segments))
+
+  def __len__(self):
+    return self.num_live
+
+  def search(self, queries, k, metric = 'l2', dtype = None, device = None):
+    '''
+    Exact k nearest live rows: topk_search of every segment for k plus its number of tombstones, tombstones dropped, then
+    merged. Returns (distances, rows) as numpy arrays of shape (len(queries), min(k, len(self))), nearest first.
+    '''
+    kwargs = {'metric': metric, 'device': device}
+    if dtype is not None: kwargs['dtype'] = dtype
+    k = min(k, self.num_live)
+    all_distances = [np.zeros((len(queries), 0), dtype = np.float32)]; all_rows = [np.zeros((len(queries), 0), dtype = np.int64)]
+    for segment, offset in zip(self.segments, self.offsets[:-1]):
+      num_deleted = int(segment.deleted.sum())
+      if num_deleted == len(segment.paths) or k == 0:
+        continue
+      distances, indices = topk_search(queries, segment.embeddings, k + num_deleted, **kwargs)
+      if num_deleted:
+        distances = np.where(segment.deleted[indices], np.inf, distances)
+      all_distances.append(distances); all_rows.append(indices + offset)
+
+    distances = np.concatenate(all_distances, axis = 1); rows = np.concatenate(all_rows, axis = 1)
+    order = np.argsort(distances, axis = 1, kind = 'stable')[:, :k]
+    return np.take_along_axis(distances, order, axis = 1), np.take_along_axis(rows, order, axis = 1)
+
+  def locate(self, row):
+    segment = int(np.searchsorted(self.offsets, row, side = 'right')) - 1
+    return self.segments[segment], row - self.offsets[segment]
+
+  def paths(self, rows):
+    return [segment.paths[i] for segment, i in map(self.locate, rows)]
+
+  def labels(self, rows):
+    return [segment.labels[i] for segment, i in map(self.locate, rows)]
+
+  def live(self):
+    '''(embeddings, labels, paths) of every live row, embeddings as one in-memory float32 array'''
+    embeddings = []; labels = []; paths = []
+    for segment in self.segments:
+      keep = np.flatnonzero(~segment.deleted)
+      if len(keep):
+        embeddings.append(np.asarray(segment.embeddings[keep], dtype = np.float32))
+        labels.extend(segment.labels[i] for i in keep); paths.extend(segment.paths[i] for i in keep)
+    dim = self.segments[0].embeddings.shape[1] if self.segments else 0
+    return (np.concatenate(embeddings) if embeddings else np.zeros((0, dim), dtype = np.float32)), labels, paths
+
+  def stats(self):
+    num_rows = int(self.offsets[-1])
+    return {'live': self.num_live, 'tombstones': num_rows - self.num_live, 'segments': len(self.segments), 'generation': self.generation}
+
+
+class GalleryIndex():
+  '''
+  Photo embeddings kept in <index_dir> as immutable segment_<n>.npy files (memory-mapped) and an append-only log.jsonl of
+  operations: 'add' (a new segment; a path that is already present is replaced, its old row becomes a tombstone) and
+  'remove' (tombstones). An update writes and fsyncs its segment before appending its log record, so it costs time in the
+  size of the change and a crash loses at most the update in progress. compact() rewrites the live rows into a single
+  segment under a new log (a new generation). refresh() applies what another process appended since the last read.
+  The first log record names the image model of the embeddings (model_key, e.g. its state_dict_hash); sync() with another
+  model encodes the whole gallery again. Single writer; any number of readers, each query using snapshot().
+  '''
+  def __init__(self, index_dir, model_key = None):
+    self.index_dir = index_dir
+    self.log_path = os.path.join(index_dir, LOG_FILE)
+    self.lock = threading.Lock()
+    if not os.path.isdir(index_dir): os.makedirs(index_dir)
+    if not os.path.exists(self.log_path):
+      self.write_log([{'op': 'base', 'generation': 0, 'model': model_key}])
+    self.reload()
+
+  def snapshot(self):
+    return self._snapshot
+
+  def __len__(self):
+    return len(self._snapshot)
+
+  '''LOG REPLAY'''
+
+  def read_log(self, offset = 0):
+    '''(records, offset after the last complete record) from 'offset'. A torn last line (crash during an append) is ignored'''
+    records = []
+    with open(self.log_path, 'rb') as f:
+      f.seek(offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          break
+        try:
+          records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+          break
+        offset += len(line)
+    return records, offset
+
+  def log_generation(self):
+    with open(self.log_path, 'rb') as f:
+      return json.loads(f.readline().decode('utf-8'))['generation']
+
+  def reload(self, attempts = 3):
+    with self.lock:
+      for attempt in range(attempts):
+        records, offset = self.read_log()
+        self.segments = []; self.rows = {}; self.next_segment = 0
+        self.model_key = records[0].get('model') # None for an index written before the model was recorded
+        try:
+          self.apply(records[1:], records[0]['generation'], offset)
+          return
+        except FileNotFoundError: # a compaction by another process replaced the log after it was read
+          if attempt == attempts - 1: raise
+
+  def refresh(self):
+    '''Applies the records appended (or the compaction done) by another process. Returns False if nothing changed'''
+    if os.path.getsize(self.log_path) == self._snapshot.log_offset and self.log_generation() == self._snapshot.generation:
+      return False
+    if self.log_generation() != self._snapshot.generation:
+      self.reload()
+      return True
+    with self.lock:
+      records, offset = self.read_log(self._snapshot.log_offset)
+      self.apply(records, self._snapshot.generation, offset)
+    return bool(records)
+
+  def apply(self, records, generation, log_offset):
+    '''Updates the segments and the path -> (segment, row) map with 'records', then publishes a new snapshot'''
+    for record in records:
+      if record['op'] == 'add':
+        self.tombstone(record['paths'])
+        name = record['segment']
+        self.next_segment = max(self.next_segment, int(name[len('segment_'):-len('.npy')]) + 1)
+        embeddings = np.load(os.path.join(self.index_dir, name), mmap_mode = 'r')
+        self.segments.append(Segment(name, embeddings, record['paths'], record['labels'], record['mtimes'], np.zeros(len(record['paths']), dtype = bool)))
+        self.rows.update((path, (len(self.segments) - 1, row)) for row, path in enumerate(record['paths']))
+      elif record['op'] == 'remove':
+        self.tombstone(record['paths'])
+    self._snapshot = GallerySnapshot(self.segments, generation, log_offset)
+
+  def tombstone(self, paths):
+    by_segment = collections.defaultdict(list)
+    for path in paths:
+      if path in self.rows:
+        segment, row = self.rows.pop(path)
+        by_segment[segment].append(row)
+    for segment, rows in by_segment.items():
+      deleted = self.segments[segment].deleted.copy() # copy on write, older snapshots keep their mask
+      deleted[rows] = True
+      self.segments[segment] = self.segments[segment]._replace(deleted = deleted)
+
+  '''UPDATES'''
+
+  def write_log(self, records, path = None):
+    path = path or self.log_path
+    with open(path + '.tmp', 'w') as f:
+      f.write(''.join(json.dumps(record) + '\n' for record in records))
+      f.flush(); os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+  def append(self, record):
+    '''Writes 'record' at the end of the last complete record (overwriting a torn one), then applies it'''
+    data = (json.dumps(record) + '\n').encode('utf-8')
+    with open(self.log_path, 'r+b') as f:
+      f.seek(self._snapshot.log_offset); f.truncate()
+      f.write(data)
+      f.flush(); os.fsync(f.fileno())
+    self.apply([record], self._snapshot.generation, self._snapshot.log_offset + len(data))
+
+  def write_segment(self, embeddings):
+    name = 'segment_%06d.npy' % self.next_segment
+    self.next_segment += 1
+    path = os.path.join(self.index_dir, name)
+    with open(path + '.tmp', 'wb') as f:
+      np.save(f, np.asarray(embeddings, dtype = np.float32))
+      f.flush(); os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    return name
+
+  def add(self, paths, embeddings, labels, mtimes = None):
+    '''Appends photos (replacing those whose path is already in the index). embeddings: (len(paths), dim) array'''
+    if not len(paths):
+      return
+    if len(embeddings) != len(paths) or len(labels) != len(paths):
+      raise ValueError('add() needs one embedding and one label per path, got %d paths, %d embeddings, %d labels' % (len(paths), len(embeddings), len(labels)))
+    with self.lock:
+      name = self.write_segment(embeddings)
+      self.append({'op': 'add', 'segment': name, 'paths': list(paths), 'labels': [int(label) for label in labels],
+                   'mtimes': [int(mtime) for mtime in mtimes] if mtimes is not None else [0] * len(paths)})
+
+  def remove(self, paths):
+    '''Tombstones the photos at 'paths'; paths that are not in the index are ignored. Returns the number removed'''
+    with self.lock:
+      paths = [path for path in paths if path in self.rows]
+      if paths: self.append({'op': 'remove', 'paths': paths})
+    return len(paths)
+
+  def sync(self, filenames, label_idxs, encode_fn, model_key = None, stamp_fn = file_mtime):
+    '''
+    Makes the index hold exactly 'filenames': removes the paths that are gone and encodes the new or modified ones
+    (by stamp_fn(filename), e.g. the file's mtime, and label) with encode_fn(indices), which returns the embeddings of
+    filenames[indices]. Returns (added, removed)
+    When 'model_key' is given and is not the model the index was built with, every photo is encoded and replaces the
+    index under a new generation, so the gallery never mixes the embeddings of two models.
+    '''
+    snapshot = self._snapshot
+    mtimes = [stamp_fn(filename) for filename in filenames]
+    if model_key is not None and model_key != self.model_key:
+      embeddings = np.asarray(encode_fn(list(range(len(filenames)))), dtype = np.float32)
+      self.write_generation(embeddings, [int(label_idx) for label_idx in label_idxs], list(filenames), mtimes, model_key)
+      return len(filenames), len(snapshot)
+    stale_indices = []
+    for i, (filename, label_idx, mtime) in enumerate(zip(filenames, label_idxs, mtimes)):
+      location = self.rows.get(filename)
+      segment = snapshot.segments[location[0]] if location else None
+      if segment is None or segment.mtimes[location[1]] != mtime or segment.labels[location[1]] != int(label_idx):
+        stale_indices.append(i)
+
+    num_removed = self.remove(sorted(set(self.rows) - set(filenames)))
+    if stale_indices:
+      self.add([filenames[i] for i in stale_indices], np.asarray(encode_fn(stale_indices), dtype = np.float32),
+               [label_idxs[i] for i in stale_indices], [mtimes[i] for i in stale_indices])
+    return len(stale_indices), num_removed
+
+  def compact(self):
+    '''Rewrites the live rows into one segment and starts a new log generation, then deletes the unreferenced segments'''
+    with self.lock:
+      snapshot = self._snapshot
+      embeddings, labels, paths = snapshot.live()
+      mtimes = [segment.mtimes[i] for segment in snapshot.segments for i in np.flatnonzero(~segment.deleted)]
+    self.write_generation(embeddings, labels, paths, mtimes, self.model_key)
+
+  def write_generation(self, embeddings, labels, paths, mtimes, model_key):
+    '''
+    Replaces the index with these rows, as one segment under a new log generation of 'model_key', then deletes the
+    unreferenced segments
+    '''
+    with self.lock:
+      records = [{'op': 'base', 'generation': self._snapshot.generation + 1, 'model': model_key}]
+      if paths:
+        records.append({'op': 'add', 'segment': self.write_segment(embeddings), 'paths': paths, 'labels': labels, 'mtimes': [int(mtime) for mtime in mtimes]})
+      self.write_log(records)
+      referenced = set(record['segment'] for record in records[1:])
+    # open snapshots keep their memory maps of the removed files (the deletion is retried by the next compaction where files in use cannot be removed)
+    for name in os.listdir(self.index_dir):
+      if name.startswith('segment_') and name not in referenced:
+        try:
+          os.remove(os.path.join(self.index_dir, name))
+        except OSError:
+          pass
+    self.reload()
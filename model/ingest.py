@@ -0,0 +1,177 @@
+import collections
+import io
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+from multiprocessing import Pool
+
+from model.shards import ShardWriter, decode_image
+
+# same clean-up as download_data.prepare_dataset, applied to the archive entry names
+LABEL_RENAMES = {'hot-air_balloon': 'hot_air_balloon', 'jack-o-lantern': 'jack_o_lantern'}
+# archive directory -> (section, source); the other tx_* directories of the 7z are augmented variants and are skipped
+ARCHIVE_DIRECTORIES = {('256x256', 'photo', 'tx_000000000000'): ('photos', 'sketchy'),
+                       ('256x256', 'sketch', 'tx_000000000000'): ('sketches', 'sketchy'),
+                       ('EXTEND_image_sketchy',): ('photos', 'extended')}
+EXTENSIONS = {'photos': '.jpg', 'sketches': '.png'}
+
+
+def classify_entry(name):
+  '''(section, label, shard key) of an archive entry, or None if it is not part of the dataset'''
+  parts = name.replace('\\', '/').split('/')
+  for directory, (section, source) in ARCHIVE_DIRECTORIES.items():
+    if len(parts) == len(directory) + 2 and tuple(parts[:len(directory)]) == directory and parts[-1].lower().endswith(EXTENSIONS[section]):
+      label = LABEL_RENAMES.get(parts[-2], parts[-2])
+      return section, label, '%s/%s/%s/%s' % (section, label, source, parts[-1])
+  return None
+
+
+def decode_batch(items):
+  '''Decodes a list of encoded image bytes (runs in the pool)'''
+  return [decode_image(io.BytesIO(data)) for data in items]
+
+
+class ArchiveReader():
+  '''Dataset entries of a .zip or .7z archive: names() from the archive headers, stream() their bytes in archive order'''
+  def __init__(self, path):
+    self.path = path
+    self.is_7z = path.lower().endswith('.7z')
+
+  def names(self):
+    if self.is_7z:
+      import py7zr
+      with py7zr.SevenZipFile(self.path, mode = 'r') as archive:
+        names = archive.getnames()
+    else:
+      with zipfile.ZipFile(self.path) as archive:
+        names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    return [name for name in names if classify_entry(name)]
+
+  def stream(self, names, emit):
+    '''Calls emit(name, bytes) for every entry of 'names', one decompressed entry in memory at a time'''
+    if not self.is_7z:
+      with zipfile.ZipFile(self.path) as archive:
+        for name in names:
+          emit(name, archive.read(name))
+      return
+
+    import py7zr
+    try:
+      import py7zr.io # the writer factories of py7zr >= 1.0 (python >= 3.10)
+    except ImportError:
+      self.stream_extracted(names, emit)
+      return
+
+    class EntryFactory(py7zr.io.WriterFactory):
+      '''Collects each entry in memory and hands it over when the next one starts (or at the end)'''
+      def __init__(self):
+        self.current = None
+      def create(self, filename):
+        self.finish()
+        self.current = (filename, py7zr.io.Py7zBytesIO(filename, limit = 2**31))
+        return self.current[1]
+      def finish(self):
+        if self.current is not None:
+          filename, buffer = self.current
+          self.current = None
+          buffer.seek(0)
+          emit(filename, buffer.read())
+
+    factory = EntryFactory()
+    with py7zr.SevenZipFile(self.path, mode = 'r') as archive:
+      archive.extract(targets = names, factory = factory) # entries outside 'names' are decompressed but never stored
+    factory.finish()
+
+  def stream_extracted(self, names, emit):
+    '''
+    stream() of a .7z with an older py7zr (0.20, the environment.yml pin), which can only hand entries over all at once:
+    they are extracted to a temporary directory next to the archive, then read and deleted one at a time
+    '''
+    import py7zr
+    temp_dir = tempfile.mkdtemp(prefix = 'ingest_', dir = os.path.dirname(os.path.abspath(self.path)))
+    try:
+      with py7zr.SevenZipFile(self.path, mode = 'r') as archive:
+        archive.extract(path = temp_dir, targets = names)
+      for name in names:
+        path = os.path.join(temp_dir, name)
+        with open(path, 'rb') as f:
+          data = f.read()
+        os.remove(path)
+        emit(name, data)
+    finally:
+      shutil.rmtree(temp_dir, ignore_errors = True)
+
+
+def ingest_archives(archive_paths, shard_dir, num_workers = 0, batch_size = 32, max_pending = None):
+  '''
+  Streams the photos and sketches of the Sketchy archives (Sketchy.7z, extended_photo.zip) straight into per-class shards
+  under <shard_dir>/<section>, as build_shards does from an extracted tree: the class directories are renamed and the
+  augmented tx_* variants skipped on the fly, images are decoded and resized in 'num_workers' processes, and the raw
+  files never touch the disk. Archives are read concurrently, one thread each, and at most 'max_pending' batches
+  (default 2 per worker) of encoded images wait in memory. Returns {section: number of images}.
+  '''
+  readers = [ArchiveReader(path) for path in archive_paths]
+  names = [reader.names() for reader in readers]
+
+  '''PLAN THE SHARDS FROM THE ARCHIVE HEADERS'''
+  keys = collections.defaultdict(lambda: collections.defaultdict(list)) # section -> label -> shard keys
+  locations = {} # (archive, entry name) -> (section, label, row)
+  for archive, archive_names in enumerate(names):
+    for name in archive_names:
+      section, label, key = classify_entry(name)
+      locations[(archive, name)] = (section, label, len(keys[section][label]))
+      keys[section][label].append(key)
+  writers = {}
+  for section, labels in keys.items():
+    writers[section] = ShardWriter(os.path.join(shard_dir, section))
+    for label, label_keys in labels.items():
+      writers[section].open(label, label_keys)
+
+  '''READ (ONE THREAD PER ARCHIVE), DECODE (POOL), WRITE (THIS THREAD)'''
+  max_pending = max_pending or 2 * max(num_workers, 1)
+  entries = queue.Queue(maxsize = max_pending * batch_size) # back-pressure on the readers
+  def read(archive):
+    try:
+      readers[archive].stream(names[archive], lambda name, data: entries.put((archive, name, data)))
+      entries.put(None)
+    except Exception as e:
+      entries.put(e)
+  threads = [threading.Thread(target = read, args = (archive,), daemon = True) for archive in range(len(readers))]
+  for thread in threads: thread.start()
+
+  pool = Pool(num_workers) if num_workers > 0 else None
+  pending = collections.deque()
+  def write(batch_locations, images):
+    for (section, label, row), image in zip(batch_locations, images):
+      writers[section].put(label, row, image)
+  try:
+    num_running = len(threads); batch = []
+    while num_running or batch:
+      item = entries.get() if num_running else None
+      if isinstance(item, Exception):
+        raise item
+      if item is None and num_running:
+        num_running -= 1
+      elif item is not None:
+        archive, name, data = item
+        batch.append((locations[(archive, name)], data))
+      if batch and (len(batch) == batch_size or not num_running):
+        batch_locations, batch_data = zip(*batch); batch = []
+        if pool:
+          pending.append((batch_locations, pool.apply_async(decode_batch, (list(batch_data),))))
+        else:
+          write(batch_locations, decode_batch(batch_data))
+      while pending and (len(pending) > max_pending or not num_running):
+        batch_locations, result = pending.popleft()
+        write(batch_locations, result.get())
+  finally:
+    if pool: pool.close(); pool.join()
+
+  counts = {}
+  for section, writer in writers.items():
+    entries_written = writer.close()
+    counts[section] = sum(len(entry['filenames']) for entry in entries_written.values())
+  return counts
@@ -1,4 +1,6 @@
 import torch
+import torch.distributed as dist
+import torch.nn as nn
 
 class GradReverse(torch.autograd.Function):
     '''GRL layer from https://arxiv.org/abs/1409.7495'''
@@ -17,4 +19,52 @@ class GradReverse(torch.autograd.Function):
         return ctx.lambd * grad_output.neg(), None
 
 def grad_reverse(x, lambd=0.5):
-    return GradReverse.apply(x, lambd)
\ No newline at end of file
+    return GradReverse.apply(x, lambd)
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+class AllReduceSum(torch.autograd.Function):
+    '''Sum of a tensor over the processes of a distributed run. It feeds the loss of every process, so its gradient is summed too'''
+
+    @staticmethod
+    def forward(ctx, x):
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_output = grad_output.clone()
+        dist.all_reduce(grad_output)
+        return grad_output
+
+
+class DistributedBatchNorm1d(nn.BatchNorm1d):
+    '''
+    BatchNorm1d over (N, C) inputs whose training statistics are those of the batches of all the processes of a distributed
+    run, like nn.SyncBatchNorm (which needs GPUs) but over any backend, gloo on the CPU included. Same parameters and buffers as
+    BatchNorm1d, and the same behaviour in a single process or in eval mode.
+    '''
+
+    def forward(self, x):
+        if not (self.training and is_distributed()):
+            return super().forward(x)
+        # one all-reduce of (sum, sum of squares, count), in float64 as the variance is E[x^2] - E[x]^2
+        num_features = x.shape[1]
+        local = x.double()
+        stats = AllReduceSum.apply(torch.cat([local.sum(0), (local * local).sum(0), local.new_full((1,), x.shape[0])]))
+        count = stats[-1]
+        mean = stats[:num_features] / count
+        var = stats[num_features:2 * num_features] / count - mean * mean
+
+        if self.track_running_stats:
+            with torch.no_grad():
+                self.num_batches_tracked += 1
+                momentum = self.momentum if self.momentum is not None else 1.0 / float(self.num_batches_tracked)
+                self.running_mean.mul_(1 - momentum).add_(momentum * mean.to(x.dtype))
+                self.running_var.mul_(1 - momentum).add_(momentum * (var * count / (count - 1)).to(x.dtype))
+
+        x = (x - mean.to(x.dtype)) * torch.rsqrt(var.to(x.dtype) + self.eps)
+        return x * self.weight + self.bias if self.affine else x
@@ -0,0 +1,108 @@
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+MANIFEST_FILE = 'manifest.npz'
+EXTENSIONS = {'photos': '.jpg', 'sketches': '.png'}
+MTIME_GRANULARITY_NS = 2 * 10**9 # coarsest common filesystem timestamp (FAT, some network filesystems)
+
+
+def scan_directory(directory, extension):
+  '''
+  (sorted file names with 'extension', sizes, mtimes in ns) of one class directory, and the directory's mtime. The mtime is
+  read before listing and reported as 0 (always stale) when it is too recent to tell apart from a change during the scan.
+  '''
+  directory_mtime = os.stat(directory).st_mtime_ns
+  if time.time_ns() - directory_mtime < MTIME_GRANULARITY_NS: directory_mtime = 0
+  entries = []
+  with os.scandir(directory) as it:
+    for entry in it:
+      if entry.name.endswith(extension) and not entry.name.startswith('.') and entry.is_file():
+        stat = entry.stat()
+        entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+  entries.sort()
+  return [name for name, _, _ in entries], [size for _, size, _ in entries], [mtime for _, _, mtime in entries], directory_mtime
+
+
+class DatasetManifest():
+  '''
+  File listing of the <data_dir>/<section>/<label> directories, cached as columns (names, sizes, mtimes and per-directory
+  offsets) in a single .npz file. A directory is listed again only when its mtime changed (files added, removed or renamed),
+  so a warm start costs one stat per directory instead of a glob. Directories are listed in 'num_workers' threads.
+  '''
+  def __init__(self, data_dir, manifest_path = None, num_workers = 8):
+    self.data_dir = data_dir
+    self.manifest_path = manifest_path or os.path.join(data_dir, MANIFEST_FILE)
+    self.num_workers = num_workers
+    self.directories = {} # 'section/label' -> (directory mtime, names, sizes, mtimes)
+    self.checked = set() # directories already validated by this process
+    if os.path.exists(self.manifest_path):
+      self.load()
+
+  def load(self):
+    with np.load(self.manifest_path) as manifest:
+      offsets = manifest['offsets']
+      names, sizes, mtimes = manifest['names'], manifest['sizes'], manifest['mtimes']
+      for i, (key, directory_mtime) in enumerate(zip(manifest['directories'].tolist(), manifest['directory_mtimes'].tolist())):
+        start, end = offsets[i], offsets[i + 1]
+        self.directories[key] = (directory_mtime, names[start:end].tolist(), sizes[start:end], mtimes[start:end])
+
+  def save(self):
+    keys = sorted(self.directories)
+    offsets = np.cumsum([0] + [len(self.directories[key][1]) for key in keys])
+    names = [name for key in keys for name in self.directories[key][1]]
+    temp_path = self.manifest_path + '.tmp.npz'
+    np.savez(temp_path, directories = np.array(keys, dtype = str), offsets = offsets.astype(np.int64),
+             directory_mtimes = np.array([self.directories[key][0] for key in keys], dtype = np.int64),
+             names = np.array(names, dtype = str),
+             sizes = np.concatenate([np.asarray(self.directories[key][2], dtype = np.int64) for key in keys] + [np.zeros(0, np.int64)]),
+             mtimes = np.concatenate([np.asarray(self.directories[key][3], dtype = np.int64) for key in keys] + [np.zeros(0, np.int64)]))
+    os.replace(temp_path, self.manifest_path)
+
+  def update(self, sections, labels):
+    '''Lists the directories of 'labels' in 'sections' that are new or changed since the manifest was written. Returns their number'''
+    keys = [section + '/' + label for section in sections for label in labels if section + '/' + label not in self.checked]
+
+    def stale(key):
+      try:
+        return key not in self.directories or os.stat(os.path.join(self.data_dir, key)).st_mtime_ns != self.directories[key][0]
+      except FileNotFoundError:
+        return True
+
+    def scan(key):
+      directory = os.path.join(self.data_dir, key)
+      if not os.path.isdir(directory): # same as the empty glob of a missing class
+        return key, (0, [], [], [])
+      names, sizes, mtimes, directory_mtime = scan_directory(directory, EXTENSIONS[key.split('/')[0]])
+      return key, (directory_mtime, names, sizes, mtimes)
+
+    pool = ThreadPool(self.num_workers) if self.num_workers > 1 else None
+    try:
+      run = pool.map if pool else lambda fn, items: list(map(fn, items))
+      stale_keys = [key for key, is_stale in zip(keys, run(stale, keys)) if is_stale]
+      for key, listing in run(scan, stale_keys):
+        self.directories[key] = listing
+      self.checked.update(keys)
+    finally:
+      if pool: pool.close(); pool.join()
+
+    if stale_keys:
+      try:
+        self.save()
+      except OSError as e: # e.g. a read-only dataset directory, the listing is still used for this run
+        print('Could not write the dataset manifest %s: %s' % (self.manifest_path, e))
+    return len(stale_keys)
+
+  def get_data_list(self, labels, label_to_index, section):
+    '''Same (filenames, class indices) as dataloader.get_data_list, from the manifest'''
+    self.update([section], labels)
+    filenames = []
+    classes = []
+    for label in labels:
+      directory = os.path.join(self.data_dir, section, label)
+      names = self.directories[section + '/' + label][1]
+      filenames.extend(os.path.join(directory, name) for name in names)
+      classes.extend([label_to_index[label]] * len(names))
+    return filenames, classes
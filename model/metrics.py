@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from model.retrieval import iter_distance_blocks
+
+
+def rank_relevance(query_labels, gallery_labels, ranked_indices):
+  '''Boolean matrix, True where the gallery item at each rank shares the label of the query'''
+  return np.asarray(gallery_labels)[ranked_indices] == np.expand_dims(np.asarray(query_labels), axis = 1)
+
+
+def average_precision(relevance, sorted_distances = None, num_relevant = None):
+  '''
+  AP of every row of a rank-sorted relevance matrix, without a python loop over the queries.
+  If 'sorted_distances' is given, items with equal distance are treated as one threshold, like sklearn's average_precision_score.
+  'num_relevant' defaults to the number of relevant items in the list; queries without relevant items get an AP of 0.
+  '''
+  relevance = np.asarray(relevance, dtype = bool)
+  num_queries, num_ranks = relevance.shape
+  true_positives = np.cumsum(relevance, axis = 1, dtype = np.float64)
+  precision = true_positives / np.arange(1, num_ranks + 1)
+
+  if sorted_distances is not None:
+    # every item is scored with the precision at the last rank of its group of ties
+    rank_indices = np.broadcast_to(np.arange(num_ranks), (num_queries, num_ranks))
+    is_group_end = np.ones((num_queries, num_ranks), dtype = bool)
+    is_group_end[:, :-1] = sorted_distances[:, 1:] != sorted_distances[:, :-1]
+    group_ends = np.where(is_group_end, rank_indices, num_ranks)
+    group_ends = np.flip(np.minimum.accumulate(np.flip(group_ends, axis = 1), axis = 1), axis = 1)
+    precision = np.take_along_axis(precision, group_ends, axis = 1)
+
+  if num_relevant is None:
+    num_relevant = true_positives[:, -1] if num_ranks > 0 else np.zeros(num_queries)
+  num_relevant = np.asarray(num_relevant, dtype = np.float64)
+
+  precision_sums = (precision * relevance).sum(axis = 1)
+  return np.divide(precision_sums, num_relevant, out = np.zeros(num_queries), where = num_relevant > 0)
+
+
+def precision_at_k(relevance, k):
+  '''Fraction of relevant items among the first k ranks of every row'''
+  return relevance[:, :k].sum(axis = 1) / float(k)
+
+
+def retrieval_metrics(query_features, gallery_features, query_labels, gallery_labels, ks = (200,), metric = 'l2', dtype = torch.float32, block_size = 256, device = None):
+  '''
+  AP over the full ranking and AP@k / precision@k for every query, computed 'block_size' queries at a time.
+  Returns a dict of per-query arrays: 'ap', and 'ap@k', 'precision@k' for each k in 'ks'.
+  '''
+  query_labels = np.asarray(query_labels); gallery_labels = np.asarray(gallery_labels)
+  results = {'ap': np.empty(len(query_labels))}
+  for k in ks:
+    results['ap@%d' % k] = np.empty(len(query_labels))
+    results['precision@%d' % k] = np.empty(len(query_labels))
+
+  for start, end, distances in iter_distance_blocks(query_features, gallery_features, metric, dtype, query_block_size = block_size, device = device):
+    ranked_indices = np.argsort(distances, axis = 1, kind = 'stable')
+    sorted_distances = np.take_along_axis(distances, ranked_indices, axis = 1)
+    relevance = rank_relevance(query_labels[start:end], gallery_labels, ranked_indices)
+
+    results['ap'][start:end] = average_precision(relevance, sorted_distances)
+    for k in ks:
+      results['ap@%d' % k][start:end] = average_precision(relevance[:, :k], sorted_distances[:, :k])
+      results['precision@%d' % k][start:end] = precision_at_k(relevance, k)
+
+  return results
+
+
+def per_class_mean(values, labels, num_classes = None):
+  '''Mean of a per-query metric for every class index; NaN for classes without queries'''
+  labels = np.asarray(labels)
+  sums = np.bincount(labels, weights = values, minlength = num_classes or 0)
+  counts = np.bincount(labels, minlength = num_classes or 0)
+  return np.divide(sums, counts, out = np.full(len(sums), np.nan), where = counts > 0)
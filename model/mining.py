@@ -0,0 +1,48 @@
+import torch
+
+MINING_MODES = ('batch_hard', 'semi_hard')
+
+
+def mine_triplets(sketch_features, image_features, labels, margin = 1.0, mode = 'batch_hard', class_similarity = None):
+  '''
+  Picks a positive and a negative photo among the photos already in the batch for every sketch (anchor).
+  Row i of 'image_features' is the photo paired with sketch i, 'labels' holds the class index of every pair.
+
+  batch_hard: the farthest photo of the anchor's class is the positive, negatives are the other-class photos violating the margin.
+  semi_hard: the paired photo is the positive, negatives are the other-class photos with d(a, p) < d(a, n) < d(a, p) + margin.
+
+  One negative is sampled per anchor among its candidates, with probability proportional to the word vector similarity
+  of the two classes ('class_similarity', num_classes x num_classes; uniform if None), so closer classes stay more likely
+  to be chosen. Anchors without any candidate take their closest other-class photo.
+  Returns (positive_indices, negative_indices) into 'image_features'.
+  '''
+  if mode not in MINING_MODES:
+    raise ValueError('Unknown mining mode %s, expected one of %s' % (mode, str(MINING_MODES)))
+
+  with torch.no_grad():
+    distances = torch.cdist(sketch_features.float(), image_features.float())
+    same_class = labels.unsqueeze(1) == labels.unsqueeze(0)
+
+    '''POSITIVES'''
+    if mode == 'batch_hard':
+      positive_indices = distances.masked_fill(~same_class, float('-inf')).argmax(dim = 1)
+    else:
+      positive_indices = torch.arange(distances.shape[0], device = distances.device)
+    positive_distances = distances.gather(1, positive_indices.unsqueeze(1))
+
+    '''NEGATIVE CANDIDATES'''
+    candidates = ~same_class & (distances < positive_distances + margin)
+    if mode == 'semi_hard':
+      candidates &= distances > positive_distances
+
+    weights = candidates.float()
+    if class_similarity is not None:
+      weights *= class_similarity[labels][:, labels].float()
+
+    '''SAMPLING'''
+    has_candidates = weights.sum(dim = 1) > 0
+    sampled = torch.multinomial(torch.where(has_candidates.unsqueeze(1), weights, torch.ones_like(weights)), 1).squeeze(1)
+    hardest = distances.masked_fill(same_class, float('inf')).argmin(dim = 1)
+    negative_indices = torch.where(has_candidates, sampled, hardest)
+
+  return positive_indices, negative_indices
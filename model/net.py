@@ -1,18 +1,188 @@
+import contextlib
+import copy
+import inspect
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision
+from torch.utils.checkpoint import checkpoint_sequential
 
-class BasicModel(nn.Module):
-  '''Main model for the triplet loss objective'''
-  def __init__(self):
+from model.layers import DistributedBatchNorm1d
+
+# the reentrant variant is the only one older torch versions have, newer ones warn unless it is asked for explicitly
+CHECKPOINT_KWARGS = {'use_reentrant': True} if 'use_reentrant' in inspect.signature(checkpoint_sequential).parameters else {}
+
+
+def run_segments(layers, x, segments):
+  '''
+  layers(x) for an nn.Sequential. With segments > 1 in training, only the activations at the boundaries of 'segments'
+  chunks of layers are kept and the rest are recomputed during the backward pass (the last chunk is not checkpointed).
+  '''
+  if segments <= 1 or not (layers.training and torch.is_grad_enabled()):
+    return layers(x)
+  # reentrant checkpointing only backpropagates into a segment whose input requires grad, the images never do
+  if not x.requires_grad: x = x.detach().requires_grad_()
+  return checkpoint_sequential(layers, segments, x, **CHECKPOINT_KWARGS)
+
+
+FROZEN_BLOCKS = (0, 1, 2, 3)
+
+def frozen_prefix_length(layers, frozen_blocks):
+  '''Number of leading DenseNet layers up to and including the transition after dense block 'frozen_blocks' (0: none)'''
+  if frozen_blocks not in FROZEN_BLOCKS:
+    raise ValueError('frozen_blocks must be one of %s' % str(FROZEN_BLOCKS))
+  if frozen_blocks == 0:
+    return 0
+  return [name for name, _ in layers.named_children()].index('transition%d' % frozen_blocks) + 1
+
+
+LAYER_VIEWS = ('prefix_layers', 'suffix_layers')
+
+def drop_layer_views(module, state_dict, prefix, local_metadata):
+  '''state_dict hook: the weights of the layer views are saved under the backbone's name only'''
+  for key in [key for key in state_dict if key.startswith(tuple(prefix + view + '.' for view in LAYER_VIEWS))]:
+    del state_dict[key]
+
+
+class FrozenPrefixMixin():
+  '''
+  Freezes the first 'num_frozen' layers of 'self.<backbone attribute>': no gradients, batch norm statistics kept in eval mode
+  (so the prefix is a fixed function of the image and its outputs can be cached, see model.feature_cache), and run without
+  autograd. forward_suffix() runs the rest of the model from cached prefix outputs.
+  The backbone layers before and after num_frozen are registered once as 'prefix_layers' and 'suffix_layers' (tracing,
+  as in model/export.py, needs every module called to be a submodule). They hold the backbone's layers, whose state_dict
+  keys stay those of the backbone.
+  '''
+  def freeze_prefix(self, num_frozen):
+    self.num_frozen = num_frozen
+    self.prefix_layers = self.backbone()[:num_frozen]
+    self.suffix_layers = self.backbone()[num_frozen:]
+    self._register_state_dict_hook(drop_layer_views)
+    self._register_load_state_dict_pre_hook(self.fill_layer_views)
+    for param in self.frozen_prefix().parameters():
+      param.requires_grad = False
+    self.train(self.training)
+
+  def fill_layer_views(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+    '''load_state_dict pre-hook: the layer views are loaded from the backbone's entries'''
+    backbone_prefix = prefix + [name for name, module in self._modules.items() if module is self.backbone()][0]
+    for key in [key for key in state_dict if key.startswith(backbone_prefix + '.')]:
+      layer = key[len(backbone_prefix) + 1:].split('.')[0]
+      view = 'prefix_layers' if layer in self.prefix_layers._modules else 'suffix_layers'
+      state_dict[prefix + view + key[len(backbone_prefix):]] = state_dict[key]
+
+  def frozen_prefix(self):
+    return self.prefix_layers
+
+  def train(self, mode = True):
+    super().train(mode)
+    self.frozen_prefix().eval()
+    return self
+
+  def run_prefix(self, x):
+    if self.num_frozen == 0:
+      return x
+    with torch.no_grad():
+      return self.frozen_prefix()(x)
+
+
+INIT_FUNCTIONS = ('uniform_', 'normal_', 'constant_', 'ones_', 'zeros_', 'kaiming_uniform_', 'kaiming_normal_', 'xavier_uniform_', 'xavier_normal_')
+
+@contextlib.contextmanager
+def skip_weight_init():
+  '''Makes the torch.nn.init functions no-ops while models are built: their weights are left as allocated (torch.empty)'''
+  saved = {name: getattr(nn.init, name) for name in INIT_FUNCTIONS}
+  for name in saved: setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+  try:
+    yield
+  finally:
+    for name, function in saved.items(): setattr(nn.init, name, function)
+
+
+def densenet_features(pretrained = True):
+  '''
+  DenseNet-121 feature layers with the ImageNet weights. pretrained = False neither reads (or downloads) the ImageNet
+  weights nor initialises the layers, for models a checkpoint is loaded into right after.
+  '''
+  if pretrained:
+    return torchvision.models.densenet121(pretrained = True, progress = False).features
+  with skip_weight_init():
+    return torchvision.models.densenet121(pretrained = False).features
+
+
+class BasicModel(FrozenPrefixMixin, nn.Module):
+  '''
+  Main model for the triplet loss objective. frozen_blocks: DenseNet blocks kept frozen (FrozenPrefixMixin).
+  pretrained = False: uninitialised weights, to be loaded from a checkpoint (densenet_features)
+  '''
+  def __init__(self, checkpoint_segments = 0, frozen_blocks = 0, pretrained = True):
     super(BasicModel, self).__init__()
-    self.net = torchvision.models.densenet121(pretrained = True, progress = False).features
+    self.net = densenet_features(pretrained)
     self.last_layer = torch.nn.MaxPool2d((7,7)) 
+    self.checkpoint_segments = checkpoint_segments
+    self.freeze_prefix(frozen_prefix_length(self.net, frozen_blocks))
+  def backbone(self):
+    return self.net
   def forward(self, x):
-    return self.last_layer(self.net(x)).view(x.shape[0], -1)
-  
+    return self.forward_suffix(self.run_prefix(x))
+  def forward_suffix(self, x):
+    return self.last_layer(run_segments(self.suffix_layers, x, self.checkpoint_segments)).view(x.shape[0], -1)
+
+
+class DomainBranch(FrozenPrefixMixin, nn.Module):
+  '''
+  Sketch or photo model of the shared-trunk variant: a DenseNet-121 trunk (up to the last transition layer) shared by
+  both domains, followed by a domain-specific last dense block. Same output as BasicModel.
+  '''
+  def __init__(self, trunk, head, checkpoint_segments = 0, frozen_blocks = 0):
+    super(DomainBranch, self).__init__()
+    self.trunk = trunk
+    self.head = head
+    self.last_layer = torch.nn.MaxPool2d((7,7))
+    self.checkpoint_segments = checkpoint_segments
+    self.freeze_prefix(frozen_prefix_length(self.trunk, frozen_blocks))
+  def backbone(self):
+    return self.trunk
+  def forward(self, x):
+    return self.forward_suffix(self.run_prefix(x))
+  def forward_suffix(self, x):
+    return self.last_layer(self.head(run_segments(self.suffix_layers, x, self.checkpoint_segments))).view(x.shape[0], -1)
+
+
+ARCHITECTURES = ('two_tower', 'shared_trunk')
+
+def build_models(architecture = 'two_tower', checkpoint_segments = 0, frozen_blocks = 0, pretrained = True):
+  '''
+  Returns (image_model, sketch_model). checkpoint_segments > 1 enables activation checkpointing of the backbone
+  in that many segments during training (less activation memory for about one more forward pass per step).
+  frozen_blocks: 1-3 freezes the DenseNet layers up to the transition after that dense block (FrozenPrefixMixin).
+  pretrained = False: uninitialised backbones, for models a checkpoint is loaded into (faster, and works offline).
+  two_tower: two independent DenseNet-121s.
+  shared_trunk: both models hold the same trunk module and only the last dense block (+ final norm) is per domain,
+  about 70% of the DenseNet-121 weights are shared. Both state_dicts contain the trunk, so each model loads on its own;
+  torch.save writes the shared tensors once.
+  '''
+  if architecture == 'two_tower':
+    return BasicModel(checkpoint_segments, frozen_blocks, pretrained), BasicModel(checkpoint_segments, frozen_blocks, pretrained)
+  if architecture != 'shared_trunk':
+    raise ValueError('Unknown architecture %s' % architecture)
+  features = densenet_features(pretrained)
+  trunk = features[:-2]
+  head = nn.Sequential(features.denseblock4, features.norm5)
+  return DomainBranch(trunk, head, checkpoint_segments, frozen_blocks), DomainBranch(trunk, copy.deepcopy(head), checkpoint_segments, frozen_blocks)
+
+
+def unique_parameters(*models):
+  '''Trainable parameters of the models, each once (the shared trunk must not be stepped twice by the optimizer)'''
+  params = []; seen = set()
+  for model in models:
+    for param in model.parameters():
+      if param.requires_grad and id(param) not in seen:
+        seen.add(id(param)); params.append(param)
+  return params
+
   
 def cosine_similarity_loss(x, y):
   cosine_similarity = x.unsqueeze(1).bmm(y.unsqueeze(2)).squeeze()
@@ -50,25 +220,26 @@ class DomainAdversarialNet(nn.Module):
   This model acts as an adversary to the main model. Tries to classify domains(sketch/image). This enables the main model
   to embed the sketch and image in the same space(i.e. making sure that the distributions of the data(the last layer) generated
   from both the image and sketch model to be similar).
+  In distributed training its batch norm statistics are computed over the batches of all the processes (DistributedBatchNorm1d).
   '''
 
   def __init__(self):
     super(DomainAdversarialNet, self).__init__()
     self.net = nn.Sequential(
       nn.Linear(1024, 1024),
-      nn.BatchNorm1d(1024),
+      DistributedBatchNorm1d(1024),
       nn.ReLU(inplace = True),
 
       nn.Linear(1024, 1024),
-      nn.BatchNorm1d(1024),      
+      DistributedBatchNorm1d(1024),      
       nn.ReLU(inplace = True),
 
       nn.Linear(1024, 1024),
-      nn.BatchNorm1d(1024),
+      DistributedBatchNorm1d(1024),
       nn.ReLU(inplace = True),
 
       nn.Linear(1024, 1024),
-      nn.BatchNorm1d(1024),
+      DistributedBatchNorm1d(1024),
       nn.ReLU(inplace = True),
 
       nn.Linear(1024, 1)
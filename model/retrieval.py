@@ -0,0 +1,115 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+METRICS = ('l2', 'cosine')
+DTYPES = {'float32': torch.float32, 'float16': torch.float16}
+
+
+def get_block(features, start, end, metric = 'l2', dtype = torch.float32, device = None):
+  '''
+  Slices rows [start, end) of a numpy array / memmap / tensor of embeddings, moves them to 'device' in 'dtype'.
+  Only the slice is copied, so the full matrix can stay memory-mapped on disk.
+  '''
+  block = features[start:end]
+  if isinstance(block, np.ndarray):
+    block = torch.from_numpy(np.array(block, dtype = np.float32))
+  block = block.to(device = device, dtype = torch.float32)
+  if metric == 'cosine':
+    block = F.normalize(block, p = 2, dim = 1)
+  return block.to(dtype)
+
+
+def pairwise_distances(queries, gallery, metric = 'l2'):
+  '''
+  Distances between two blocks of embeddings through a single matrix multiply.
+  l2: ||q||^2 - 2 q.g + ||g||^2 (same ranking as the minkowski p=2 cdist used before), cosine: 1 - q.g on normalised rows.
+  Always returns float32.
+  '''
+  if queries.device.type == 'cpu' and queries.dtype == torch.float16:
+    # half precision matmul is not implemented on every CPU build, the fp16 rounding of the inputs is kept
+    queries, gallery = queries.float(), gallery.float()
+
+  products = torch.mm(queries, gallery.t()).float()
+  if metric == 'cosine':
+    return 1.0 - products
+
+  query_norms = queries.float().pow(2).sum(dim = 1, keepdim = True)
+  gallery_norms = gallery.float().pow(2).sum(dim = 1).unsqueeze(0)
+  return (query_norms - 2.0 * products + gallery_norms).clamp_(min = 0.0).sqrt_()
+
+
+def _check_args(metric, dtype):
+  if metric not in METRICS:
+    raise ValueError('Unknown metric %s, expected one of %s' % (metric, str(METRICS)))
+  if isinstance(dtype, str):
+    if dtype not in DTYPES:
+      raise ValueError('Unknown dtype %s, expected one of %s' % (dtype, str(list(DTYPES))))
+    dtype = DTYPES[dtype]
+  return dtype
+
+
+def iter_distance_blocks(queries, gallery, metric = 'l2', dtype = torch.float32, query_block_size = 256, gallery_block_size = 8192, device = None):
+  '''
+  Yields (start, end, distances) where 'distances' is a float32 numpy array of shape (end - start, len(gallery)).
+  Peak memory is query_block_size x len(gallery) instead of len(queries) x len(gallery).
+  '''
+  dtype = _check_args(metric, dtype)
+  device = device or torch.device('cpu')
+  num_queries, num_gallery = len(queries), len(gallery)
+
+  for q_start in range(0, num_queries, query_block_size):
+    q_end = min(q_start + query_block_size, num_queries)
+    query_block = get_block(queries, q_start, q_end, metric, dtype, device)
+    distances = np.empty((q_end - q_start, num_gallery), dtype = np.float32)
+    for g_start in range(0, num_gallery, gallery_block_size):
+      g_end = min(g_start + gallery_block_size, num_gallery)
+      gallery_block = get_block(gallery, g_start, g_end, metric, dtype, device)
+      distances[:, g_start:g_end] = pairwise_distances(query_block, gallery_block, metric).cpu().numpy()
+    yield q_start, q_end, distances
+
+
+def topk_search(queries, gallery, k, metric = 'l2', dtype = torch.float32, query_block_size = 1024, gallery_block_size = 8192, device = None):
+  '''
+  Exact k nearest gallery rows for every query, computed block by block with a running top-k per query.
+  Returns (distances, indices) as numpy arrays of shape (len(queries), k), nearest first.
+  Peak memory is query_block_size x gallery_block_size, independent of the number of queries and gallery rows.
+  '''
+  dtype = _check_args(metric, dtype)
+  device = device or torch.device('cpu')
+  num_queries, num_gallery = len(queries), len(gallery)
+  k = min(k, num_gallery)
+
+  all_distances = np.empty((num_queries, k), dtype = np.float32)
+  all_indices = np.empty((num_queries, k), dtype = np.int64)
+  if k == 0:
+    return all_distances, all_indices
+
+  for q_start in range(0, num_queries, query_block_size):
+    q_end = min(q_start + query_block_size, num_queries)
+    query_block = get_block(queries, q_start, q_end, metric, dtype, device)
+
+    best_distances, best_indices = None, None
+    for g_start in range(0, num_gallery, gallery_block_size):
+      g_end = min(g_start + gallery_block_size, num_gallery)
+      gallery_block = get_block(gallery, g_start, g_end, metric, dtype, device)
+      distances = pairwise_distances(query_block, gallery_block, metric)
+
+      '''PARTIAL SELECTION WITHIN THE BLOCK'''
+      block_distances, block_indices = torch.topk(distances, min(k, g_end - g_start), dim = 1, largest = False, sorted = False)
+      block_indices += g_start
+
+      '''MERGE WITH THE RUNNING TOP-K'''
+      if best_distances is not None:
+        block_distances = torch.cat([best_distances, block_distances], dim = 1)
+        block_indices = torch.cat([best_indices, block_indices], dim = 1)
+        block_distances, order = torch.topk(block_distances, min(k, block_distances.shape[1]), dim = 1, largest = False, sorted = False)
+        block_indices = torch.gather(block_indices, 1, order)
+      best_distances, best_indices = block_distances, block_indices
+
+    best_distances, order = torch.sort(best_distances, dim = 1)
+    best_indices = torch.gather(best_indices, 1, order)
+    all_distances[q_start:q_end] = best_distances.cpu().numpy()
+    all_indices[q_start:q_end] = best_indices.cpu().numpy()
+
+  return all_distances, all_indices
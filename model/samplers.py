@@ -0,0 +1,129 @@
+import numpy as np
+
+
+def build_alias_table(probabilities):
+  '''
+  Walker's alias tables for sampling from every row of a (num_rows x n) probability matrix in constant time.
+  Returns (prob, alias): pick i uniformly, keep it with probability prob[row, i], else take alias[row, i].
+  '''
+  probabilities = np.asarray(probabilities, dtype = np.float64)
+  num_rows, n = probabilities.shape
+  prob = np.zeros((num_rows, n)); alias = np.zeros((num_rows, n), dtype = np.int64)
+
+  for row in range(num_rows):
+    scaled = probabilities[row] * n / probabilities[row].sum()
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+      s, l = small.pop(), large.pop()
+      prob[row, s] = scaled[s]; alias[row, s] = l
+      scaled[l] -= 1.0 - scaled[s]
+      (small if scaled[l] < 1.0 else large).append(l)
+    for i in small + large: # only numerical leftovers, which are ~1
+      prob[row, i] = 1.0; alias[row, i] = i
+
+  return prob, alias
+
+
+def sample_alias(prob, alias, row):
+  i = np.random.randint(prob.shape[1])
+  return i if np.random.random_sample() < prob[row, i] else alias[row, i]
+
+
+class TripletSampler():
+  '''
+  Constant-time sampling of the positive image and the negative class of a training triplet.
+  Images are grouped per class once (contiguous index arrays), and the negative class distribution of every class
+  (the other classes, weighted by word vector similarity) is turned into alias tables once.
+  '''
+  def __init__(self, image_label_idxs, word_vectors_similarity):
+    image_label_idxs = np.asarray(image_label_idxs)
+    num_classes = word_vectors_similarity.shape[0]
+
+    '''PER-CLASS IMAGE INDICES'''
+    self.image_order = np.argsort(image_label_idxs, kind = 'stable')
+    self.class_counts = np.bincount(image_label_idxs, minlength = num_classes)
+    self.class_offsets = np.concatenate([[0], np.cumsum(self.class_counts)[:-1]])
+
+    '''NEGATIVE CLASS DISTRIBUTIONS'''
+    # hard negative mining - closer classes(more similarity value) have a higher probability of selection
+    negative_probabilities = np.array(word_vectors_similarity, dtype = np.float64)
+    np.fill_diagonal(negative_probabilities, 0.0)
+    negative_probabilities /= np.linalg.norm(negative_probabilities, ord = 1, axis = 1, keepdims = True)
+    self.negative_prob, self.negative_alias = build_alias_table(negative_probabilities)
+
+  def random_image(self, label_idx):
+    '''Index of a uniformly random image of class 'label_idx' '''
+    return self.image_order[self.class_offsets[label_idx] + np.random.randint(self.class_counts[label_idx])]
+
+  def negative_label(self, label_idx):
+    return sample_alias(self.negative_prob, self.negative_alias, label_idx)
+
+
+class PKBatchSampler():
+  '''
+  Class-balanced batches for in-batch triplet mining: every batch holds 'classes_per_batch' distinct classes (P)
+  with 'samples_per_class' sketches each (K), drawn with replacement when a class has fewer than K sketches.
+  An epoch has as many batches as the sketches fill (len(sketches) // (P x K)), divided among 'num_replicas' processes
+  in distributed training (each process draws its own batches from its own np.random stream).
+  '''
+  def __init__(self, sketch_label_idxs, classes_per_batch, samples_per_class, num_replicas = 1):
+    sketch_label_idxs = np.asarray(sketch_label_idxs)
+    self.classes = np.unique(sketch_label_idxs)
+    if classes_per_batch < 2 or classes_per_batch > len(self.classes):
+      raise ValueError('classes_per_batch must be between 2 and the number of classes (%d), got %d' % (len(self.classes), classes_per_batch))
+    self.classes_per_batch = classes_per_batch
+    self.samples_per_class = samples_per_class
+    self.class_sketch_idxs = {label: np.flatnonzero(sketch_label_idxs == label) for label in self.classes}
+    self.num_batches = len(sketch_label_idxs) // (classes_per_batch * samples_per_class * num_replicas)
+
+  def __iter__(self):
+    for _ in range(self.num_batches):
+      batch = []
+      for label in np.random.choice(self.classes, self.classes_per_batch, replace = False):
+        sketch_idxs = self.class_sketch_idxs[label]
+        batch.extend(np.random.choice(sketch_idxs, self.samples_per_class, replace = len(sketch_idxs) < self.samples_per_class).tolist())
+      yield batch
+
+  def __len__(self):
+    return self.num_batches
+
+
+class ResumableBatchSampler():
+  '''
+  Wraps a batch sampler so an epoch can be resumed: the epoch's batches are drawn when it starts, remaining(n) returns
+  the batches after the first n (saved in a checkpoint) and resume(batches) makes the next epoch yield exactly those.
+  The index lists are small next to the data, and DataLoader prefetching does not affect what counts as consumed.
+  '''
+  def __init__(self, batch_sampler):
+    self.batch_sampler = batch_sampler
+    self.batches = []
+    self.resume_batches = None
+
+  def __iter__(self):
+    if self.resume_batches is not None:
+      self.batches, self.resume_batches = self.resume_batches, None
+    else:
+      self.batches = [list(batch) for batch in self.batch_sampler]
+    return iter(self.batches)
+
+  def __len__(self):
+    return len(self.batch_sampler)
+
+  def remaining(self, num_consumed):
+    return self.batches[num_consumed:]
+
+  def resume(self, batches):
+    self.resume_batches = [list(batch) for batch in batches]
+
+  def set_epoch(self, epoch):
+    '''Passed on to a DistributedSampler, whose shuffle is seeded with the epoch so that every process shuffles the same way'''
+    sampler = getattr(self.batch_sampler, 'sampler', None)
+    if hasattr(sampler, 'set_epoch'): sampler.set_epoch(epoch)
+
+  def skip(self, num_consumed):
+    '''
+    Distributed counterpart of resume(): a checkpoint only holds rank 0's batches, so every process draws its batches of the
+    epoch again (the same ones from a DistributedSampler after set_epoch, new random ones from PKBatchSampler) without the first num_consumed
+    '''
+    self.resume_batches = [list(batch) for batch in self.batch_sampler][num_consumed:]
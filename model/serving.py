@@ -0,0 +1,86 @@
+import asyncio
+import collections
+import time
+
+import numpy as np
+
+
+class LatencyStats():
+  '''Request latencies (last 'window' requests) and throughput counters of the retrieval service'''
+  def __init__(self, window = 10000):
+    self.latencies = collections.deque(maxlen = window)
+    self.start_time = time.time()
+    self.num_requests = 0
+    self.num_errors = 0
+    self.num_batches = 0
+    self.num_batched_items = 0
+
+  def record_request(self, latency, error = False):
+    self.latencies.append(latency)
+    self.num_requests += 1
+    self.num_errors += int(error)
+
+  def record_batch(self, batch_size):
+    self.num_batches += 1
+    self.num_batched_items += batch_size
+
+  def summary(self):
+    latencies_ms = 1000.0 * np.array(self.latencies) if self.latencies else np.zeros(1)
+    elapsed = time.time() - self.start_time
+    return {'requests': self.num_requests, 'errors': self.num_errors, 'uptime_s': elapsed,
+            'throughput_qps': self.num_requests / elapsed if elapsed > 0 else 0.0,
+            'latency_p50_ms': float(np.percentile(latencies_ms, 50)), 'latency_p99_ms': float(np.percentile(latencies_ms, 99)),
+            'batches': self.num_batches, 'mean_batch_size': self.num_batched_items / max(self.num_batches, 1)}
+
+
+class MicroBatcher():
+  '''
+  Groups concurrent requests into batches for 'batch_fn' (called in a worker thread with a list of items, returns a list of
+  results or exceptions in the same order). A batch is dispatched once it has 'max_batch_size' items or when the oldest item
+  has waited 'max_wait_ms', whichever comes first.
+  '''
+  def __init__(self, batch_fn, max_batch_size = 32, max_wait_ms = 5.0, stats = None):
+    self.batch_fn = batch_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000.0
+    self.stats = stats
+    self.queue = None
+
+  def start(self):
+    '''Starts the dispatch loop on the running event loop'''
+    self.queue = asyncio.Queue()
+    return asyncio.ensure_future(self.run())
+
+  async def submit(self, item):
+    future = asyncio.get_event_loop().create_future()
+    await self.queue.put((item, future))
+    return await future
+
+  async def run(self):
+    loop = asyncio.get_event_loop()
+    while True:
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.max_wait
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      items = [item for item, _ in batch]
+      try:
+        results = await loop.run_in_executor(None, self.batch_fn, items)
+      except Exception as e:
+        results = [e] * len(batch)
+      if self.stats: self.stats.record_batch(len(batch))
+
+      for (_, future), result in zip(batch, results):
+        if future.done(): # the client went away
+          continue
+        if isinstance(result, Exception):
+          future.set_exception(result)
+        else:
+          future.set_result(result)
@@ -0,0 +1,95 @@
+import copy
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+
+from model.metrics import retrieval_metrics
+
+WORKER = {} # state of a pool process, set by init_worker
+
+
+def serialize_model(model):
+  '''Picklable CPU copy of a model; TorchScript models (export.py) go through torch.jit.save'''
+  if isinstance(model, torch.jit.ScriptModule):
+    buffer = io.BytesIO()
+    torch.jit.save(model, buffer)
+    return ('script', buffer.getvalue())
+  return ('module', copy.deepcopy(model).cpu())
+
+
+def deserialize_model(spec):
+  kind, value = spec
+  model = torch.jit.load(io.BytesIO(value), map_location = 'cpu') if kind == 'script' else value
+  return model.eval()
+
+
+def init_worker(models, datasets, num_threads):
+  torch.set_num_threads(num_threads)
+  WORKER['models'] = {section: deserialize_model(spec) for section, spec in models.items()}
+  WORKER['datasets'] = datasets
+
+
+def encode_shard(job):
+  section, indices, batch_size = job
+  dataloader = torch.utils.data.DataLoader(torch.utils.data.Subset(WORKER['datasets'][section], indices), batch_size = batch_size, shuffle = False)
+  with torch.no_grad():
+    features = [WORKER['models'][section](images) for images, _ in dataloader]
+  return torch.cat(features, dim = 0).numpy() if features else np.zeros((0, 0), dtype = np.float32)
+
+
+def score_shard(job):
+  '''retrieval_metrics of a slice of the queries against the whole (memory-mapped) gallery'''
+  directory, start, end, kwargs = job
+  queries = np.load(os.path.join(directory, 'queries.npy'), mmap_mode = 'r')
+  query_labels = np.load(os.path.join(directory, 'query_labels.npy'))
+  gallery = np.load(os.path.join(directory, 'gallery.npy'), mmap_mode = 'r')
+  gallery_labels = np.load(os.path.join(directory, 'gallery_labels.npy'))
+  return retrieval_metrics(queries[start:end], gallery, query_labels[start:end], gallery_labels, device = torch.device('cpu'), **kwargs)
+
+
+def split(num_items, num_shards):
+  '''Contiguous (start, end) ranges covering num_items'''
+  bounds = np.linspace(0, num_items, num_shards + 1).astype(int)
+  return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+class ShardedEvaluator():
+  '''
+  A pool of 'num_workers' CPU processes, each with its own copy of the photo/sketch models and 'threads_per_worker'
+  intra-op threads (default: the parent's thread count divided among the workers).
+  encode() splits a dataset into contiguous shards, one per worker. retrieval_metrics() splits the queries: every worker
+  ranks its queries against the whole gallery (shared through a memory-mapped file), so AP over the full ranking is the
+  same as in a single process.
+  '''
+  def __init__(self, image_model, sketch_model, datasets, num_workers, threads_per_worker = None):
+    self.num_workers = num_workers
+    threads_per_worker = threads_per_worker or max(1, torch.get_num_threads() // num_workers)
+    models = {'photos': serialize_model(image_model), 'sketches': serialize_model(sketch_model)}
+    # spawn: the parent may hold CUDA or OpenMP state that does not survive fork
+    self.pool = multiprocessing.get_context('spawn').Pool(num_workers, initializer = init_worker, initargs = (models, datasets, threads_per_worker))
+
+  def encode(self, section, indices, batch_size):
+    indices = list(indices)
+    jobs = [(section, indices[start:end], batch_size) for start, end in split(len(indices), self.num_workers)]
+    shards = [shard for shard in self.pool.map(encode_shard, jobs) if len(shard)]
+    return np.concatenate(shards, axis = 0) if shards else np.zeros((0, 0), dtype = np.float32)
+
+  def retrieval_metrics(self, query_features, gallery_features, query_labels, gallery_labels, **kwargs):
+    directory = tempfile.mkdtemp(prefix = 'sharded_eval_')
+    try:
+      for name, array in [('queries', query_features), ('query_labels', query_labels), ('gallery', gallery_features), ('gallery_labels', gallery_labels)]:
+        np.save(os.path.join(directory, name + '.npy'), np.asarray(array))
+      jobs = [(directory, start, end, kwargs) for start, end in split(len(query_features), self.num_workers)]
+      results = self.pool.map(score_shard, jobs)
+    finally:
+      shutil.rmtree(directory, ignore_errors = True)
+    return {name: np.concatenate([result[name] for result in results]) for name in results[0]}
+
+  def close(self):
+    self.pool.close()
+    self.pool.join()
@@ -0,0 +1,145 @@
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = 224
+INDEX_FILE = 'index.json'
+
+
+def decode_image(filename):
+  '''Same decoding as the datasets: RGB, resized to IMAGE_SIZE x IMAGE_SIZE, as a uint8 HWC array'''
+  return np.asarray(Image.open(filename).convert('RGB').resize((IMAGE_SIZE, IMAGE_SIZE)), dtype = np.uint8)
+
+
+class ShardWriter():
+  '''
+  Per-class shards of one section whose images arrive in any order: open() a class with its filenames, put() each decoded
+  image at its row, then close() renames the complete shards into place and adds them to the index.
+  '''
+  def __init__(self, section_dir):
+    self.section_dir = section_dir
+    if not os.path.isdir(section_dir): os.makedirs(section_dir)
+    self.shards = {} # label -> [filenames, memmap, number of rows written]
+
+  def open(self, label, filenames):
+    temp_path = os.path.join(self.section_dir, label + '.npy.tmp.npy')
+    shard = np.lib.format.open_memmap(temp_path, mode = 'w+', dtype = np.uint8, shape = (len(filenames), IMAGE_SIZE, IMAGE_SIZE, 3))
+    self.shards[label] = [list(filenames), shard, 0]
+
+  def put(self, label, row, image):
+    self.shards[label][1][row] = image
+    self.shards[label][2] += 1
+
+  def finish(self, label):
+    '''Closes the shard of 'label'. Returns its index entry'''
+    filenames, shard, num_written = self.shards.pop(label)
+    if num_written != len(filenames):
+      raise ValueError('Shard %s of %s got %d of its %d images' % (label, self.section_dir, num_written, len(filenames)))
+    shard_file = label + '.npy'
+    shard.flush(); del shard
+    os.replace(os.path.join(self.section_dir, shard_file + '.tmp.npy'), os.path.join(self.section_dir, shard_file))
+    return {'shard': shard_file, 'filenames': filenames}
+
+  def close(self):
+    entries = {label: self.finish(label) for label in list(self.shards)}
+    write_index(self.section_dir, entries)
+    return entries
+
+
+def write_shard(section_dir, label, filenames, images):
+  '''
+  Writes the decoded 'images' (iterable of uint8 HWC arrays, one per filename) of one class to <section_dir>/<label>.npy.
+  Returns the index entry of the shard.
+  '''
+  writer = ShardWriter(section_dir)
+  writer.open(label, filenames)
+  for i, image in enumerate(images):
+    writer.put(label, i, image)
+  return writer.finish(label)
+
+
+def write_index(section_dir, entries):
+  '''entries: {label: entry returned by write_shard}. Merged into an existing index, so classes can be (re)built separately'''
+  index_path = os.path.join(section_dir, INDEX_FILE)
+  index = {}
+  if os.path.exists(index_path):
+    with open(index_path) as f:
+      index = json.load(f)
+  index.update(entries)
+  with open(index_path + '.tmp', 'w') as f:
+    json.dump(index, f)
+  os.replace(index_path + '.tmp', index_path)
+
+
+def build_shards(section_dir, files_by_label, num_workers = 0):
+  '''
+  Decodes and resizes every file once and packs each class into a memory-mappable shard.
+  files_by_label: {label: [filenames]}. Decoding runs in 'num_workers' processes (in this process if 0).
+  '''
+  if not os.path.isdir(section_dir): os.makedirs(section_dir)
+  pool = Pool(num_workers) if num_workers > 0 else None
+  entries = {}
+  try:
+    for label, filenames in files_by_label.items():
+      images = pool.imap(decode_image, filenames, chunksize = 16) if pool else map(decode_image, filenames)
+      entries[label] = write_shard(section_dir, label, filenames, images)
+      print('Packed %d images of class %s' % (len(filenames), label))
+  finally:
+    if pool: pool.close(); pool.join()
+  write_index(section_dir, entries)
+
+
+class ShardReader():
+  '''
+  Read access to the shards of one section (<shard_dir>/<section>). Shards are memory-mapped lazily,
+  so every DataLoader worker maps them on first use, and an image is a zero-copy slice of its shard.
+  '''
+  def __init__(self, shard_dir, section):
+    self.section_dir = os.path.join(shard_dir, section)
+    with open(os.path.join(self.section_dir, INDEX_FILE)) as f:
+      self.index = json.load(f)
+    self.locations = {filename: (label, row) for label, entry in self.index.items() for row, filename in enumerate(entry['filenames'])}
+    self.shards = {}
+    self.stamps = {}
+
+  def get_data_list(self, labels, label_to_index):
+    '''Same output as dataloader.get_data_list, read from the index instead of globbing the class directories'''
+    filenames = []
+    classes = []
+    for label in labels:
+      if label not in self.index:
+        raise KeyError('Class %s is missing from the shards in %s' % (label, self.section_dir))
+      cur_label_filenames = self.index[label]['filenames']
+      filenames.extend(cur_label_filenames)
+      classes.extend([label_to_index[label]] * len(cur_label_filenames))
+    return filenames, classes
+
+  def get_shard(self, label):
+    if label not in self.shards:
+      # copy-on-write mapping: the slices are writable (as torch expects) without ever touching the file
+      self.shards[label] = np.load(os.path.join(self.section_dir, self.index[label]['shard']), mmap_mode = 'c')
+    return self.shards[label]
+
+  def stamp(self, filename):
+    '''
+    Change stamp of 'filename' (its key may not be a path on disk, e.g. when streamed from the archives): the mtime of its
+    class's shard, which is replaced as a whole when the class is packed again
+    '''
+    label, _ = self.locations[filename]
+    if label not in self.stamps:
+      self.stamps[label] = os.stat(os.path.join(self.section_dir, self.index[label]['shard'])).st_mtime_ns
+    return self.stamps[label]
+
+  def read(self, filename):
+    '''uint8 HWC array of 'filename', as decoded by decode_image'''
+    label, row = self.locations[filename]
+    return self.get_shard(label)[row]
+
+  def __getstate__(self):
+    # memory maps are not sent to DataLoader workers, they are reopened there
+    state = self.__dict__.copy()
+    state['shards'] = {}
+    return state
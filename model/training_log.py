@@ -0,0 +1,136 @@
+import datetime
+import json
+import os
+import time
+
+import pytz
+import torch
+
+STAGES = ('data', 'transfer', 'forward', 'domain', 'backward', 'optimizer')
+
+
+class StageTimer():
+  '''
+  Wall-clock time of the stages of a training iteration. On a GPU the device is synchronized at every stage boundary,
+  otherwise asynchronous kernels would be charged to whichever stage waits for them.
+  '''
+  def __init__(self, device):
+    self.synchronize = device.type == 'cuda'
+    self.times = {}
+    self.stage_start = None
+
+  def start(self):
+    self.times = {}
+    self.stage_start = time.time()
+
+  def mark(self, stage):
+    '''Ends 'stage', which began at the previous mark (or start)'''
+    if self.synchronize: torch.cuda.synchronize()
+    now = time.time()
+    self.times[stage] = self.times.get(stage, 0.0) + now - self.stage_start
+    self.stage_start = now
+
+
+class TrainingLogger():
+  '''
+  Per-iteration JSONL records (losses as python floats, stage times) and a console summary every 'print_every' iterations
+  (0: nothing is printed, as on the processes other than rank 0 of a distributed run).
+  profile_windows: list of (first, last) global iterations to trace with torch.profiler, written to 'profile_dir'
+  as Chrome traces (chrome://tracing or Perfetto).
+  '''
+  def __init__(self, log_file = None, print_every = 10, profile_windows = None, profile_dir = 'profiles', device = None):
+    self.log = open(log_file, 'a', buffering = 1) if log_file else None # line-buffered: every record is on disk as soon as it is logged
+    self.print_every = print_every
+    self.profile_windows = sorted(profile_windows or [])
+    self.profile_dir = profile_dir
+    self.activities = None
+    if self.profile_windows:
+      from torch.profiler import profile, ProfilerActivity # torch >= 1.8.1
+      self.profile = profile
+      self.activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device is not None and device.type == 'cuda' else [])
+    self.profiler = None
+    self.profiler_window = None
+    self.start_epoch(0)
+
+  def start_epoch(self, epoch):
+    self.epoch = epoch
+    self.epoch_start_time = time.time()
+    self.loss_sums = {}; self.stage_sums = {}
+    self.num_items = 0; self.num_iterations = 0
+    self.validation_time = 0.0
+
+  def before_iteration(self, global_iteration):
+    for window in self.profile_windows:
+      if window[0] == global_iteration and self.profiler is None:
+        if not os.path.isdir(self.profile_dir): os.makedirs(self.profile_dir)
+        self.profiler = self.profile(activities = self.activities, record_shapes = True)
+        self.profiler.__enter__(); self.profiler_window = window
+
+  def log_iteration(self, iteration, num_batches, global_iteration, batch_size, losses, stage_times):
+    '''losses: {name: detached scalar tensor or float}, batch means'''
+    losses = {name: float(value) for name, value in losses.items()}
+    for name, value in losses.items():
+      self.loss_sums[name] = self.loss_sums.get(name, 0.0) + value * batch_size
+    for stage, value in stage_times.items():
+      self.stage_sums[stage] = self.stage_sums.get(stage, 0.0) + value
+    self.num_items += batch_size; self.num_iterations += 1
+
+    if self.log:
+      record = {'epoch': self.epoch, 'iteration': iteration, 'global_iteration': global_iteration, 'time': time.time(), 'batch_size': batch_size}
+      record.update(losses)
+      record.update({'time_' + stage: value for stage, value in stage_times.items()})
+      self.log.write(json.dumps(record) + '\n')
+
+    if self.profiler is not None and global_iteration >= self.profiler_window[1]:
+      self.stop_profiler()
+
+    if self.print_every and iteration % self.print_every == 0:
+      self.print_summary(iteration, num_batches, losses)
+
+  def log_validation(self, global_iteration, results):
+    '''results: model.validation.Validator.run output'''
+    self.validation_time += results['time']
+    if self.log:
+      record = {'epoch': self.epoch, 'global_iteration': global_iteration, 'time': time.time()}
+      record.update({'validation_' + name: value for name, value in results.items()})
+      self.log.write(json.dumps(record) + '\n')
+    print('Validation at iteration %d: mAP %f (CI %f - %f); %.1fs, validation is %.1f%% of the training time'
+          % (global_iteration, results['mAP'], results['mAP_low'], results['mAP_high'], results['time'], 100 * results['fraction']))
+
+  def stop_profiler(self):
+    self.profiler.__exit__(None, None, None)
+    self.profiler.export_chrome_trace(os.path.join(self.profile_dir, 'trace_%d_%d.json' % tuple(self.profiler_window)))
+    self.profiler = None
+
+  def averages(self):
+    '''(mean losses per item, mean stage times per iteration) over the epoch so far'''
+    return ({name: value / self.num_items for name, value in self.loss_sums.items()},
+            {stage: value / self.num_iterations for stage, value in self.stage_sums.items()})
+
+  def print_summary(self, iteration, num_batches, losses):
+    average_losses, average_times = self.averages()
+    iteration_time = sum(average_times.values())
+    eta_cur_epoch = str(datetime.timedelta(seconds = int(iteration_time * (num_batches - iteration))))
+    print(datetime.datetime.now(pytz.timezone('America/Los_Angeles')).replace(microsecond = 0), end = ' ')
+    print('Epoch: %d [%d / %d] ; eta: %s' % (self.epoch, iteration, num_batches, eta_cur_epoch))
+    print('; '.join('%s: %f(%f)' % (name, losses[name], average_losses[name]) for name in losses))
+    print('Time per iteration: %.3fs (%s)' % (iteration_time, '; '.join('%s %.0f%%' % (stage, 100 * average_times[stage] / max(iteration_time, 1e-12))
+                                                                          for stage in STAGES if stage in average_times)))
+
+  def end_epoch(self, peak_memory):
+    average_losses, average_times = self.averages()
+    elapsed = time.time() - self.epoch_start_time
+    if self.log:
+      record = {'epoch': self.epoch, 'epoch_time': elapsed, 'validation_time': self.validation_time, 'peak_memory_mb': peak_memory}
+      record.update({'mean_' + name: value for name, value in average_losses.items()})
+      record.update({'mean_time_' + stage: value for stage, value in average_times.items()})
+      self.log.write(json.dumps(record) + '\n')
+    if self.print_every:
+      print('Epoch %d complete, time taken: %s (validation %.1f%%); peak memory: %.0f MB'
+            % (self.epoch, str(datetime.timedelta(seconds = int(elapsed))), 100 * self.validation_time / max(elapsed, 1e-12), peak_memory))
+
+  def close(self):
+    if self.profiler is not None:
+      self.stop_profiler()
+    if self.log:
+      self.log.close(); self.log = None
@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+import torch
+
+from model.metrics import retrieval_metrics
+
+
+def stratified_subset(label_idxs, per_class, seed = 0):
+  '''Sorted indices of (at most) 'per_class' items of every class, the same for a given seed'''
+  label_idxs = np.asarray(label_idxs)
+  rng = np.random.RandomState(seed)
+  indices = [rng.permutation(np.flatnonzero(label_idxs == label))[:per_class] for label in np.unique(label_idxs)]
+  return np.sort(np.concatenate(indices)) if indices else np.zeros(0, dtype = np.int64)
+
+
+def bootstrap_ci(values, labels, num_resamples = 1000, confidence = 0.95, seed = 0):
+  '''
+  Percentile confidence interval of the mean of 'values' (per-query APs), resampling the queries of each class with
+  replacement so every resample keeps the class balance of the subset
+  '''
+  values = np.asarray(values, dtype = np.float64); labels = np.asarray(labels)
+  rng = np.random.RandomState(seed)
+  sums = np.zeros(num_resamples)
+  for label in np.unique(labels):
+    class_values = values[labels == label]
+    sums += class_values[rng.randint(0, len(class_values), size = (num_resamples, len(class_values)))].sum(axis = 1)
+  means = sums / len(values)
+  tail = 100.0 * (1.0 - confidence) / 2
+  return float(np.percentile(means, tail)), float(np.percentile(means, 100.0 - tail))
+
+
+class Validator():
+  '''
+  mAP on a fixed stratified subset of the test classes ('per_class' sketches and photos of each), with a bootstrap
+  confidence interval. The subset is decoded once and its image tensors are kept in memory, so a validation costs
+  only the forward passes and the batched retrieval of model.metrics.retrieval_metrics.
+  max_fraction bounds the time spent validating: due() turns False while validation took more than that fraction of
+  the training time so far.
+  '''
+  def __init__(self, dataloaders, per_class = 10, batch_size = 32, every = 0, max_fraction = 0.1, metric = 'l2', num_resamples = 1000, seed = 0):
+    self.dataloaders = dataloaders
+    self.per_class = per_class
+    self.batch_size = batch_size
+    self.every = every
+    self.max_fraction = max_fraction
+    self.metric = metric
+    self.num_resamples = num_resamples
+    self.seed = seed
+    self.inputs = None
+    self.validation_time = 0.0
+    self.start_time = time.time()
+    self.last_iteration = None
+
+  def load_inputs(self):
+    '''{section: (images, label indices)} of the subset, decoded once'''
+    self.inputs = {}
+    for section in ['photos', 'sketches']:
+      dataset = self.dataloaders.get_test_dataloader(batch_size = self.batch_size, section = section).dataset
+      indices = stratified_subset(dataset.label_idxs, self.per_class, self.seed)
+      dataloader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices.tolist()), batch_size = self.batch_size, shuffle = False)
+      with torch.random.fork_rng(devices = []): # the loader draws a seed, training (and a resumed run) must not see it
+        batches = list(dataloader)
+      self.inputs[section] = (torch.cat([images for images, _ in batches]), torch.cat([label_idxs for _, label_idxs in batches]).numpy())
+
+  def due(self, global_iteration, end_of_epoch = False):
+    '''every > 0: every 'every' iterations, otherwise at the end of every epoch; skipped while over the time budget'''
+    if self.every > 0:
+      if global_iteration - (self.last_iteration if self.last_iteration is not None else -1) < self.every:
+        return False
+    elif not end_of_epoch:
+      return False
+    return self.validation_time <= self.max_fraction * (time.time() - self.start_time - self.validation_time)
+
+  def encode(self, model, section, device):
+    images, _ = self.inputs[section]
+    with torch.no_grad():
+      return torch.cat([model(images[start:start + self.batch_size].to(device)).cpu() for start in range(0, len(images), self.batch_size)]).numpy()
+
+  def run(self, image_model, sketch_model, device, global_iteration):
+    '''Returns {'mAP', 'mAP_low', 'mAP_high', 'time', 'fraction'}, the models are put back in their previous mode'''
+    start_time = time.time()
+    if self.inputs is None: self.load_inputs()
+    modes = (image_model.training, sketch_model.training)
+    image_model.eval(); sketch_model.eval()
+    try:
+      photo_features = self.encode(image_model, 'photos', device)
+      sketch_features = self.encode(sketch_model, 'sketches', device)
+    finally:
+      image_model.train(modes[0]); sketch_model.train(modes[1])
+    sketch_labels = self.inputs['sketches'][1]
+    average_precisions = retrieval_metrics(sketch_features, photo_features, sketch_labels, self.inputs['photos'][1], ks = (), metric = self.metric, device = device)['ap']
+    low, high = bootstrap_ci(average_precisions, sketch_labels, self.num_resamples, seed = self.seed)
+
+    elapsed = time.time() - start_time
+    self.validation_time += elapsed
+    self.last_iteration = global_iteration
+    training_time = time.time() - self.start_time - self.validation_time
+    return {'mAP': float(average_precisions.mean()), 'mAP_low': low, 'mAP_high': high, 'time': elapsed,
+            'fraction': self.validation_time / max(training_time, 1e-12)}
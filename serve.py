@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from PIL import Image
+import torch
+
+from model.net import BasicModel, build_models, ARCHITECTURES
+from model.checkpoints import lazy_load
+from model.export import load_exported_model
+from model.dataloader import get_test_transforms
+from model.retrieval import topk_search, METRICS
+from model.gallery_index import GalleryIndex, LOG_FILE
+from model.serving import LatencyStats, MicroBatcher
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class RetrievalService():
+  '''
+  Sketch-to-photo retrieval over a precomputed photo embedding matrix (memory-mapped) or a gallery index (update_gallery.py),
+  whose updates are picked up before each batch. The sketch model is loaded once; queries arrive through a MicroBatcher so
+  the forward pass runs on batches.
+  '''
+  def __init__(self, checkpoint, gallery_dir, max_k = 100, metric = 'l2', exported_model = None, architecture = 'two_tower'):
+    if exported_model:
+      # TorchScript (possibly int8) model written by export.py, CPU only
+      self.device = torch.device('cpu')
+      self.sketch_model = load_exported_model(exported_model)
+    else:
+      self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+      pretrained = not checkpoint
+      self.sketch_model = BasicModel(pretrained = pretrained) if architecture == 'two_tower' else build_models(architecture, pretrained = pretrained)[1]
+      if checkpoint:
+        self.sketch_model.load_state_dict(lazy_load(checkpoint)['sketch_model'])
+    self.sketch_model = self.sketch_model.to(self.device).eval()
+    self.transforms = get_test_transforms()
+
+    # a gallery index, an embedding store entry (embeddings.npy + manifest.json) or an evaluate.py --save_embeddings directory
+    self.index = None
+    if os.path.exists(os.path.join(gallery_dir, LOG_FILE)):
+      self.index = GalleryIndex(gallery_dir)
+      self.gallery = self.index.snapshot()
+    elif os.path.exists(os.path.join(gallery_dir, 'embeddings.npy')):
+      self.gallery = np.load(os.path.join(gallery_dir, 'embeddings.npy'), mmap_mode = 'r')
+      with open(os.path.join(gallery_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+      self.paths = [entry['path'] for entry in manifest]; self.labels = [entry['label'] for entry in manifest]
+    else:
+      self.gallery = np.load(os.path.join(gallery_dir, 'photo_embeddings.npy'), mmap_mode = 'r')
+      self.paths = None; self.labels = np.load(os.path.join(gallery_dir, 'photo_labels.npy')).tolist()
+    print('Loaded %d photo embeddings from %s' % (len(self.gallery), gallery_dir))
+
+    self.max_k = max_k
+    self.metric = metric
+    self.stats = LatencyStats()
+
+  def query_batch(self, items):
+    '''items: list of (sketch image bytes, k). Returns one result dict (or exception) per item'''
+    results = [None] * len(items)
+    sketches = []; valid = []
+    for i, (image_bytes, k) in enumerate(items):
+      try:
+        sketches.append(self.transforms(Image.open(io.BytesIO(image_bytes)).convert('RGB').resize((224,224))))
+        valid.append(i)
+      except Exception as e:
+        results[i] = ValueError('Could not decode the sketch: %s' % e)
+    if not valid:
+      return results
+
+    with torch.no_grad():
+      features = self.sketch_model(torch.stack(sketches).to(self.device))
+    k = max(items[i][1] for i in valid)
+    if self.index:
+      # one snapshot for the whole batch, an update of the index during the search does not change its results
+      self.index.refresh()
+      snapshot = self.index.snapshot()
+      distances, indices = snapshot.search(features, k, metric = self.metric, device = self.device)
+      labels, paths = snapshot.labels, snapshot.paths
+    else:
+      distances, indices = topk_search(features, self.gallery, k, metric = self.metric, device = self.device)
+      labels = lambda rows: [self.labels[j] for j in rows]
+      paths = (lambda rows: [self.paths[j] for j in rows]) if self.paths else None
+
+    for row, i in enumerate(valid):
+      k = items[i][1]
+      result = {'indices': indices[row, :k].tolist(), 'distances': distances[row, :k].tolist(), 'labels': labels(indices[row, :k])}
+      if paths: result['paths'] = paths(indices[row, :k])
+      results[i] = result
+    return results
+
+
+async def handle_request(service, batcher, method, target, body):
+  '''Returns (status, payload) for one HTTP request'''
+  url = urlparse(target)
+  if url.path == '/stats':
+    return 200, service.stats.summary()
+  if url.path != '/query':
+    return 404, {'error': 'unknown path %s' % url.path}
+  if method != 'POST':
+    return 405, {'error': 'POST the sketch image as the request body'}
+
+  try:
+    k = int(parse_qs(url.query).get('k', ['10'])[0])
+  except ValueError:
+    return 400, {'error': 'k must be an integer'}
+  if k < 1 or k > service.max_k:
+    return 400, {'error': 'k must be between 1 and %d' % service.max_k}
+
+  try:
+    return 200, await batcher.submit((body, k))
+  except ValueError as e:
+    return 400, {'error': str(e)}
+
+
+async def serve_connection(service, batcher, reader, writer):
+  '''Minimal HTTP/1.1 with keep-alive: request line, headers, Content-Length body'''
+  loop = asyncio.get_event_loop()
+  try:
+    while True:
+      request_line = await reader.readline()
+      if not request_line:
+        break
+      start_time = loop.time()
+      method, target = request_line.decode('latin-1').split()[:2]
+      headers = {}
+      while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+          break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+      body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+      try:
+        status, payload = await handle_request(service, batcher, method, target, body)
+      except Exception as e:
+        status, payload = 500, {'error': str(e)}
+      if target.startswith('/query'):
+        service.stats.record_request(loop.time() - start_time, error = status != 200)
+
+      data = json.dumps(payload).encode('utf-8')
+      keep_alive = headers.get('connection', '').lower() != 'close'
+      writer.write(('HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n'
+                    % (status, HTTP_REASONS[status], len(data), 'keep-alive' if keep_alive else 'close')).encode('latin-1') + data)
+      await writer.drain()
+      if not keep_alive:
+        break
+  except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+    pass
+  finally:
+    writer.close()
+
+
+async def main(args):
+  service = RetrievalService(args.model, args.gallery, max_k = args.max_k, metric = args.metric, exported_model = args.exported_model, architecture = args.architecture)
+  batcher = MicroBatcher(service.query_batch, max_batch_size = args.max_batch_size, max_wait_ms = args.max_wait_ms, stats = service.stats)
+  batcher.start()
+
+  handler = lambda reader, writer: serve_connection(service, batcher, reader, writer)
+  if args.unix_socket:
+    server = await asyncio.start_unix_server(handler, path = args.unix_socket)
+    print('Serving on unix socket %s' % args.unix_socket)
+  else:
+    server = await asyncio.start_server(handler, host = args.host, port = args.port)
+    print('Serving on http://%s:%d' % (args.host, args.port))
+  async with server:
+    await server.serve_forever()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Sketch-to-photo retrieval service. POST a sketch image to /query?k=10, GET /stats for latency/throughput')
+  parser.add_argument('--model', help='Model checkpoint path')
+  parser.add_argument('--architecture', help='Architecture of the checkpoint (train.py architecture)', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--exported_model', help='TorchScript sketch model written by export.py, used instead of --model')
+  parser.add_argument('--gallery', help='Photo embeddings: a gallery index (update_gallery.py), an embedding store entry (<store>/<hash>) or an evaluate.py --save_embeddings directory', required = True)
+  parser.add_argument('--host', default = '127.0.0.1')
+  parser.add_argument('--port', type=int, default = 8000)
+  parser.add_argument('--unix_socket', help='Listen on this unix socket instead of TCP')
+  parser.add_argument('--max_batch_size', type=int, help='Maximum number of sketches per forward pass', default = 32)
+  parser.add_argument('--max_wait_ms', type=float, help='Maximum time a query waits for its batch to fill', default = 5.0)
+  parser.add_argument('--max_k', type=int, help='Largest k a query may ask for', default = 100)
+  parser.add_argument('--metric', choices = METRICS, default = 'l2')
+
+  args = parser.parse_args()
+  asyncio.run(main(args))
@@ -2,18 +2,94 @@
 Guide for usage:
 In your terminal, run the command:
 
-python download_gdrive.py GoogleFileID /path/for/this/file/to/download/file.type
+python download_gdrive.py GoogleFileID /path/for/this/file/to/download/file.type [--sha256 HASH]
 
-Credited to 
+Downloads go to <file>.part first and are resumed with an HTTP Range request after a dropped connection (or when the
+command is run again), then checked against --sha256 if given and renamed to <file>.
+
+Credited to
 https://stackoverflow.com/questions/25010369/wget-curl-large-file-from-google-drive
 author: https://stackoverflow.com/users/1475331/user115202
 '''
 
+import hashlib
+import os
+import time
+
 import requests
 
 from tqdm import tqdm
 
-def download_file_from_google_drive(id, destination):
+GOOGLE_DRIVE_URL = "https://docs.google.com/uc?export=download"
+CHUNK_SIZE = 32768
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout)
+
+
+def sha256sum(path, chunk_size = 1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_url(url, destination, params = None, session = None, sha256 = None, max_retries = 5, retry_wait = 1.0, position = None):
+    '''
+    Streams 'url' to destination + '.part', resuming from its current size with a Range request (servers without range
+    support send the whole file again). A dropped connection is retried up to 'max_retries' times in a row with exponential
+    backoff. The complete file is checked against 'sha256' (if given) before it is renamed to 'destination'.
+    An existing 'destination' with the right checksum is not downloaded again.
+    '''
+    if os.path.exists(destination) and (sha256 is None or sha256sum(destination) == sha256.lower()):
+        return destination
+    session = session or requests.Session()
+    part_path = destination + '.part'
+    failures = 0
+
+    with tqdm(unit = 'B', unit_scale = True, unit_divisor = 1024, desc = os.path.basename(destination), position = position) as bar:
+        while True:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+            received = 0
+            try:
+                with session.get(url, params = params, headers = headers, stream = True, timeout = 60) as response:
+                    if response.status_code == 416:  # nothing left after 'offset', the part file is complete
+                        break
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        offset = 0
+                    length = response.headers.get('Content-Length')
+                    bar.total = offset + int(length) if length is not None else None
+                    bar.n = offset; bar.refresh()
+
+                    with open(part_path, 'ab' if offset else 'wb') as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            if chunk:  # filter out keep-alive new chunks
+                                f.write(chunk)
+                                received += len(chunk)
+                                bar.update(len(chunk))
+                if length is None or received >= int(length):
+                    break
+                raise requests.exceptions.ChunkedEncodingError('connection closed after %d of %s bytes' % (received, length))
+            except RETRY_ERRORS as e:
+                failures = 1 if received else failures + 1  # only attempts without any progress count against max_retries
+                if failures > max_retries:
+                    raise
+                wait = retry_wait * 2 ** (failures - 1)
+                bar.write('%s: %s, resuming in %.0fs' % (os.path.basename(destination), e, wait))
+                time.sleep(wait)
+
+    if sha256 is not None:
+        digest = sha256sum(part_path)
+        if digest != sha256.lower():
+            os.remove(part_path)
+            raise ValueError('Checksum mismatch for %s: expected %s, got %s' % (destination, sha256, digest))
+    os.replace(part_path, destination)
+    return destination
+
+
+def download_file_from_google_drive(id, destination, session = None, **kwargs):
+    '''Resolves the large-file confirmation token of Google Drive, then download_url'''
     def get_confirm_token(response):
         for key, value in response.cookies.items():
             if key.startswith('download_warning'):
@@ -21,37 +97,25 @@ def download_file_from_google_drive(id, destination):
 
         return None
 
-    def save_response_content(response, destination):
-        CHUNK_SIZE = 32768
-
-        with open(destination, "wb") as f:
-            with tqdm(unit='B', unit_scale=True, unit_divisor=1024) as bar:
-                for chunk in response.iter_content(CHUNK_SIZE):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        bar.update(CHUNK_SIZE)
-
-    URL = "https://docs.google.com/uc?export=download"
-
-    session = requests.Session()
+    session = session or requests.Session()
 
-    response = session.get(URL, params = { 'id' : id }, stream = True)
-    token = get_confirm_token(response)
+    params = { 'id' : id }
+    with session.get(GOOGLE_DRIVE_URL, params = params, stream = True) as response:
+        token = get_confirm_token(response)
 
     if token:
-        params = { 'id' : id, 'confirm' : token }
-        response = session.get(URL, params = params, stream = True)
+        params['confirm'] = token
 
-    save_response_content(response, destination)    
+    return download_url(GOOGLE_DRIVE_URL, destination, params = params, session = session, **kwargs)
 
 
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) != 3:
-        print("Usage: python google_drive.py drive_file_id destination_file_path")
-    else:
-        # TAKE ID FROM SHAREABLE LINK
-        file_id = sys.argv[1]
-        # DESTINATION FILE ON YOUR DISK
-        destination = sys.argv[2]
-        download_file_from_google_drive(file_id, destination)
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Resumable download of a Google Drive file')
+    # TAKE ID FROM SHAREABLE LINK
+    parser.add_argument('file_id', help = 'Google Drive file id')
+    # DESTINATION FILE ON YOUR DISK
+    parser.add_argument('destination', help = 'Destination file path')
+    parser.add_argument('--sha256', help = 'Expected SHA-256 of the file')
+    args = parser.parse_args()
+    download_file_from_google_drive(args.file_id, args.destination, sha256 = args.sha256)
@@ -0,0 +1,91 @@
+'''
+Local HTTP stand-in for the dataset host, to test download_data.py without the network:
+
+python src/mirror_server.py DIRECTORY [--port 8001] [--drop_every BYTES]
+python download_data.py --path_dataset /tmp/Dataset --base_url http://127.0.0.1:8001
+
+Serves the files of DIRECTORY with Range support and a SHA256SUMS listing of them. --drop_every closes every response
+after that many bytes, so each download has to be resumed.
+'''
+
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import threading
+
+
+def write_checksums(directory):
+    '''Writes DIRECTORY/SHA256SUMS ("<hash>  <name>" lines, as sha256sum does) for every file of DIRECTORY'''
+    lines = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name != 'SHA256SUMS' and os.path.isfile(path):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            lines.append('%s  %s\n' % (digest.hexdigest(), name))
+    with open(os.path.join(directory, 'SHA256SUMS'), 'w') as f:
+        f.writelines(lines)
+
+
+def make_handler(directory, drop_every = None):
+    class MirrorHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            path = os.path.join(directory, os.path.basename(self.path.split('?')[0]))
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(path)
+            start = 0
+            match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, size - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(size - start))
+            self.end_headers()
+
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(drop_every) if drop_every else f.read()
+            self.wfile.write(data)
+            if drop_every and start + len(data) < size:
+                self.close_connection = True  # a dropped connection: fewer bytes than Content-Length
+
+        def log_message(self, format, *args):
+            pass
+
+    return MirrorHandler
+
+
+def start_mirror(directory, port = 0, drop_every = None):
+    '''Serves DIRECTORY from a background thread. Returns (server, base URL); stop with server.shutdown()'''
+    write_checksums(directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), make_handler(directory, drop_every))
+    threading.Thread(target = server.serve_forever, daemon = True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local HTTP mirror of the dataset archives')
+    parser.add_argument('directory', help = 'Directory holding Sketchy.7z and extended_photo.zip')
+    parser.add_argument('--port', type = int, default = 8001)
+    parser.add_argument('--drop_every', type = int, help = 'Close every response after this many bytes')
+    args = parser.parse_args()
+    server, base_url = start_mirror(args.directory, args.port, args.drop_every)
+    print('Serving %s on %s' % (args.directory, base_url))
+    threading.Event().wait()
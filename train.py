@@ -1,5 +1,7 @@
+import os
 import time
 import datetime
+import functools
 import pytz 
 import argparse
 
@@ -10,76 +12,249 @@ import torch.nn.functional as F
 import torchvision.utils as vutils 
 
 
-from model.net import BasicModel, DomainAdversarialNet
+from model.net import build_models, unique_parameters, DomainAdversarialNet, ARCHITECTURES
 from model.dataloader import Dataloaders
 from model.layers import grad_reverse
+from model.mining import mine_triplets, MINING_MODES
+from model.training_log import TrainingLogger, StageTimer
+from model.checkpoints import CheckpointManager, get_rng_state, set_rng_state
+from model.validation import Validator
+from model.feature_cache import FeatureCache
+from model.autotune import autotune
+from model.distributed import init_distributed, barrier, shared_seed, seed_rank, TrainingModules, data_parallel
 from evaluate import evaluate
 from utils import *
 
 class Trainer():
-  def __init__(self, data_dir):
-    self.dataloaders = Dataloaders(data_dir)
+  def __init__(self, data_dir, shard_dir = None, num_workers = 0, prefetch_factor = 2):
+    self.dataloaders = Dataloaders(data_dir, shard_dir = shard_dir, num_workers = num_workers, pin_memory = torch.cuda.is_available(),
+                                   prefetch_factor = prefetch_factor, persistent_workers = num_workers > 0)
     self.train_dict = self.dataloaders.train_dict
     self.test_dict = self.dataloaders.test_dict
   
   #def train_and_evaluate(self, config, checkpoint=None):
-  def train_and_evaluate(self, checkpoint=None):
+  def train_and_evaluate(self, checkpoint=None, sampling='triplet', classes_per_batch=8, samples_per_class=4, architecture='two_tower',
+                         batch_size=32, accumulation_steps=1, checkpoint_segments=0,
+                         log_file=None, print_every=10, profile_windows=None, profile_dir='profiles',
+                         checkpoint_dir='checkpoints', save_every=0, keep_last=3,
+                         validate_every=0, validation_per_class=10, validation_budget=0.1,
+                         frozen_blocks=0, feature_cache_dir=None, backend='gloo'):
+    '''
+    checkpoint: checkpoint to resume from; checkpoints written by this version continue the epoch at the batch they stopped
+    checkpoint_dir: written in the background every save_every iterations (0: at the end of every epoch only), the last
+    keep_last are kept (model.checkpoints.CheckpointManager)
+    validate_every: iterations between validations (0: at the end of every epoch) on validation_per_class sketches and photos of
+    each test class (0: no validation), skipped while they took more than validation_budget of the training time
+    (model.validation.Validator). Every validation saves a checkpoint with its mAP, the best one is best.pth.tar
+    batch_size: triplets per batch, or 'auto' for the throughput-optimal batch size and number of threads of this host and
+    configuration within the memory limit (model.autotune.autotune, probed once then read from its cache; triplet sampling only)
+    accumulation_steps: number of consecutive batches whose gradients are summed before each optimizer step
+    (effective batch size batch_size x accumulation_steps, or P x K x accumulation_steps with in-batch mining)
+    checkpoint_segments: > 1 recomputes the backbone activations in backward instead of storing them (model.net.run_segments)
+    log_file: JSONL file for per-iteration losses and stage times (model.training_log.TrainingLogger), printed every print_every
+    profile_windows: list of (first, last) iterations to trace with torch.profiler into profile_dir
+    architecture: 'two_tower' (a DenseNet-121 per domain) or 'shared_trunk' (shared backbone, per-domain last dense block)
+    frozen_blocks: 1-3 freezes the DenseNet-121 layers up to the transition after that dense block; with feature_cache_dir
+    their outputs for every training photo and sketch are computed once and cached (model.feature_cache.FeatureCache),
+    and training only runs the layers after them
+    sampling: 'triplet' loads a negative photo for every sketch (3 forward passes per triplet);
+    'batch_hard'/'semi_hard' load classes_per_batch x samples_per_class sketch/photo pairs and mine the negatives among the batch's photos
+    backend: torch.distributed backend of the processes started by torchrun or model.distributed.launch_local (WORLD_SIZE > 1),
+    which train together with DistributedDataParallel: each one trains on its share of every epoch (batch_size triplets per
+    process and batch) with its own sampling RNGs, and only rank 0 logs, validates and writes checkpoints
+    '''
     #batch_size = config['batch_size']
-    batch_size = 32
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
-    train_dataloader = self.dataloaders.get_train_dataloader(batch_size = batch_size, shuffle=True) 
-    num_batches = len(train_dataloader) 
+    rank, world_size = init_distributed(backend)
+    distributed = world_size > 1; main_process = rank == 0
+    if distributed:
+      if batch_size == 'auto':
+        raise ValueError("batch_size = 'auto' is not supported in distributed training")
+      if checkpoint_segments:
+        raise ValueError('checkpoint_segments is not supported in distributed training (the recomputation reruns the gradient hooks)')
+      if torch.cuda.is_available():
+        device = torch.device('cuda', int(os.environ.get('LOCAL_RANK', 0))); torch.cuda.set_device(device)
+
+    if sampling != 'triplet' and sampling not in MINING_MODES:
+      raise ValueError('Unknown sampling %s' % sampling)
+
+    if batch_size == 'auto':
+      if sampling != 'triplet':
+        raise ValueError("batch_size = 'auto' tunes the triplet batch, %s sampling loads classes_per_batch x samples_per_class pairs" % sampling)
+      # with a feature cache, the probes time the layers after the frozen blocks on their cached outputs
+      mode = 'train_suffix' if frozen_blocks and feature_cache_dir else 'train'
+      setting = autotune(mode, functools.partial(build_models, architecture, checkpoint_segments, frozen_blocks, False), device,
+                         name = 'build_models:%s:segments%d:frozen%d' % (architecture, checkpoint_segments, frozen_blocks))
+      batch_size = setting['batch_size']; torch.set_num_threads(setting['num_threads'])
+      print('Autotuned batch size %d, %d threads' % (batch_size, setting['num_threads']))
 
-    image_model = BasicModel().to(device)
-    sketch_model = BasicModel().to(device) 
+    if architecture not in ARCHITECTURES:
+      raise ValueError('Unknown architecture %s' % architecture)
+    image_model, sketch_model = build_models(architecture, checkpoint_segments = checkpoint_segments, frozen_blocks = frozen_blocks, pretrained = not checkpoint)
+    image_model = image_model.to(device)
+    sketch_model = sketch_model.to(device) 
     
     domain_net = DomainAdversarialNet().to(device)    
 
-    params = [param for param in image_model.parameters() if param.requires_grad == True]
-    params.extend([param for param in sketch_model.parameters() if param.requires_grad == True]) 
-    params.extend([param for param in domain_net.parameters() if param.requires_grad == True]) 
+    params = unique_parameters(image_model, sketch_model, domain_net)
     #optimizer = torch.optim.Adam(params, lr=config['lr'])
     optimizer = torch.optim.Adam(params, 0.001)
 
     criterion = nn.TripletMarginLoss(margin = 1.0, p = 2)
     domain_criterion = nn.BCELoss()
 
+    start_epoch = 0; resume_state = None; state = {}
     if checkpoint:
-      load_checkpoint(checkpoint, image_model, sketch_model, domain_net, optimizer)
+      state = load_checkpoint(checkpoint, image_model, sketch_model, domain_net)
+      # the optimizer only steps the parameters that are not frozen, its state carries over when the same ones are trained
+      if state.get('frozen_blocks', 0) == frozen_blocks and [len(group['params']) for group in state['optim_dict']['param_groups']] == [len(group['params']) for group in optimizer.param_groups]:
+        optimizer.load_state_dict(state['optim_dict'])
+      else:
+        print('%s trained other parameters (frozen_blocks %d, now %d): the optimizer starts from scratch' % (checkpoint, state.get('frozen_blocks', 0), frozen_blocks))
+      if 'remaining_batches' in state:
+        start_epoch = state['epoch'] + (0 if state['remaining_batches'] else 1)
+        if state['remaining_batches']: resume_state = state
+      if resume_state is not None and state.get('world_size', 1) != world_size:
+        raise ValueError('%s stopped in an epoch of a run with %d processes, only as many can continue it' % (checkpoint, state.get('world_size', 1)))
+    checkpoint_manager = CheckpointManager(checkpoint_dir, keep_last = keep_last) if main_process else None
+
+    sampler_seed = 0
+    if distributed:
+      # the epochs are shuffled the same way on every rank, so the ranks get disjoint shares (a resumed run keeps the seed);
+      # the triplet sampling RNGs are independent per rank
+      sampler_seed = state['sampler_seed'] if 'sampler_seed' in state else shared_seed()
+      seed_rank(sampler_seed, rank, state.get('iteration', -1) + 1)
+
+    if sampling == 'triplet':
+      train_dataloader = self.dataloaders.get_train_dataloader(batch_size = batch_size, shuffle=True, num_replicas = world_size, rank = rank, seed = sampler_seed)
+    else:
+      train_dataloader = self.dataloaders.get_pk_train_dataloader(classes_per_batch, samples_per_class, num_replicas = world_size)
+      class_similarity = torch.FloatTensor(self.dataloaders.train_dataset.word_vectors_similarity).to(device)
+    num_batches = len(train_dataloader) 
+
+    # every model call of an iteration goes through one module, which DistributedDataParallel wraps in distributed training
+    # (and then gives rank 0's weights to every rank, before the feature cache key is computed from them)
+    suffix_only = bool(frozen_blocks and feature_cache_dir)
+    train_modules = TrainingModules(image_model, sketch_model, domain_net, suffix_only = suffix_only)
+    if distributed: train_modules = data_parallel(train_modules, device)
+    encode_sketches = functools.partial(train_modules, 'sketch_model'); encode_photos = functools.partial(train_modules, 'image_model')
+    classify_domain = functools.partial(train_modules, 'domain_net')
+
+    if suffix_only:
+      # after the checkpoint is loaded: the cache key is the hash of the frozen weights
+      feature_cache = FeatureCache(feature_cache_dir, image_model, sketch_model, frozen_blocks)
+      if main_process:
+        start_time = time.time()
+        num_encoded = feature_cache.build_dataset(self.dataloaders.train_dataset, batch_size = batch_size, num_workers = self.dataloaders.num_workers, device = device)
+        print('Feature cache %s: %d files encoded in %.1fs, %.1f MB' % (feature_cache.directory, num_encoded, time.time() - start_time, feature_cache.size_bytes() / 2**20))
+      barrier() # the other ranks read the cache rank 0 wrote
+      feature_cache.attach(self.dataloaders.train_dataset)
+
+    def checkpoint_state(epoch, global_iteration, batches_done):
+      state = {'iteration': global_iteration, 
+               'epoch': epoch,
+               'architecture': architecture,
+               'frozen_blocks': frozen_blocks,
+               'image_model': image_model.state_dict(), 
+               'sketch_model': sketch_model.state_dict(),
+               'domain_model': domain_net.state_dict(),
+               'optim_dict': optimizer.state_dict(),
+               'remaining_batches': train_dataloader.batch_sampler.remaining(batches_done), # [] once the epoch is complete
+               'rng_state': get_rng_state()}
+      if distributed: # the remaining batches and the RNG states are rank 0's
+        state.update({'world_size': world_size, 'sampler_seed': sampler_seed})
+      return state
 
-    print('Training...')    
+    if main_process: print('Training...')    
     
 
+    # the other ranks keep their logger silent: it only times their stages
+    logger = TrainingLogger(log_file if main_process else None, print_every = print_every if main_process else 0,
+                            profile_windows = profile_windows if main_process else None, profile_dir = profile_dir, device = device)
+    timer = StageTimer(device)
+
+    validator = None
+    if validation_per_class > 0 and main_process:
+      validator = Validator(self.dataloaders, per_class = validation_per_class, every = validate_every, max_fraction = validation_budget)
+
+    def validate(global_iteration):
+      results = validator.run(image_model, sketch_model, device, global_iteration)
+      logger.log_validation(global_iteration, results)
+      return results['mAP']
+
+    grl_weight = 0
+    last_saved = None
     #for epoch in range(config['epochs']):
-    for epoch in range(10):
-      accumulated_triplet_loss = RunningAverage()
-      accumulated_iteration_time = RunningAverage()
-      accumulated_image_domain_loss = RunningAverage()
-      accumulated_sketch_domain_loss = RunningAverage()
+    for epoch in range(start_epoch, 10):
+      logger.start_epoch(epoch)
 
-      epoch_start_time = time.time()
+      start_batch = 0
+      train_dataloader.batch_sampler.set_epoch(epoch)
+      if resume_state is not None and distributed:
+        # the checkpoint only holds rank 0's batches: every rank draws its share of the epoch again and skips the consumed
+        # batches, its RNGs were seeded for the resumed iteration (seed_rank)
+        start_batch = num_batches - len(resume_state['remaining_batches'])
+        train_dataloader.batch_sampler.skip(start_batch)
+        train_batches = iter(train_dataloader)
+        if main_process: print('Resuming epoch %d at batch %d' % (epoch, start_batch))
+        last_saved = resume_state['iteration']; resume_state = None
+      elif resume_state is not None:
+        # same remaining batches in the same order, and (once the loader has drawn its seed) the RNGs as they were
+        # when the checkpoint was taken
+        train_dataloader.batch_sampler.resume(resume_state['remaining_batches'])
+        start_batch = num_batches - len(resume_state['remaining_batches'])
+        train_batches = iter(train_dataloader)
+        set_rng_state(resume_state['rng_state'])
+        print('Resuming epoch %d at batch %d' % (epoch, start_batch))
+        last_saved = resume_state['iteration']; resume_state = None
+      else:
+        train_batches = iter(train_dataloader)
 
       image_model.train() 
       sketch_model.train()
       domain_net.train() 
       
-      for iteration, batch in enumerate(train_dataloader):
-        time_start = time.time()        
+      timer.start()
+      for iteration, batch in enumerate(train_batches, start_batch):
+        global_iteration = iteration + epoch * num_batches
+        timer.mark('data') # time spent waiting for the dataloader
+        logger.before_iteration(global_iteration)
+        stepped = (iteration + 1) % accumulation_steps == 0 or iteration + 1 == num_batches
+        if distributed:
+          # as in DistributedDataParallel.no_sync(): the gradients of an accumulation window are only averaged over
+          # the ranks in the backward pass of its last batch
+          train_modules.require_backward_grad_sync = stepped
+
+        if sampling == 'triplet':
+          '''GETTING THE DATA'''
+          anchors, positives, negatives, label_embeddings, positive_label_idxs, negative_label_idxs = batch
+          anchors = anchors.to(device, non_blocking = True); positives = positives.to(device, non_blocking = True)
+          negatives = negatives.to(device, non_blocking = True); label_embeddings = label_embeddings.to(device)
+          timer.mark('transfer')
 
-        '''GETTING THE DATA'''
-        anchors, positives, negatives, label_embeddings, positive_label_idxs, negative_label_idxs = batch
-        anchors = torch.autograd.Variable(anchors.to(device)); positives = torch.autograd.Variable(positives.to(device))
-        negatives = torch.autograd.Variable(negatives.to(device)); label_embeddings = torch.autograd.Variable(label_embeddings.to(device))
+          '''MAIN NET INFERENCE AND LOSS'''
+          pred_sketch_features = encode_sketches(anchors)
+          pred_positives_features = encode_photos(positives)
+          pred_negatives_features = encode_photos(negatives)
+          domain_image_features = [pred_positives_features, pred_negatives_features]
+        else:
+          '''GETTING THE DATA'''
+          anchors, photos, label_embeddings, label_idxs = batch
+          anchors = anchors.to(device, non_blocking = True); photos = photos.to(device, non_blocking = True); label_idxs = label_idxs.to(device)
+          timer.mark('transfer')
 
-        '''MAIN NET INFERENCE AND LOSS'''
-        pred_sketch_features = sketch_model(anchors)
-        pred_positives_features = image_model(positives)
-        pred_negatives_features = image_model(negatives)
+          '''MAIN NET INFERENCE AND IN-BATCH MINING'''
+          pred_sketch_features = encode_sketches(anchors)
+          pred_photo_features = encode_photos(photos)
+          positive_indices, negative_indices = mine_triplets(pred_sketch_features, pred_photo_features, label_idxs, margin = 1.0, mode = sampling, class_similarity = class_similarity)
+          pred_positives_features = pred_photo_features[positive_indices]
+          pred_negatives_features = pred_photo_features[negative_indices]
+          domain_image_features = [pred_photo_features]
 
         #triplet_loss = config['triplet_loss_ratio'] * criterion(pred_sketch_features, pred_positives_features, pred_negatives_features)
         triplet_loss = 1 * criterion(pred_sketch_features, pred_positives_features, pred_negatives_features)
-        accumulated_triplet_loss.update(triplet_loss, anchors.shape[0])        
+        timer.mark('forward')
 
         '''DOMAIN ADVERSARIAL TRAINING''' # vannila generator for now. Later - add randomness in outputs of generator, or lower the label
 
@@ -98,54 +273,63 @@ class Trainer():
         else:
           grl_weight = 1
 
-        domain_pred_p_images = domain_net(grad_reverse(pred_positives_features, grl_weight))
-        domain_pred_n_images = domain_net(grad_reverse(pred_negatives_features, grl_weight))
-        domain_pred_sketches = domain_net(grad_reverse(pred_sketch_features, grl_weight))
+        domain_pred_images = [classify_domain(grad_reverse(features, grl_weight)) for features in domain_image_features]
+        domain_pred_sketches = classify_domain(grad_reverse(pred_sketch_features, grl_weight))
 
         '''DOMAIN LOSS'''
 
         #domain_loss_images = config['domain_loss_ratio'] * (domain_criterion(domain_pred_p_images, image_domain_targets) + domain_criterion(domain_pred_n_images, image_domain_targets))
-        domain_loss_images = 0.5 * (domain_criterion(domain_pred_p_images, image_domain_targets) + domain_criterion(domain_pred_n_images, image_domain_targets))
-        accumulated_image_domain_loss.update(domain_loss_images, anchors.shape[0])
+        # 0.5 * (positives + negatives) in triplet mode, the same weight on the batch's photos with in-batch mining
+        domain_loss_images = sum([domain_criterion(pred, image_domain_targets) for pred in domain_pred_images]) / len(domain_pred_images)
         #domain_loss_sketches = config['domain_loss_ratio'] * (domain_criterion(domain_pred_sketches, sketch_domain_targets))
         domain_loss_sketches = 0.5 * (domain_criterion(domain_pred_sketches, sketch_domain_targets))
-        accumulated_sketch_domain_loss.update(domain_loss_sketches, anchors.shape[0])    
         total_domain_loss = domain_loss_images + domain_loss_sketches
+        timer.mark('domain')
 
         '''OPTIMIZATION W.R.T. BOTH LOSSES'''
-        optimizer.zero_grad()  
+        # every loss is a batch mean, dividing by the number of batches of the accumulation window makes the summed
+        # gradients those of the mean over the window (the last window of an epoch may be shorter)
+        if iteration % accumulation_steps == 0:
+          optimizer.zero_grad()  
+          window = min(accumulation_steps, num_batches - iteration)
         total_loss = triplet_loss + total_domain_loss
-        total_loss.backward()
-        optimizer.step()  
-
+        (total_loss / window).backward()
+        timer.mark('backward')
+        if stepped:
+          optimizer.step()  
+        timer.mark('optimizer')
 
         '''LOGGER'''
-        time_end = time.time()
-        accumulated_iteration_time.update(time_end - time_start)
+        # only detached python floats are kept, the loss tensors (and their graphs) are released with the iteration.
+        # The batch size is that of all the ranks (the losses are rank 0's)
+        logger.log_iteration(iteration, num_batches, global_iteration, anchors.shape[0] * world_size,
+                             {'triplet_loss': triplet_loss.item(), 'sketch_domain_loss': domain_loss_sketches.item(), 'image_domain_loss': domain_loss_images.item()},
+                             timer.times)
 
-        #if iteration % config['print_every'] == 0:
-        if iteration % 10 == 0:
-          eta_cur_epoch = str(datetime.timedelta(seconds = int(accumulated_iteration_time() * (num_batches - iteration)))) 
-          print(datetime.datetime.now(pytz.timezone('America/Los_Angeles')).replace(microsecond = 0), end = ' ')
-
-          print('Epoch: %d [%d / %d] ; eta: %s' % (epoch, iteration, num_batches, eta_cur_epoch))
-          print('Average Triplet loss: %f(%f);' % (triplet_loss, accumulated_triplet_loss()))
-          print('Sketch domain loss: %f; Image Domain loss: %f' % (accumulated_sketch_domain_loss(), accumulated_image_domain_loss()))
+        '''VALIDATION AND CHECKPOINT'''
+        # only between optimizer steps, so a resumed run starts a fresh accumulation window
+        score = None
+        if validator and validator.every and stepped and iteration + 1 < num_batches and validator.due(global_iteration):
+          score = validate(global_iteration)
+        if main_process and stepped and iteration + 1 < num_batches and (score is not None or save_every and global_iteration - (last_saved if last_saved is not None else -1) >= save_every):
+          checkpoint_manager.save(checkpoint_state(epoch, global_iteration, iteration + 1), global_iteration, score = score)
+          last_saved = global_iteration
+        timer.start()
         
       '''END OF EPOCH'''
-      epoch_end_time = time.time()
-      print('Epoch %d complete, time taken: %s' % (epoch, str(datetime.timedelta(seconds = int(epoch_end_time - epoch_start_time)))))
+      last_iteration = epoch * num_batches + num_batches - 1
+      score = validate(last_iteration) if validator and validator.due(last_iteration, end_of_epoch = True) else None
+      logger.end_epoch(peak_memory_mb(device))
       torch.cuda.empty_cache()
 
-      save_checkpoint({'iteration': iteration + epoch * num_batches, 
-                        'image_model': image_model.state_dict(), 
-                        'sketch_model': sketch_model.state_dict(),
-                        'domain_model': domain_net.state_dict(),
-                        'optim_dict': optimizer.state_dict()},
-                         #checkpoint_dir = config['checkpoint_dir'])
-                         checkpoint_dir = "C:/Users/rub/Desktop/Stanford/CS230/Project/Zero-Shot-Sketch-Based-Image-Retrieval-master/Zero-Shot-Sketch-Based-Image-Retrieval-master/saveModel")
-      print('Saved epoch!')
-      print('\n\n\n')
+      last_saved = last_iteration
+      if main_process:
+        checkpoint_manager.save(checkpoint_state(epoch, last_iteration, num_batches), last_iteration, score = score)
+        print('Saving epoch in the background')
+        print('\n\n\n')
+
+    if main_process: checkpoint_manager.close()
+    logger.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+import argparse
+import datetime
+import time
+
+import torch
+
+from model.net import build_models, ARCHITECTURES
+from model.dataloader import Dataloaders
+from model.embedding_store import state_dict_hash, file_hash
+from model.export import load_exported_model
+from model.gallery_index import GalleryIndex
+from utils import load_checkpoint
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Brings a gallery index (served by serve.py --gallery) up to date with the test photos: encodes only the added or modified photos and tombstones the deleted ones')
+  parser.add_argument('--model', help='Model checkpoint path')
+  parser.add_argument('--architecture', help='Architecture of the checkpoint (train.py architecture)', choices = ARCHITECTURES, default = 'two_tower')
+  parser.add_argument('--exported_model', help='TorchScript image model written by export.py, used instead of --model')
+  parser.add_argument('--data', help='Data directory path. Directory should contain two folders - sketches and photos, along with 2 .txt files for the labels', required = True)
+  parser.add_argument('--shard_dir', help='Directory of pre-decoded image shards written by build_shards.py. Images are decoded from --data if omitted')
+  parser.add_argument('--index_dir', help='Directory of the gallery index, created if missing', required = True)
+  parser.add_argument('--batch_size', type=int, help='Batch size to encode the photos', default = 32)
+  parser.add_argument('--max_tombstones', type=float, help='Compact the index once this fraction of its rows are tombstones', default = 0.25)
+  parser.add_argument('--compact', action = 'store_true', help='Compact the index after the update')
+
+  args = parser.parse_args()
+
+  if args.exported_model:
+    device = torch.device('cpu')
+    image_model = load_exported_model(args.exported_model)
+    model_key = file_hash(args.exported_model)
+  else:
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    image_model, sketch_model = build_models(args.architecture, pretrained = not args.model)
+    if args.model: load_checkpoint(args.model, image_model, sketch_model, map_location = device)
+    model_key = state_dict_hash(image_model)
+  image_model = image_model.to(device).eval()
+
+  dataset = Dataloaders(args.data, shard_dir = args.shard_dir).get_test_dataloader(batch_size = args.batch_size, section = 'photos').dataset
+  def encode_images(indices):
+    dataloader = torch.utils.data.DataLoader(torch.utils.data.Subset(dataset, indices), batch_size = args.batch_size, shuffle = False)
+    with torch.no_grad():
+      return torch.cat([image_model(images.to(device)).cpu() for images, _ in dataloader], dim = 0).numpy()
+
+  start_time = time.time()
+  index = GalleryIndex(args.index_dir, model_key)
+  if index.model_key != model_key:
+    print('Gallery index %s was built with another model (%s, now %s): encoding every photo again' % (args.index_dir, index.model_key, model_key))
+  num_added, num_removed = index.sync(dataset.filenames, dataset.label_idxs, encode_images, model_key, dataset.stamp)
+  stats = index.snapshot().stats()
+  print('Gallery index %s: %d photos encoded, %d removed; %d live rows, %d tombstones, %d segments'
+        % (args.index_dir, num_added, num_removed, stats['live'], stats['tombstones'], stats['segments']))
+  if args.compact or stats['tombstones'] > args.max_tombstones * (stats['live'] + stats['tombstones']):
+    index.compact()
+    print('Compacted to generation %d' % index.snapshot().generation)
+  print('Time taken: %s' % str(datetime.timedelta(seconds = int(time.time() - start_time))))
@@ -1,7 +1,14 @@
 import numpy as np
 import os
+import sys
 import torch
-from torchvision.utils import make_grid
+try:
+  import resource
+except ImportError: # Windows
+  resource = None
+
+from model.retrieval import topk_search
+from model.checkpoints import atomic_save, lazy_load
 
 class RunningAverage():
   def __init__(self):
@@ -9,6 +16,7 @@ class RunningAverage():
     self.sum = 0
 
   def update(self, value, n_items = 1):
+    if isinstance(value, torch.Tensor): value = value.item() # never keep the autograd graph of a loss alive
     self.sum += value * n_items
     self.count += n_items
 
@@ -16,33 +24,83 @@ class RunningAverage():
     return self.sum/self.count  
 
 
-def save_checkpoint(state, checkpoint_dir):
-    file_name = 'last.pth.tar'
-    if not os.path.isdir(checkpoint_dir): os.mkdir(checkpoint_dir)
-    torch.save(state, os.path.join(checkpoint_dir, file_name))
+def peak_memory_mb(device = None):
+  '''Peak allocated memory of a CUDA device, otherwise the peak resident set size of the process (0 where it is unavailable)'''
+  if device is not None and device.type == 'cuda':
+    return torch.cuda.max_memory_allocated(device) / 2**20
+  if resource is None:
+    return windows_peak_working_set() / 2**20 if sys.platform == 'win32' else 0.0
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10 # bytes on macOS, kB on Linux
+
+
+def windows_peak_working_set():
+  '''Peak working set of this process in bytes (GetProcessMemoryInfo), the Windows counterpart of ru_maxrss'''
+  import ctypes
+  from ctypes import wintypes
+  class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+    _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [(name, ctypes.c_size_t) for name in
+                ['PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage', 'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage',
+                 'QuotaNonPagedPoolUsage', 'PagefileUsage', 'PeakPagefileUsage']]
+  counters = PROCESS_MEMORY_COUNTERS(); counters.cb = ctypes.sizeof(PROCESS_MEMORY_COUNTERS)
+  get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+  get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+  ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+  if not get_process_memory_info(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+    return 0
+  return counters.PeakWorkingSetSize
+
 
-def load_checkpoint(checkpoint, image_model, sketch_model, domain_model=None, optimizer=None):
+def save_checkpoint(state, checkpoint_dir, file_name = 'last.pth.tar'):
+    '''Synchronous, atomic save (see model.checkpoints.CheckpointManager for the background writer used by training)'''
+    if not os.path.isdir(checkpoint_dir): os.makedirs(checkpoint_dir)
+    atomic_save(state, os.path.join(checkpoint_dir, file_name))
+
+def load_checkpoint(checkpoint, image_model, sketch_model, domain_model=None, optimizer=None, map_location='cpu'):
+    '''
+    Loads the weights (and optimizer state) and returns the checkpoint dict, e.g. for the epoch/sampler/RNG state.
+    The file is memory-mapped where possible (model.checkpoints.lazy_load), so unused entries are not read
+    '''
     if not os.path.exists(checkpoint):
         raise Exception("File {} doesn't exist".format(checkpoint))
-    checkpoint = torch.load(checkpoint)
+    checkpoint = lazy_load(checkpoint, map_location = map_location)
     print('Loading the models from the end of net iteration %d' % (checkpoint['iteration']))
     image_model.load_state_dict(checkpoint['image_model'])
     sketch_model.load_state_dict(checkpoint['sketch_model'])
     if domain_model: domain_model.load_state_dict(checkpoint['domain_model'])
     if optimizer:
       optimizer.load_state_dict(checkpoint['optim_dict'])
+    return checkpoint
+
+def save_embeddings(output_dir, image_features, image_labels, sketch_features, sketch_labels):
+  if not os.path.isdir(output_dir): os.makedirs(output_dir)
+  np.save(os.path.join(output_dir, 'photo_embeddings.npy'), np.asarray(image_features, dtype = np.float32))
+  np.save(os.path.join(output_dir, 'photo_labels.npy'), np.asarray(image_labels))
+  np.save(os.path.join(output_dir, 'sketch_embeddings.npy'), np.asarray(sketch_features, dtype = np.float32))
+  np.save(os.path.join(output_dir, 'sketch_labels.npy'), np.asarray(sketch_labels))
+
+def load_embeddings(input_dir):
+  '''Returns (image_features, image_labels, sketch_features, sketch_labels) written by save_embeddings'''
+  names = ['photo_embeddings', 'photo_labels', 'sketch_embeddings', 'sketch_labels']
+  return tuple(np.load(os.path.join(input_dir, name + '.npy'), mmap_mode = 'r') for name in names)
+
+def gather_images(images, indices):
+  '''Rows 'indices' of an image tensor, or the same images read again from a dataset of (image, label) pairs'''
+  if isinstance(images, torch.Tensor):
+    return images[indices]
+  return torch.stack([images[i][0] for i in indices])
 
-def get_sketch_images_grids(sketches, images, similarity_scores, k, num_display):
+def get_sketch_images_grids(sketches, images, sketch_features, image_features, k, num_display, metric = 'l2'):
 
   if num_display == 0 or k == 0:
     return None, None
-  num_sketches = sketches.shape[0]
+  from torchvision.utils import make_grid # only needed for the displayed grids
+  num_sketches = len(sketches)
   indices = np.random.choice(num_sketches, num_display)
 
-  cur_sketches = sketches[indices]; cur_similarities = similarity_scores[indices]
-  top_k_similarity_indices  = np.flip(np.argsort(cur_similarities, axis = 1)[:, -k:], axis = 1).copy()
-  top_k_similarity_values = np.flip(np.sort(cur_similarities, axis = 1)[:,-k:], axis = 1).copy()
-  matched_images = [images[top_k_similarity_indices[i]] for i in range(num_display)]
+  cur_sketches = gather_images(sketches, indices)
+  _, top_k_similarity_indices = topk_search(sketch_features[indices], image_features, k, metric = metric)
+  matched_images = [gather_images(images, top_k_similarity_indices[i]) for i in range(num_display)]
 
   list_of_sketches = [np.transpose(cur_sketches[i].cpu().numpy(), (1,2,0)) for i in range(num_display)]
   list_of_image_grids = [np.transpose(make_grid(matched_images[i], nrow = k).cpu().numpy(), (1,2,0)) for i in range(num_display)]